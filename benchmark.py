@@ -0,0 +1,416 @@
+"""
+Benchmarks for the performance sensitive parts of the map generation, runnable without access to the official APIs.
+Run with a benchmark name, e.g. `python benchmark.py fetch`, see `python benchmark.py --help` for the list.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from data.continents import continent_map_params
+from data.portals import portals
+from data.layouts import map_layouts
+from gw2_zone_map import override_zone_data
+from mapgen.data_api import load_zone_data
+from mapgen.map_canvas import MapCanvas
+from mapgen.map_coordinates import MapCoordinateSystem
+from mapgen.map_encoder import save_in_strips
+from mapgen.map_generator import TileApiMapTileSource, ThreadedMapTileFetcher, AsyncioMapTileFetcher, LocalMapTileSource, ArchiveMapTileSource
+from mapgen.memory_usage import get_peak_memory_usage_text
+from mapgen.overlay import map_overlays
+from mapgen.overlay.overlay_util import get_font, get_wrapped_text_lines, get_text_length, get_appended_word_length, add_stroke_around_alpha, \
+    create_stroke_stamp, draw_antialiased_line, get_line_width
+from mapgen.overlay.zone_overlay import ZoneMapOverlay
+from mapgen.tile_archive import pack_tile_directory
+
+
+class StubTileRequestHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the official tile service, serving the same generated JPEG tile for every request after a fixed latency."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    tile_bytes = b''
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.tile_bytes)))
+        self.send_header('ETag', '"stub"')
+        self.end_headers()
+        self.wfile.write(self.tile_bytes)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_stub_tile_image() -> Image.Image:
+    return Image.effect_noise((256, 256), 64).convert('RGB')
+
+
+def create_stub_tile_directory(directory: str, tile_count: int, zoom: int = 7):
+    """Creates a tile directory in the same layout as that_shaman's tiles, containing tile_count x tile_count copies of a generated tile."""
+    tile_buffer = BytesIO()
+    create_stub_tile_image().save(tile_buffer, 'JPEG', quality=90)
+    for x in range(tile_count):
+        os.makedirs(f'{directory}/1/1/{zoom}/{x}', exist_ok=True)
+        for y in range(tile_count):
+            with open(f'{directory}/1/1/{zoom}/{x}/{y}.jpg', 'wb') as f:
+                f.write(tile_buffer.getvalue())
+
+
+def start_stub_tile_server(latency: float) -> tuple[ThreadingHTTPServer, str]:
+    tile_image = create_stub_tile_image()
+    tile_buffer = BytesIO()
+    tile_image.save(tile_buffer, 'JPEG', quality=90)
+    StubTileRequestHandler.latency = latency
+    StubTileRequestHandler.tile_bytes = tile_buffer.getvalue()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTileRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/{{continent}}/{{floor}}/{{zoom}}/{{x}}/{{y}}.jpg?dns={{dns}}'
+
+
+def benchmark_fetch(args):
+    server, tile_url = start_stub_tile_server(args.latency)
+    tile_coords = [(x, y) for x in range(args.tiles) for y in range(args.tiles)]
+    print(f"Fetching {len(tile_coords)} tiles from a local stub server with {1000 * args.latency:.0f} ms latency...")
+
+    for name in args.engines:
+        tile_source = TileApiMapTileSource(tile_url)
+        tile_fetcher = ThreadedMapTileFetcher(tile_source) if name == 'thread' else AsyncioMapTileFetcher(tile_source, args.concurrency)
+        loaded = 0
+
+        def on_tile_loaded(x, y, tile_image):
+            nonlocal loaded
+            tile_image.load()
+            loaded += 1
+
+        start = time.perf_counter()
+        tile_fetcher.fetch_tiles(1, 1, 7, tile_coords, on_tile_loaded)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {loaded} tiles in {elapsed:.2f} s ({loaded / elapsed:.0f} tiles/s)")
+
+    server.shutdown()
+
+
+def benchmark_local(args):
+    tile_coords = [(x, y) for x in range(args.tiles) for y in range(args.tiles)]
+    with tempfile.TemporaryDirectory() as tiles_dir:
+        print(f"Creating a local tile directory with {len(tile_coords)} tiles...")
+        create_stub_tile_directory(tiles_dir, args.tiles)
+
+        archive_path = f'{tiles_dir}/tiles.gw2tiles'
+        pack_tile_directory(tiles_dir, archive_path)
+
+        for name, create_tile_source in [('directory', LocalMapTileSource), ('archive', ArchiveMapTileSource)]:
+            for workers in args.workers:
+                tile_fetcher = ThreadedMapTileFetcher(create_tile_source(tiles_dir if name == 'directory' else archive_path, workers))
+                start = time.perf_counter()
+                tile_fetcher.fetch_tiles(1, 1, 7, tile_coords, lambda x, y, tile_image: None)
+                elapsed = time.perf_counter() - start
+                print(f"{name:>9}, {workers:>3} workers: {len(tile_coords)} tiles in {elapsed:.2f} s ({len(tile_coords) / elapsed:.0f} tiles/s)")
+
+
+def benchmark_labels(args):
+    print(f"Loading zone data{' from the local API cache' if args.api_load else ''}...")
+    zone_data = load_zone_data([args.lang], load_api_cache=args.api_load)[args.lang]
+    map_layout = map_layouts[args.layout]
+    print(f"Drawing overlays for layout '{args.layout}' at zoom {args.zoom} over blank base maps...")
+
+    for overlay_name in args.overlays:
+        map_overlay = map_overlays[overlay_name]
+        overlay_zone_data = override_zone_data(zone_data, map_overlay)
+        elapsed = 0
+        for _, sector in map_layout.parts:
+            map_coord = MapCoordinateSystem(continent_map_params[sector.continent_id], args.zoom, sector)
+            image = Image.new('RGB', map_coord.continent_to_sector_image_coord(map_coord.sector_bottom_right))
+            start = time.perf_counter()
+            map_overlay.draw_overlay(image, list(overlay_zone_data), map_layout, map_coord, 1, debug=False)
+            elapsed += time.perf_counter() - start
+        print(f"{overlay_name:>12}: {len(overlay_zone_data)} zones in {elapsed:.2f} s. {get_peak_memory_usage_text()}")
+
+
+def get_wrapped_text_lines_reference(text, font, line_length):
+    """Previous implementation of get_wrapped_text_lines, measuring the whole line again for each word, to compare against."""
+    lines = ['']
+    for i, word in enumerate(text.split(' ')):
+        line = f'{lines[-1]} {word}' if i > 0 else word
+        if font.getlength(line) <= line_length or len(lines[-1]) < 3:
+            lines[-1] = line
+        else:
+            lines.append(word)
+    return lines
+
+
+def benchmark_wrap(args):
+    print(f"Loading zone data{' from the local API cache' if args.api_load else ''}...")
+    zone_data = load_zone_data(args.langs, load_api_cache=args.api_load)
+    texts = [line for lang in args.langs for zone in zone_data[lang] for line in zone['name'].splitlines()]
+    fonts = [get_font(size, bold, not bold) for size in [16, 32, 64] for bold in [True, False]]
+    line_lengths = [100, 200, 400]
+    cases = [(text, font, line_length) for text in texts for font in fonts for line_length in line_lengths]
+    print(f"Wrapping {len(texts)} zone names in {len(args.langs)} languages with {len(fonts)} fonts and {len(line_lengths)} line lengths ({len(cases)} cases)...")
+
+    start = time.perf_counter()
+    reference_results = [get_wrapped_text_lines_reference(*case) for case in cases]
+    print(f"   reference: {time.perf_counter() - start:.2f} s")
+
+    get_text_length.cache_clear()
+    get_appended_word_length.cache_clear()
+    for name in ['cold cache', 'warm cache']:
+        start = time.perf_counter()
+        results = [get_wrapped_text_lines(*case) for case in cases]
+        print(f"{name:>12}: {time.perf_counter() - start:.2f} s")
+
+    mismatches = sum(1 for result, reference_result in zip(results, reference_results) if result != reference_result)
+    print(f"Wrapped lines differing from the reference: {mismatches}")
+
+
+def benchmark_import(args):
+    print(f"Importing {args.module} in {args.runs} fresh interpreters...")
+    elapsed = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {args.module}'], check=True)
+        elapsed.append(time.perf_counter() - start)
+    baseline_start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    baseline = time.perf_counter() - baseline_start
+    print(f"min {min(elapsed):.3f} s, average {sum(elapsed) / len(elapsed):.3f} s, interpreter startup alone {baseline:.3f} s")
+
+
+def add_stroke_around_alpha_reference(image, stroke_width=1, stroke_color=(0, 0, 0, 255), alpha_threshold=64):
+    """Previous implementation of add_stroke_around_alpha, stamping the stroke point by point, to compare against."""
+    image_array = np.asarray(image)
+    input_alpha = image_array[..., 3]
+    output_alpha = np.zeros(np.array(input_alpha.shape) + 2 * stroke_width, dtype=float)
+
+    stamp = create_stroke_stamp(stroke_width)
+    stamp_size = np.size(stamp, 0)
+    for i in range(np.size(input_alpha, 0)):
+        for j in range(np.size(input_alpha, 1)):
+            if input_alpha[i, j] >= alpha_threshold:
+                output_slice = output_alpha[i:i + stamp_size, j:j + stamp_size]
+                np.add(output_slice, stamp, out=output_slice)
+
+    np.clip(output_alpha, 0, 1, out=output_alpha)
+    output_array = np.full(image_array.shape + np.array((2 * stroke_width, 2 * stroke_width, 0)), stroke_color, dtype=float)
+    output_array[..., 3] *= output_alpha
+    output_stroke = Image.fromarray(output_array.round().astype(np.uint8))
+
+    extended_image = Image.new('RGBA', output_stroke.size)
+    extended_image.paste(image, (stroke_width, stroke_width), image)
+    composite_image = Image.alpha_composite(output_stroke, extended_image)
+    return composite_image.crop(composite_image.getbbox())
+
+
+def create_text_image(size: tuple[int, int]) -> Image.Image:
+    """Creates a transparent image filled with lines of text, similar to the zone labels."""
+    image = Image.new('RGBA', size)
+    draw = ImageDraw.Draw(image)
+    font = get_font(32, True)
+    for y in range(0, size[1], 48):
+        draw.text((8 - y % 96, y), 'Divinity\'s Reach Lion\'s Arch Bloodtide Coast ' * (size[0] // 400 + 1), font=font, fill='white')
+    return image
+
+
+def benchmark_stroke(args):
+    for stroke_width in args.stroke_widths:
+        image = create_text_image((args.reference_size, args.reference_size))
+        start = time.perf_counter()
+        reference_result = add_stroke_around_alpha_reference(image, stroke_width)
+        reference_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        result = add_stroke_around_alpha(image, stroke_width)
+        elapsed = time.perf_counter() - start
+
+        if result.size != reference_result.size:
+            diff_text = f"size {result.size} differs from the reference {reference_result.size}"
+        else:
+            diff = np.abs(np.asarray(result, dtype=int) - np.asarray(reference_result, dtype=int))
+            diff_text = f"max pixel difference {diff.max()}, {np.count_nonzero(diff.max(axis=2))} pixels differ"
+        print(f"Stroke width {stroke_width}, {image.size[0]}x{image.size[1]} image: reference {reference_elapsed:.2f} s, vectorized {elapsed:.3f} s, {diff_text}")
+
+        image = create_text_image((args.size, args.size))
+        start = time.perf_counter()
+        add_stroke_around_alpha(image, stroke_width)
+        print(f"Stroke width {stroke_width}, {image.size[0]}x{image.size[1]} image: vectorized {time.perf_counter() - start:.2f} s")
+
+
+def draw_portal_connection_line_reference(map_image, portal1_image_coord, portal2_image_coord, line_color, line_width, margin):
+    """Previous implementation of ZoneMapOverlay.draw_portal_connection_line, drawing the line at 4x scale and downsampling it, to compare against."""
+    super_sampling_factor = 4
+    line_rect = abs(portal1_image_coord[0] - portal2_image_coord[0]), abs(portal1_image_coord[1] - portal2_image_coord[1])
+    paste_coord = min(portal1_image_coord[0], portal2_image_coord[0]) - margin, min(portal1_image_coord[1], portal2_image_coord[1]) - margin
+    super_sampled_image_size = super_sampling_factor * (line_rect[0] + 2 * margin), super_sampling_factor * (line_rect[1] + 2 * margin)
+    super_sampled_image = Image.new('RGBA', super_sampled_image_size)
+    super_sampled_draw = ImageDraw.Draw(super_sampled_image)
+
+    line_coord = ((super_sampling_factor * (portal1_image_coord[0] - paste_coord[0]), super_sampling_factor * (portal1_image_coord[1] - paste_coord[1])),
+                  (super_sampling_factor * (portal2_image_coord[0] - paste_coord[0]), super_sampling_factor * (portal2_image_coord[1] - paste_coord[1])))
+    super_sampled_draw.line(line_coord, fill=line_color, width=super_sampling_factor * line_width)
+
+    resized_size = line_rect[0] + 2 * margin, line_rect[1] + 2 * margin
+    smooth_line_image = super_sampled_image.resize(resized_size, resample=Image.Resampling.LANCZOS)
+    map_image.paste(smooth_line_image, paste_coord, smooth_line_image)
+
+
+def get_portal_connection_lines(zoom: float) -> list[tuple[tuple[int, int], tuple[int, int], tuple[int, int, int, int], int]]:
+    """Returns the image coordinates, relative to their own canvas, color and width of all portal connection lines at the given zoom."""
+    map_coord = MapCoordinateSystem(continent_map_params[1], zoom)
+    line_width = get_line_width(map_coord)
+    lines = []
+    for portal_type, settings in ZoneMapOverlay.portal_settings.items():
+        for portal in portals.get(portal_type, []):
+            if len(portal) == 5 and settings['line_color'] is not None:
+                portal1_image_coord = map_coord.continent_to_full_image_coord((portal[1], portal[2]))
+                portal2_image_coord = map_coord.continent_to_full_image_coord((portal[3], portal[4]))
+                canvas_offset = min(portal1_image_coord[0], portal2_image_coord[0]) - line_width, min(portal1_image_coord[1], portal2_image_coord[1]) - line_width
+                lines.append(((portal1_image_coord[0] - canvas_offset[0], portal1_image_coord[1] - canvas_offset[1]),
+                              (portal2_image_coord[0] - canvas_offset[0], portal2_image_coord[1] - canvas_offset[1]), settings['line_color'], line_width))
+    return lines
+
+
+def draw_portal_connection_lines(implementation: str, zoom: float) -> tuple[float, list[np.ndarray]]:
+    elapsed = 0
+    canvases = []
+    for portal1_image_coord, portal2_image_coord, line_color, line_width in get_portal_connection_lines(zoom):
+        canvas = Image.new('RGB', (abs(portal1_image_coord[0] - portal2_image_coord[0]) + 2 * line_width + 1, abs(portal1_image_coord[1] - portal2_image_coord[1]) + 2 * line_width + 1))
+        start = time.perf_counter()
+        if implementation == 'reference':
+            draw_portal_connection_line_reference(canvas, portal1_image_coord, portal2_image_coord, line_color, line_width, line_width)
+        else:
+            draw_antialiased_line(canvas, portal1_image_coord, portal2_image_coord, line_color, line_width)
+        elapsed += time.perf_counter() - start
+        canvases.append(np.asarray(canvas))
+    return elapsed, canvases
+
+
+def benchmark_lines(args):
+    if len(args.zooms) == 1 and len(args.implementations) == 1:
+        elapsed, canvases = draw_portal_connection_lines(args.implementations[0], args.zooms[0])
+        print(f"Zoom {args.zooms[0]}, {args.implementations[0]:>9}: {len(canvases)} lines in {elapsed:.2f} s. {get_peak_memory_usage_text()}")
+        return
+
+    print(f"Comparing the implementations at zoom {args.compare_zoom}...")
+    _, reference_canvases = draw_portal_connection_lines('reference', args.compare_zoom)
+    _, canvases = draw_portal_connection_lines('analytic', args.compare_zoom)
+    diffs = [np.abs(canvas.astype(int) - reference_canvas.astype(int)) for canvas, reference_canvas in zip(canvases, reference_canvases)]
+    total_ratio = sum(int(canvas.sum()) for canvas in canvases) / sum(int(canvas.sum()) for canvas in reference_canvases)
+    print(f"Max pixel difference {max(int(diff.max()) for diff in diffs)}, mean difference over the line pixels "
+          f"{sum(int(diff.sum()) for diff in diffs) / sum(np.count_nonzero(canvas) for canvas in reference_canvases):.2f}, total intensity {total_ratio:.3f} of the reference")
+
+    # Each measurement runs in its own process, so that the peak memory usage is its own
+    for zoom in args.zooms:
+        for implementation in args.implementations:
+            subprocess.run([sys.executable, sys.argv[0], 'lines', '--zooms', str(zoom), '--implementations', implementation], check=True)
+
+
+def create_encode_image(implementation: str, size: tuple[int, int], directory: str) -> Image.Image | MapCanvas:
+    """Creates an image covered with the stub tile, in memory for the 'save' implementation or as a map canvas for the others."""
+    tile_row_image = Image.new('RGB', (size[0], 256))
+    tile_image = create_stub_tile_image()
+    for x in range(0, size[0], 256):
+        tile_row_image.paste(tile_image, (x, 0))
+    image = Image.new('RGB', size) if implementation == 'save' else MapCanvas(size, directory)
+    for y in range(0, size[1], 256):
+        image.paste(tile_row_image, (0, y))
+    return image
+
+
+def benchmark_encode(args):
+    if len(args.formats) == 1 and len(args.implementations) == 1:
+        output_format, implementation = args.formats[0], args.implementations[0]
+        with tempfile.TemporaryDirectory() as directory:
+            image = create_encode_image(implementation, (args.width, args.height), directory)
+            output_path = f'{directory}/output.{output_format}'
+            start = time.perf_counter()
+            match implementation:
+                case 'save' | 'canvas':
+                    image.save(output_path, quality=95 if output_format == 'jpg' else None)
+                case 'stream':
+                    save_in_strips(image, output_path, f'{output_format}-stream')
+            elapsed = time.perf_counter() - start
+            print(f"{output_format} {implementation:>6}: encoded {args.width}x{args.height} in {elapsed:.2f} s, {os.path.getsize(output_path) / 2 ** 20:.0f} MiB. "
+                  f"{get_peak_memory_usage_text()}")
+            if isinstance(image, MapCanvas):
+                image.close()
+        return
+
+    # Each measurement runs in its own process, so that the peak memory usage is its own
+    for output_format in args.formats:
+        for implementation in args.implementations:
+            subprocess.run([sys.executable, sys.argv[0], 'encode', '--formats', output_format, '--implementations', implementation,
+                            '--width', str(args.width), '--height', str(args.height)], check=True)
+
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    fetch_parser = subparsers.add_parser('fetch', help="Compares the tile fetch engines against a local stub tile server.")
+    fetch_parser.add_argument('--engines', nargs='+', default=['thread', 'asyncio'], help="Fetch engines to compare: thread, asyncio")
+    fetch_parser.add_argument('--tiles', type=int, default=40, help="Number of tiles along each side of the fetched square.")
+    fetch_parser.add_argument('--latency', type=float, default=0.02, help="Simulated latency of the stub server in seconds.")
+    fetch_parser.add_argument('--concurrency', type=int, default=8, help="Concurrent requests per tile host for the asyncio engine.")
+    fetch_parser.set_defaults(func=benchmark_fetch)
+
+    local_parser = subparsers.add_parser('local', help="Measures local tile loading from a directory and from a tile archive with varying numbers of workers.")
+    local_parser.add_argument('--tiles', type=int, default=40, help="Number of tiles along each side of the loaded square.")
+    local_parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, 2, 4, os.cpu_count() or 1}), help="Worker counts to compare.")
+    local_parser.set_defaults(func=benchmark_local)
+
+    labels_parser = subparsers.add_parser('labels', help="Measures drawing of the zone overlays, dominated by the zone labels, over blank base maps. Needs the zone data from the API.")
+    labels_parser.add_argument('--api-load', action='store_true', help="Loads the zone data from the local API cache saved by gw2_zone_map.py --api-save instead of the API.")
+    labels_parser.add_argument('--lang', default='en', help="Language of the zone data.")
+    labels_parser.add_argument('--layout', default='TyriaWorld', help="Map layout to draw the overlays for.")
+    labels_parser.add_argument('--overlays', nargs='+', default=['zone_access', 'mastery'], help="Overlays to measure.")
+    labels_parser.add_argument('--zoom', type=float, default=4, help="Zoom level of the map.")
+    labels_parser.set_defaults(func=benchmark_labels)
+
+    wrap_parser = subparsers.add_parser('wrap', help="Compares the text wrapping of zone labels against its previous implementation. Needs the zone data from the API.")
+    wrap_parser.add_argument('--api-load', action='store_true', help="Loads the zone data from the local API cache saved by gw2_zone_map.py --api-save instead of the API.")
+    wrap_parser.add_argument('--langs', nargs='+', default=['en', 'es', 'de', 'fr'], help="Languages of the zone names.")
+    wrap_parser.set_defaults(func=benchmark_wrap)
+
+    import_parser = subparsers.add_parser('import', help="Measures the time to import a module, including the interpreter startup.")
+    import_parser.add_argument('--module', default='mapgen.overlay', help="Module to import.")
+    import_parser.add_argument('--runs', type=int, default=5, help="Number of measured imports.")
+    import_parser.set_defaults(func=benchmark_import)
+
+    stroke_parser = subparsers.add_parser('stroke', help="Compares add_stroke_around_alpha against its previous implementation on images of text.")
+    stroke_parser.add_argument('--stroke-widths', nargs='+', type=int, default=[1, 2, 4, 8], help="Stroke widths to compare.")
+    stroke_parser.add_argument('--reference-size', type=int, default=512, help="Size of the image compared against the previous implementation.")
+    stroke_parser.add_argument('--size', type=int, default=4096, help="Size of the image to measure the vectorized implementation alone on.")
+    stroke_parser.set_defaults(func=benchmark_stroke)
+
+    lines_parser = subparsers.add_parser('lines', help="Compares the drawing of the portal connection lines against its previous super-sampled implementation.")
+    lines_parser.add_argument('--compare-zoom', type=float, default=3, help="Zoom level to compare the output of the implementations at.")
+    lines_parser.add_argument('--implementations', nargs='+', default=['reference', 'analytic'], help="Implementations to measure: reference, analytic")
+    lines_parser.add_argument('--zooms', nargs='+', type=float, default=[5, 6], help="Zoom levels to measure.")
+    lines_parser.set_defaults(func=benchmark_lines)
+
+    encode_parser = subparsers.add_parser('encode', help="Compares saving a large map image by PIL against saving a map canvas and encoding it in strips.")
+    encode_parser.add_argument('--formats', nargs='+', default=['jpg', 'png'], help="Output formats to measure: jpg, png")
+    encode_parser.add_argument('--implementations', nargs='+', default=['save', 'canvas', 'stream'],
+                               help="Implementations to measure: save (an in-memory image saved by PIL), canvas (a map canvas saved by PIL) and stream (a map canvas encoded in strips)")
+    encode_parser.add_argument('--width', type=int, default=16384, help="Width of the encoded image.")
+    encode_parser.add_argument('--height', type=int, default=12288, help="Height of the encoded image.")
+    encode_parser.set_defaults(func=benchmark_encode)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
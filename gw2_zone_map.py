@@ -1,16 +1,27 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
 from pathlib import Path
 
+from PIL import Image
+
 from data.continents import continent_map_params
 from data.layouts import map_layouts
+from data.portals import portals
 from data.zones import conditional_zone_blacklist, conditional_zone_data_overrides, all_zone_data_overrides, \
     conditional_custom_zones
+from mapgen.build_manifest import BuildManifest, get_input_hash, get_tool_version, get_font_version
 from mapgen.data_api import load_zone_data
-from mapgen.map_composite import combine_part_images
+from mapgen.map_canvas import MapCanvas
+from mapgen.map_composite import combine_part_images, combine_part_canvases
 from mapgen.map_coordinates import MapSector, MapCoordinateSystem, MapLayout
-from mapgen.map_generator import MapGenerator
+from mapgen.map_encoder import strip_encoders, get_file_extension, save_in_strips
+from mapgen.map_generator import MapGenerator, TileApiMapTileSource
 from mapgen.overlay import map_overlays
-from mapgen.overlay.overlay_util import MapOverlay
+from mapgen.overlay.overlay_util import MapOverlay, label_layout_cache
+from mapgen.shared_image import SharedImage
+from mapgen.tile_archive import pack_tile_directory
+from mapgen.tile_pyramid import TilePyramidWriter
 
 
 def main():
@@ -25,11 +36,14 @@ def parse_arguments():
     sector_group.add_argument('-c', '--continent', type=int, help="ID of the continent to generate the map for")
     sector_group.add_argument('-l', '--layout', nargs='+', help=f"Name of the layout to generate the map for. Allowed values are: {list(map_layouts.keys())}")
 
-    parser.add_argument('-f', '--format', default='jpg', help="Output file format")
+    parser.add_argument('-f', '--format', default='jpg',
+                        help=f"Output file format. Either a file extension saved by PIL, such as 'jpg' or 'png', or one of {list(strip_encoders.keys())} to encode the output maps in parallel strips, without needing the whole map in memory.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes drawing the overlays and saving the output maps for the different overlays and languages in parallel. Default is 1.")
     parser.add_argument('-o', '--output', default='output', help="The output directory")
     parser.add_argument('-s', '--scale', type=float, default=1, help="Overlay scaling factor, default is 1.")
     parser.add_argument('-t', '--tiles', default='api',
-                        help="Source of map tile images. Allowed values are: 'local' (provided in a local directory structure, such as from that_shaman's map API), and 'api' (provided by the official tile API). Default is 'api'.")
+                        help="Source of map tile images. Allowed values are: 'local' (provided in a local directory structure, such as from that_shaman's map API), 'archive' (a single tile archive file packed from such a directory), and 'api' (provided by the official tile API). Default is 'api'.")
     parser.add_argument('-v', '--overlay', nargs='+', default=['zone_access', 'mastery'], help=f"Map overlays to generate. Allowed values are: {list(map_overlays.keys())}")
     parser.add_argument('-z', '--zoom', nargs='+', type=float, default=[3.4],
                         help="The zoom levels to generate the maps for. Does support decimal numbers as long as the zoom level exists when rounded up.")
@@ -37,12 +51,49 @@ def parse_arguments():
                         help='Instead of the REST API, optionally loads the API data from a local cache located in the api-cache directory, previously saved by the --api-save parameter. Can be used when the API service is down.')
     parser.add_argument('--api-save', action='store_true', default=False,
                         help='Optionally saves the data downloaded from the REST API to the api-cache directory, to be loaded later by the --api-load parameter in case the API service is down.')
+    parser.add_argument('--base-cache', default=None,
+                        help="Directory to cache the generated base map images (map tiles without overlays) in between runs, so that runs only changing zone data or overlays skip all tile work. By default, base maps are not cached.")
+    parser.add_argument('--base-cache-size', type=float, default=16384,
+                        help="Maximum size of the base map cache in MiB, evicting the least recently used base maps first. Default is 16384.")
+    parser.add_argument('--build-manifest', default=None,
+                        help="Optional file to record a hash of the inputs of each output map in, so that the following runs skip the maps whose inputs haven't changed. By default, all maps are generated.")
+    parser.add_argument('--canvas-dir', default=None,
+                        help="Directory to render the map images into memory-mapped canvas files in, instead of in memory, so that maps larger than the available memory can be generated. By default, map images are rendered in memory.")
     parser.add_argument('--debug', action='store_true', help="Renders debugging overlays, such as text label regions.")
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help="Only lists the output maps which would be generated, because their inputs changed since the build recorded in --build-manifest.")
+    parser.add_argument('--fetch', default='thread',
+                        help="Engine used to load the map tiles. Allowed values are: 'thread' (a thread pool with a task per tile) and 'asyncio' (an event loop with a limited number of concurrent requests per tile host). Default is 'thread'.")
+    parser.add_argument('--fetch-concurrency', type=int, default=8, help="If the fetch engine is 'asyncio', maximum number of concurrent tile requests per tile host. Default is 8.")
+    parser.add_argument('--label-cache', default=None,
+                        help="Optional file to save the zone label layouts to and reuse them in the following runs, so that unchanged labels only need to be drawn.")
     parser.add_argument('--lang', nargs='+', default=['en'], help="Languages to generate the map for (en, es, de, fr). Default is en. (Not fully supported yet.)")
     parser.add_argument('--no-legend', dest='legend', action='store_false', help="Marks if the overlay legends should be generated.")
     parser.add_argument('--no-overrides', dest='overrides', action='store_false',
                         help="Marks if custom zone data overrides to the official API should be ignored (by default they are applied).")
+    parser.add_argument('--overlay-tile-size', type=int, default=None,
+                        help="Draws the overlays one square tile of this size in pixels at a time, only drawing the features reaching into each tile, to bound the memory used at high zoom levels. By default, the overlays are drawn over each whole map part at once.")
+    parser.add_argument('--pack-tiles', action='store_true', default=False,
+                        help="Packs the local tiles directory given by --tiles-dir into the tile archive given by --tiles-archive before generating the maps.")
+    parser.add_argument('--pyramid-min-zoom', type=int, default=None,
+                        help="Writes each output map as a deep-zoom pyramid of 256 px tiles in zoom/x/y directories, from the --zoom level down to this zoom level, instead of a single image. Needs a single integer --zoom level and single sector layouts or continents. By default, single images are written.")
+    parser.add_argument('--tile-cache', default=None,
+                        help="If tiles are set to 'api', directory to cache the downloaded tiles in between runs. By default, tiles are not cached.")
+    parser.add_argument('--tile-cache-max-age', type=float, default=24,
+                        help="Number of hours for which cached tiles are used without revalidating them with the tile service, and for which base maps of 'api' tiles are reused by --base-cache and --build-manifest, default is 24.")
+    parser.add_argument('--tile-cache-size', type=float, default=4096, help="Maximum size of the tile cache in MiB, default is 4096.")
+    parser.add_argument('--tile-store-budget', type=float, default=1024,
+                        help="Memory budget in MiB for keeping loaded tiles which will be requested again within the same run, by other bands, layouts and zoom levels, 0 disables the reuse. Default is 1024.")
+    parser.add_argument('--tile-store-spill', default=None,
+                        help="Directory to spill reusable tiles exceeding --tile-store-budget to. By default, a temporary directory is used.")
+    parser.add_argument('--tile-store-spill-size', type=float, default=1024,
+                        help="Maximum size in MiB of the encoded tiles spilled to --tile-store-spill, further tiles are loaded again when requested. Default is 1024.")
+    parser.add_argument('--tile-workers', type=int, default=None,
+                        help="Number of parallel workers loading the map tiles for the 'thread' fetch engine. Default is the number of CPU cores for 'local' tiles and 32 for 'api' tiles.")
+    parser.add_argument('--tiles-archive', default='tiles.gw2tiles', help="If tiles are set to 'archive', path to the tile archive file.")
     parser.add_argument('--tiles-dir', default='tiles', help="If tiles are set to 'local', name of the input tiles directory, such as from that_shaman's map API.")
+    parser.add_argument('--tiles-url', default=TileApiMapTileSource.default_tile_url,
+                        help="If tiles are set to 'api', URL template of the tile service, with {dns}, {continent}, {floor}, {zoom}, {x} and {y} placeholders.")
 
     args = parser.parse_args()
     if not args.continent and not args.layout:
@@ -51,6 +102,18 @@ def parse_arguments():
     if args.api_save and args.api_load:
         raise RuntimeError("Cannot simultaneously save and load the API cache.")
 
+    if args.dry_run and not args.build_manifest:
+        raise RuntimeError("A dry run needs a build manifest to compare the inputs with.")
+
+    if args.pyramid_min_zoom is not None and (len(args.zoom) != 1 or not args.zoom[0].is_integer() or args.pyramid_min_zoom > args.zoom[0]):
+        raise RuntimeError("Tile pyramids need a single integer zoom level, not lower than the pyramid's minimum zoom level.")
+
+    # The pyramid tiles are aligned to a single continent's tile grid, which the parts of a composite layout don't share
+    if args.pyramid_min_zoom is not None and args.layout:
+        composite_layouts = [layout for layout in args.layout if layout in map_layouts and len(map_layouts[layout].parts) > 1]
+        if composite_layouts:
+            raise RuntimeError(f"Tile pyramids can only be written for single sector layouts or continents, not for the composite layouts {composite_layouts}.")
+
     print(f"Arguments: {args}")
     return args
 
@@ -59,63 +122,181 @@ def generate_maps(args):
     output_path = Path(args.output)
     output_path.mkdir(parents=True, exist_ok=True)
 
+    if args.pack_tiles and not args.dry_run:
+        print(f"Packing tiles from {args.tiles_dir} into {args.tiles_archive}...")
+        pack_tile_directory(args.tiles_dir, args.tiles_archive)
+
     map_generator = MapGenerator(args)
+    build_manifest = BuildManifest(args.build_manifest) if args.build_manifest else None
+
+    if args.label_cache:
+        label_layout_cache.load(args.label_cache)
 
     print(f"Loading data from the API...")
     zone_data = load_zone_data(args.lang, args.api_save, args.api_load)
     print(f"Data loaded.")
 
+    # Find the maps to generate first, so that the tile store knows which tiles will be requested again
+    map_jobs = []
+    rebuilt_outputs = skipped_outputs = 0
     for layout_name, map_layout in choose_map_layouts(args):
         for zoom in args.zoom:
-            print(f"Generating maps for layout '{layout_name}' at zoom {zoom}...")
-            part_images = {}
-
-            map_coord = None
-            scale_factor = args.scale
-            for sector_index, part in enumerate(map_layout.parts, start=1):
+            part_coords: list[tuple[tuple[int, int], MapCoordinateSystem]] = []
+            for part in map_layout.parts:
                 sector = part[1]
                 map_params = continent_map_params[sector.continent_id]
                 map_coord = MapCoordinateSystem(map_params, zoom, sector)
-                part_top_left = map_coord.continent_to_full_image_coord(part[0], False)
-
-                part_image = map_generator.generate_map_image(sector.continent_id, 1, map_coord, sector_index, len(map_layout.parts))
-
-                for lang in args.lang:
-                    for i, overlay_name in enumerate(args.overlay, start=1):
-                        print(f"Drawing map overlay '{overlay_name}' for language '{lang}'...")
-                        if overlay_name not in map_overlays:
-                            raise ValueError(f"Invalid overlay name specified ({overlay_name}). Allowed values are: {list(map_overlays.keys())}")
-                        map_overlay = map_overlays[overlay_name]
-                        overridden_zone_data = override_zone_data(zone_data[lang], map_overlay) if args.overrides else zone_data
-                        part_image_copy = part_image.copy()
-                        map_overlay.draw_overlay(part_image_copy, overridden_zone_data, map_layout, map_coord, scale_factor,
-                                                 debug=args.debug)
-
-                        if lang not in part_images:
-                            part_images[lang] = {}
-                        if overlay_name not in part_images[lang]:
-                            part_images[lang][overlay_name] = []
-                        part_images[lang][overlay_name].append((part_top_left, part_image_copy))
-
-                        print(f"Map overlay '{overlay_name}' for language '{lang}' finished.")
-
-
-            for lang in part_images.keys():
-                for overlay_name in part_images[lang].keys():
+                part_coords.append((map_coord.continent_to_full_image_coord(part[0], False), map_coord))
+
+            output_jobs = []
+            input_hashes = {}
+            for lang in args.lang:
+                for overlay_name in args.overlay:
+                    if overlay_name not in map_overlays:
+                        raise ValueError(f"Invalid overlay name specified ({overlay_name}). Allowed values are: {list(map_overlays.keys())}")
+                    overridden_zone_data = override_zone_data(zone_data[lang], map_overlays[overlay_name]) if args.overrides else zone_data[lang]
                     zoom_text = str(zoom).replace('.', '-')
-                    output_path = f'{args.output}/{layout_name}_{overlay_name}_z{zoom_text}_{lang}.{args.format}'
-
-                    if len(part_images[lang][overlay_name]) == 1:
-                        full_image = part_images[lang][overlay_name][0][1]
+                    if args.pyramid_min_zoom is not None:
+                        output_path = f'{args.output}/{layout_name}_{overlay_name}_{lang}'
                     else:
-                        full_image = combine_part_images(part_images[lang][overlay_name], map_coord, scale_factor)
-
-                    if args.legend:
-                        map_overlays[overlay_name].draw_legend(full_image, map_layout, map_coord, scale_factor)
-
-                    full_image.save(output_path, quality=95 if args.format == 'jpg' else None)
-
-            print(f"\nMaps for layout '{layout_name}' at zoom {zoom} finished.")
+                        output_path = f'{args.output}/{layout_name}_{overlay_name}_z{zoom_text}_{lang}.{get_file_extension(args.format)}'
+
+                    if build_manifest:
+                        input_hashes[output_path] = get_output_input_hash(lang, overlay_name, overridden_zone_data, map_layout, part_coords, map_generator, args)
+                        rebuild_reason = build_manifest.get_rebuild_reason(output_path, input_hashes[output_path])
+                        if rebuild_reason is None:
+                            skipped_outputs += 1
+                            continue
+                        print(f"{'Would rebuild' if args.dry_run else 'Rebuilding'} {output_path} ({rebuild_reason}).")
+                    rebuilt_outputs += 1
+                    output_jobs.append((output_path, lang, overlay_name, overridden_zone_data))
+
+            # The base map images are only generated if any of their outputs need to be rebuilt
+            if output_jobs:
+                map_jobs.append((layout_name, map_layout, zoom, part_coords, output_jobs, input_hashes))
+
+    if args.dry_run:
+        map_jobs.clear()
+    map_generator.plan_map_images([(map_coord.sector.continent_id, 1, map_coord)
+                                   for _, _, _, part_coords, _, _ in map_jobs for _, map_coord in part_coords])
+
+    for layout_name, map_layout, zoom, part_coords, output_jobs, input_hashes in map_jobs:
+        print(f"Generating maps for layout '{layout_name}' at zoom {zoom}...")
+        parts: list[tuple[tuple[int, int], MapCoordinateSystem, Image.Image | MapCanvas]] = []
+        for sector_index, (part_top_left, map_coord) in enumerate(part_coords, start=1):
+            part_image = map_generator.generate_map_image(map_coord.sector.continent_id, 1, map_coord, sector_index, len(part_coords))
+            parts.append((part_top_left, map_coord, part_image))
+
+        if args.jobs > 1 and len(output_jobs) > 1:
+            # Render the overlays in worker processes, sharing the base map images with them instead of pickling a copy for each job.
+            # Map canvases are shared through their files already.
+            shared_parts = [(part_top_left, map_coord, SharedImage(part_image) if isinstance(part_image, Image.Image) else part_image)
+                            for part_top_left, map_coord, part_image in parts]
+            try:
+                with ProcessPoolExecutor(max_workers=min(args.jobs, len(output_jobs)), initializer=init_render_worker, initargs=(args,)) as executor:
+                    futures = [executor.submit(render_map_output_in_worker, *output_job, map_layout, shared_parts, args) for output_job in output_jobs]
+                    for output_job, future in zip(output_jobs, futures):
+                        label_layout_cache.add_layouts(future.result())
+                        if build_manifest:
+                            build_manifest.record(output_job[0], input_hashes[output_job[0]])
+            finally:
+                for _, _, shared_image in shared_parts:
+                    if isinstance(shared_image, SharedImage):
+                        shared_image.close()
+        else:
+            for output_job in output_jobs:
+                render_map_output(*output_job, map_layout, parts, args)
+                if build_manifest:
+                    build_manifest.record(output_job[0], input_hashes[output_job[0]])
+
+        for _, _, part_image in parts:
+            if isinstance(part_image, MapCanvas):
+                part_image.close()
+
+        print(f"\nMaps for layout '{layout_name}' at zoom {zoom} finished.")
+
+    if build_manifest:
+        print(f"{rebuilt_outputs} maps {'would be rebuilt' if args.dry_run else 'rebuilt'}, {skipped_outputs} maps unchanged since the last build.")
+    label_layout_cache.save()
+
+
+def get_output_input_hash(lang: str, overlay_name: str, zone_data: list[dict], map_layout: MapLayout,
+                          part_coords: list[tuple[tuple[int, int], MapCoordinateSystem]], map_generator: MapGenerator, args) -> str:
+    """Returns a hash of everything an output map is rendered from, to be compared with the build manifest."""
+    return get_input_hash({
+        'tool': get_tool_version(),
+        'fonts': get_font_version(),
+        'lang': lang,
+        'overlay': overlay_name,
+        'zone_data': zone_data,
+        'portals': portals,
+        'layout': asdict(map_layout),
+        'base_images': [map_generator.get_base_image_key(map_coord.sector.continent_id, 1, map_coord) for _, map_coord in part_coords],
+        'scale': args.scale,
+        'legend': args.legend,
+        'debug': args.debug,
+        'format': args.format,
+        'pyramid_min_zoom': args.pyramid_min_zoom,
+    })
+
+
+def init_render_worker(args):
+    if args.label_cache:
+        label_layout_cache.load(args.label_cache)
+
+
+def render_map_output_in_worker(*render_args) -> dict:
+    """Renders the map output in a worker process, returning the label layouts created by it so that the main process can save them."""
+    render_map_output(*render_args)
+    return label_layout_cache.pop_new_layouts()
+
+
+def render_map_output(output_path: str, lang: str, overlay_name: str, zone_data: list[dict], map_layout: MapLayout,
+                      parts: list[tuple[tuple[int, int], MapCoordinateSystem, Image.Image | SharedImage | MapCanvas]], args):
+    """
+    Draws the overlay over copies of the layout's base map images, combines them into the final map with its legend and saves it.
+    Map canvases are drawn over in tiles and combined in strips, so that none of the map images need to be held in memory in full.
+    """
+    print(f"Drawing map overlay '{overlay_name}' for language '{lang}'...")
+    map_overlay = map_overlays[overlay_name]
+    scale_factor = args.scale
+
+    part_images = []
+    map_coord = None
+    for part_top_left, map_coord, part_image in parts:
+        part_image_copy = part_image.copy()
+        if args.overlay_tile_size or isinstance(part_image_copy, MapCanvas):
+            tile_size = args.overlay_tile_size or MapCanvas.overlay_tile_size
+            map_overlay.draw_overlay_in_tiles(part_image_copy, zone_data, map_layout, map_coord, scale_factor, args.debug, tile_size)
+        else:
+            map_overlay.draw_overlay(part_image_copy, zone_data, map_layout, map_coord, scale_factor, debug=args.debug)
+        part_images.append((part_top_left, part_image_copy))
+
+    if len(part_images) == 1:
+        full_image = part_images[0][1]
+    elif isinstance(part_images[0][1], MapCanvas):
+        full_image = combine_part_canvases(part_images, map_coord, scale_factor, args.canvas_dir)
+        for _, part_canvas in part_images:
+            part_canvas.close()
+    else:
+        full_image = combine_part_images(part_images, map_coord, scale_factor)
+
+    if args.legend:
+        if isinstance(full_image, MapCanvas):
+            map_overlay.draw_legend_on_canvas(full_image, map_layout, map_coord, scale_factor)
+        else:
+            map_overlay.draw_legend(full_image, map_layout, map_coord, scale_factor)
+
+    if args.pyramid_min_zoom is not None:
+        tile_pyramid_writer = TilePyramidWriter(output_path, get_file_extension(args.format), args.pyramid_min_zoom, args.canvas_dir)
+        tile_pyramid_writer.write(full_image, parts[0][1], parts[0][0])
+    elif args.format in strip_encoders:
+        save_in_strips(full_image, output_path, args.format)
+    else:
+        full_image.save(output_path, quality=95 if args.format == 'jpg' else None)
+    if isinstance(full_image, MapCanvas):
+        full_image.close()
+    print(f"Map overlay '{overlay_name}' for language '{lang}' finished.")
 
 
 def choose_map_layouts(args) -> list[tuple[str, MapLayout]]:
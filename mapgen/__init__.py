@@ -1,5 +1,16 @@
+import mapgen.build_manifest
 import mapgen.data_api
+import mapgen.map_canvas
 import mapgen.map_composite
 import mapgen.map_coordinates
+import mapgen.map_encoder
 import mapgen.map_generator
+import mapgen.memory_usage
 import mapgen.overlay
+import mapgen.raster_cache
+import mapgen.shared_image
+import mapgen.spatial_index
+import mapgen.tile_archive
+import mapgen.tile_cache
+import mapgen.tile_pyramid
+import mapgen.tile_store
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+from functools import cache
+from pathlib import Path
+
+# Root directory of the tool, containing its sources and assets
+tool_directory = Path(__file__).resolve().parent.parent
+
+
+class BuildManifest:
+    """
+    Manifest of the output maps written by previous builds, with a hash of all the inputs each of them was rendered from,
+    so that following builds skip the outputs whose inputs haven't changed, without generating their base map images.
+    Persisted to a JSON file, which is updated after each written output, so that an interrupted build keeps the finished outputs.
+    """
+
+    # Increment when the manifest structure changes, to rebuild all the outputs
+    manifest_version = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self._input_hashes: dict[str, str] = {}
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != self.manifest_version:
+            print(f"Build manifest {path} is outdated, all maps will be rebuilt.")
+            return
+        self._input_hashes = data['outputs']
+
+    def get_rebuild_reason(self, output_path: str, input_hash: str) -> str | None:
+        """Returns why the output needs to be rebuilt, or None if it's up to date."""
+        previous_hash = self._input_hashes.get(output_path)
+        if previous_hash is None:
+            return "not built yet"
+        if previous_hash != input_hash:
+            return "inputs changed"
+        if not os.path.exists(output_path):
+            return "output missing"
+        return None
+
+    def record(self, output_path: str, input_hash: str):
+        """Records the inputs of a written output and saves the manifest."""
+        self._input_hashes[output_path] = input_hash
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.manifest_version, 'outputs': self._input_hashes}, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+def get_input_hash(inputs: dict) -> str:
+    """Returns a hash of the JSON serializable inputs of an output."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+@cache
+def get_tool_version() -> str:
+    """
+    Returns a hash of the tool's version and source code, which changes the outputs of any inputs. The data modules aren't included,
+    as their data is hashed by content as a part of each output's inputs, so that a data change only rebuilds the outputs using it.
+    """
+    source_paths = [tool_directory / 'pyproject.toml', tool_directory / 'gw2_zone_map.py', *(tool_directory / 'mapgen').rglob('*.py')]
+    return _get_files_hash(source_paths)
+
+
+@cache
+def get_font_version() -> str:
+    """Returns a hash of the font files the labels and legends are drawn with."""
+    return _get_files_hash(list((tool_directory / 'assets' / 'fonts').rglob('*.[ot]tf')))
+
+
+def _get_files_hash(paths: list[Path]) -> str:
+    files_hash = hashlib.sha256()
+    for path in sorted(paths):
+        files_hash.update(path.relative_to(tool_directory).as_posix().encode('utf-8') + b'\0')
+        files_hash.update(hashlib.sha256(path.read_bytes()).digest())
+    return files_hash.hexdigest()
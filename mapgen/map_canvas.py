@@ -0,0 +1,137 @@
+import mmap
+import os
+import shutil
+import tempfile
+from typing import Iterator
+
+import numpy as np
+from PIL import Image
+
+
+class MapCanvas:
+    """
+    RGB map image stored in a memory-mapped raw file instead of in memory, so that maps larger than the available memory can be rendered.
+    The canvas is only accessed one region at a time: images are pasted into it, regions are cropped out of it, and it's encoded directly
+    from the mapping, with the pages of each region released once it's done, so that only the regions being worked on are held in memory.
+    The pixels are stored as RGBX, which PIL can read in place, without first decoding a copy of the whole image.
+    Like SharedImage, only a handle (the file path and size) is pickled when passing the canvas to another process.
+    """
+
+    # Number of pixels in each horizontal strip the canvas is processed in, the strip height depends on the canvas width
+    strip_pixels = 2 ** 24
+    # Default size of the square tiles in which the map overlays are drawn over a canvas
+    overlay_tile_size = 2048
+    # Formats which PIL can encode from RGBX pixels, so that they can be saved in place instead of from an RGB copy of the whole canvas
+    in_place_save_formats = {'JPEG'}
+
+    def __init__(self, size: tuple[int, int], directory: str | None = None):
+        """
+        :param size: Size of the canvas in pixels, initially black.
+        :param directory: Directory to create the canvas file in. If None, the system's temporary directory is used.
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.mode = 'RGB'
+        self.size = size
+        file_descriptor, self.path = tempfile.mkstemp(prefix='gw2-canvas-', suffix='.raw', dir=directory)
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.truncate(size[0] * size[1] * 4)
+        self._owner = True
+        self._open()
+
+    def __getstate__(self):
+        return {'path': self.path, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.mode = 'RGB'
+        self.size = state['size']
+        self.path = state['path']
+        # The creating process is responsible for deleting the canvas file
+        self._owner = False
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'r+b') as f:
+            self._mmap = mmap.mmap(f.fileno(), self.size[0] * self.size[1] * 4)
+        self._pixels = np.ndarray((self.size[1], self.size[0], 4), dtype=np.uint8, buffer=self._mmap)
+
+    def get_view(self) -> Image.Image:
+        """Returns a read-only RGBX image using the canvas file's mapping in place, for cropping and encoding it without a copy."""
+        return Image.frombuffer('RGBX', self.size, self._mmap, 'raw', 'RGBX', 0, 1)
+
+    def get_strip_rows(self) -> Iterator[tuple[int, int]]:
+        """Yields the (top, bottom) rows of the horizontal strips to process the canvas in."""
+        strip_height = max(1, self.strip_pixels // self.size[0])
+        for top in range(0, self.size[1], strip_height):
+            yield top, min(self.size[1], top + strip_height)
+
+    def strips(self) -> Iterator[tuple[int, Image.Image]]:
+        """Yields the canvas as a sequence of horizontal RGB strips, with the top row of each."""
+        for top, bottom in self.get_strip_rows():
+            yield top, self.crop((0, top, self.size[0], bottom))
+
+    def crop(self, box: tuple[int, int, int, int]) -> Image.Image:
+        """Returns an RGB copy of the given region of the canvas, with the same semantics as Image.crop."""
+        region_image = self.get_view().crop(box).convert('RGB')
+        self._release_rows(box[1], box[3])
+        return region_image
+
+    def paste(self, image: Image.Image, box: tuple[int, int] = (0, 0), mask: Image.Image | None = None):
+        """Pastes the image into the canvas at the given position, clipped to the canvas, with the same semantics as Image.paste."""
+        left, top = max(0, box[0]), max(0, box[1])
+        right, bottom = min(self.size[0], box[0] + image.size[0]), min(self.size[1], box[1] + image.size[1])
+        if left >= right or top >= bottom:
+            return
+
+        if mask is None and image.mode == 'RGB':
+            image_array = np.asarray(image)
+            self._pixels[top:bottom, left:right, :3] = image_array[top - box[1]:bottom - box[1], left - box[0]:right - box[0]]
+        else:
+            region_image = self.get_view().crop((left, top, right, bottom)).convert('RGB')
+            region_image.paste(image, (box[0] - left, box[1] - top), mask)
+            self._pixels[top:bottom, left:right, :3] = np.asarray(region_image)
+        self._release_rows(top, bottom)
+
+    def copy(self) -> 'MapCanvas':
+        """Returns a private, writable copy of the canvas, in a new file next to the canvas file."""
+        canvas_copy = MapCanvas.__new__(MapCanvas)
+        canvas_copy.mode = self.mode
+        canvas_copy.size = self.size
+        file_descriptor, canvas_copy.path = tempfile.mkstemp(prefix='gw2-canvas-', suffix='.raw', dir=os.path.dirname(self.path))
+        os.close(file_descriptor)
+        shutil.copyfile(self.path, canvas_copy.path)
+        canvas_copy._owner = True
+        canvas_copy._open()
+        return canvas_copy
+
+    def save(self, fp, format: str | None = None, **params):
+        """
+        Saves the canvas like Image.save. Formats which can be encoded from RGBX pixels are encoded directly from the canvas file's mapping,
+        which the operating system can page out as needed. Other formats still need an RGB copy of the whole canvas in memory.
+        """
+        view = self.get_view()
+        if format is None and isinstance(fp, (str, os.PathLike)):
+            format = Image.registered_extensions().get(os.path.splitext(fp)[1].lower())
+        if format and format.upper() in self.in_place_save_formats:
+            view.save(fp, format, **params)
+        else:
+            view.convert('RGB').save(fp, format, **params)
+        del view
+        self._release_rows(0, self.size[1])
+
+    def close(self):
+        """Releases the canvas in this process, and deletes its file if called by the process which created it."""
+        del self._pixels
+        self._mmap.close()
+        if self._owner:
+            os.remove(self.path)
+
+    def _release_rows(self, top: int, bottom: int):
+        """Releases the memory pages of the given rows, which are kept in the canvas file, so that they don't add up in the process's memory."""
+        if not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        row_size = self.size[0] * 4
+        start = max(0, top) * row_size // mmap.PAGESIZE * mmap.PAGESIZE
+        end = min(self.size[1], bottom) * row_size
+        if start < end:
+            self._mmap.madvise(mmap.MADV_DONTNEED, start, end - start)
@@ -1,24 +1,57 @@
 from PIL import Image, ImageDraw
 
+from mapgen.map_canvas import MapCanvas
 from mapgen.map_coordinates import MapCoordinateSystem, zoom_factor
 
 
 def combine_part_images(parts: list[tuple[tuple[int, int], Image.Image]], map_coord: MapCoordinateSystem, scale_factor: float) -> Image.Image:
-    total_size = (max(pi[0][0] + pi[1].size[0] for pi in parts),
-                  max(pi[0][1] + pi[1].size[1] for pi in parts))
+    total_size = get_total_size(parts)
 
     full_image = Image.new('RGB', total_size)
     full_image_draw = ImageDraw.Draw(full_image, 'RGBA')
-    outline_width = min(32, max(1, round(0.75 * scale_factor * (zoom_factor ** map_coord.zoom))))
+    outline_width = get_part_outline_width(map_coord, scale_factor)
 
     for part in parts:
         part_top_left = part[0]
         part_image = part[1]
-        part_rect = (part_top_left[0] - outline_width,
-                     part_top_left[1] - outline_width,
-                     part_top_left[0] + part_image.size[0] + outline_width - 1,
-                     part_top_left[1] + part_image.size[1] + outline_width - 1)
-        full_image_draw.rectangle(part_rect, width=outline_width, outline=(255, 255, 255, 95))
+        full_image_draw.rectangle(get_part_outline_rect(part_top_left, part_image.size, outline_width), width=outline_width, outline=(255, 255, 255, 95))
         full_image.paste(part_image, part_top_left)
 
     return full_image
+
+
+def combine_part_canvases(parts: list[tuple[tuple[int, int], MapCanvas]], map_coord: MapCoordinateSystem, scale_factor: float,
+                          canvas_directory: str | None) -> MapCanvas:
+    """Combines the parts like combine_part_images, into a map canvas one horizontal strip at a time, with the same result."""
+    full_canvas = MapCanvas(get_total_size(parts), canvas_directory)
+    outline_width = get_part_outline_width(map_coord, scale_factor)
+
+    for strip_top, strip_bottom in full_canvas.get_strip_rows():
+        strip_image = Image.new('RGB', (full_canvas.size[0], strip_bottom - strip_top))
+        strip_draw = ImageDraw.Draw(strip_image, 'RGBA')
+        for part_top_left, part_canvas in parts:
+            outline_rect = get_part_outline_rect((part_top_left[0], part_top_left[1] - strip_top), part_canvas.size, outline_width)
+            strip_draw.rectangle(outline_rect, width=outline_width, outline=(255, 255, 255, 95))
+            part_top = max(strip_top, part_top_left[1]) - part_top_left[1]
+            part_bottom = min(strip_bottom, part_top_left[1] + part_canvas.size[1]) - part_top_left[1]
+            if part_top < part_bottom:
+                strip_image.paste(part_canvas.crop((0, part_top, part_canvas.size[0], part_bottom)), (part_top_left[0], part_top_left[1] + part_top - strip_top))
+        full_canvas.paste(strip_image, (0, strip_top))
+
+    return full_canvas
+
+
+def get_total_size(parts: list[tuple[tuple[int, int], Image.Image | MapCanvas]]) -> tuple[int, int]:
+    return (max(pi[0][0] + pi[1].size[0] for pi in parts),
+            max(pi[0][1] + pi[1].size[1] for pi in parts))
+
+
+def get_part_outline_width(map_coord: MapCoordinateSystem, scale_factor: float) -> int:
+    return min(32, max(1, round(0.75 * scale_factor * (zoom_factor ** map_coord.zoom))))
+
+
+def get_part_outline_rect(part_top_left: tuple[int, int], part_size: tuple[int, int], outline_width: int) -> tuple[int, int, int, int]:
+    return (part_top_left[0] - outline_width,
+            part_top_left[1] - outline_width,
+            part_top_left[0] + part_size[0] + outline_width - 1,
+            part_top_left[1] + part_size[1] + outline_width - 1)
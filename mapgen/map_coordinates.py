@@ -8,7 +8,7 @@ zoom_factor = 2
 LegendAlignment = Literal['lt', 'lb', 'rt', 'rb']
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class MapParameters:
     continent_id: int
     dimensions: tuple[int, int]
@@ -17,7 +17,7 @@ class MapParameters:
     max_zoom_tile_dimensions: int = tile_image_size
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class MapSector:
     continent_id: int
     continent_rect: tuple[tuple[int, int], tuple[int, int]] | None
@@ -57,8 +57,26 @@ class MapLayout:
         )
 
 
+@dataclass(frozen=True, slots=True)
 class MapCoordinateSystem:
-    def __init__(self, map_params: MapParameters, zoom: float, sector: MapSector = None):
+    """
+    Coordinate system of a map image of a sector at the given zoom. Immutable and compared by value,
+    so that equal coordinate systems created separately (e.g. per layout part or by with_int_zoom) can share cached values.
+    """
+    map_params: MapParameters
+    zoom: float
+    sector: MapSector | None = None
+
+    # Derived fields, precomputed from the ones above
+    tile_dimensions: float = field(init=False, repr=False, compare=False)
+    continent_to_tile_multiplier: float = field(init=False, repr=False, compare=False)
+    continent_to_image_multiplier: float = field(init=False, repr=False, compare=False)
+    sector_dimensions: tuple[int, int] = field(init=False, repr=False, compare=False)
+    sector_top_left: tuple[int, int] = field(init=False, repr=False, compare=False)
+    sector_bottom_right: tuple[int, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        map_params, zoom, sector = self.map_params, self.zoom, self.sector
         if zoom < map_params.min_zoom or zoom > map_params.max_zoom:
             raise ValueError(f"Zoom must be in the interval [{map_params.min_zoom}, {map_params.max_zoom}]")
 
@@ -69,16 +87,13 @@ class MapCoordinateSystem:
         elif sector_rect[0][0] >= sector_rect[1][0] or sector_rect[0][1] >= sector_rect[1][1]:
             raise ValueError(f"Sector {sector} must be defined as (top, left, bottom, right).")
 
-        self.map_params = map_params
-        self.zoom = zoom
-        self.sector = sector
-
-        self.tile_dimensions = (zoom_factor ** (map_params.max_zoom - zoom)) * map_params.max_zoom_tile_dimensions
-        self.continent_to_tile_multiplier = 1 / self.tile_dimensions
-        self.continent_to_image_multiplier = tile_image_size * self.continent_to_tile_multiplier
-        self.sector_dimensions = (sector_rect[1][0] - sector_rect[0][0] + 1, sector_rect[1][1] - sector_rect[0][1] + 1)
-        self.sector_top_left = sector_rect[0][0], sector_rect[0][1]
-        self.sector_bottom_right = sector_rect[1][0], sector_rect[1][1]
+        tile_dimensions = (zoom_factor ** (map_params.max_zoom - zoom)) * map_params.max_zoom_tile_dimensions
+        object.__setattr__(self, 'tile_dimensions', tile_dimensions)
+        object.__setattr__(self, 'continent_to_tile_multiplier', 1 / tile_dimensions)
+        object.__setattr__(self, 'continent_to_image_multiplier', tile_image_size * self.continent_to_tile_multiplier)
+        object.__setattr__(self, 'sector_dimensions', (sector_rect[1][0] - sector_rect[0][0] + 1, sector_rect[1][1] - sector_rect[0][1] + 1))
+        object.__setattr__(self, 'sector_top_left', (sector_rect[0][0], sector_rect[0][1]))
+        object.__setattr__(self, 'sector_bottom_right', (sector_rect[1][0], sector_rect[1][1]))
 
     def with_int_zoom(self):
         return MapCoordinateSystem(self.map_params, math.ceil(self.zoom), self.sector)
@@ -0,0 +1,233 @@
+import os
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from io import BytesIO
+from typing import BinaryIO
+
+import numpy as np
+from PIL import Image
+
+from mapgen.map_canvas import MapCanvas
+
+
+class StripEncoder(ABC):
+    """
+    Encodes an RGB image written to it as a sequence of horizontal strips from the top, so that the whole image never needs to be in memory.
+    The strips are encoded in parallel by a thread pool as they are written, and the encoded strips are written to the file in order.
+    All strips but the last must have the same height, which is a multiple of strip_height_multiple.
+    """
+
+    file_extension: str
+    # Number of pixels in each strip, the strip height depends on the image width
+    strip_pixels = 2 ** 22
+    strip_height_multiple = 1
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int]):
+        self.fp = fp
+        self.size = size
+        self._rows_written = 0
+        self._strip_count = 0
+        self._strip_height = None
+        self._previous_strip_image = None
+        self._max_pending_strips = os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._max_pending_strips)
+        self._pending_strips: deque[Future] = deque()
+
+    @classmethod
+    def get_strip_height(cls, size: tuple[int, int]) -> int:
+        strip_height = max(1, cls.strip_pixels // size[0])
+        return max(cls.strip_height_multiple, strip_height // cls.strip_height_multiple * cls.strip_height_multiple)
+
+    def write(self, strip_image: Image.Image):
+        if strip_image.size[0] != self.size[0] or self._rows_written + strip_image.size[1] > self.size[1]:
+            raise ValueError(f"Strip of size {strip_image.size} doesn't fit the image of size {self.size} below row {self._rows_written}.")
+        is_last = self._rows_written + strip_image.size[1] == self.size[1]
+        if self._strip_height is None:
+            self._strip_height = strip_image.size[1]
+        if (self._rows_written % self._strip_height or strip_image.size[1] > self._strip_height or
+                (not is_last and self._strip_height % self.strip_height_multiple)):
+            raise ValueError(f"Strip of {strip_image.size[1]} rows below row {self._rows_written} doesn't match the strip height {self._strip_height}.")
+
+        if strip_image.mode != 'RGB':
+            strip_image = strip_image.convert('RGB')
+        strip_index = self._strip_count
+        self._rows_written += strip_image.size[1]
+        self._strip_count += 1
+        self._pending_strips.append(self._executor.submit(self.encode_strip, strip_image, self._previous_strip_image, strip_index, is_last))
+        self._previous_strip_image = strip_image
+
+        # Write the encoded strips as soon as they're done, keeping only a limited number of them in memory
+        while len(self._pending_strips) >= self._max_pending_strips or (self._pending_strips and self._pending_strips[0].done()):
+            self.write_encoded_strip(self._pending_strips.popleft().result())
+
+    def close(self):
+        """Writes the remaining strips and the end of the file. All rows of the image must have been written."""
+        while self._pending_strips:
+            self.write_encoded_strip(self._pending_strips.popleft().result())
+        self._executor.shutdown()
+        if self._rows_written != self.size[1]:
+            raise ValueError(f"Only {self._rows_written} of the {self.size[1]} rows of the image have been written.")
+        self.finish()
+
+    @abstractmethod
+    def encode_strip(self, strip_image: Image.Image, previous_strip_image: Image.Image | None, strip_index: int, is_last: bool):
+        """
+        Encodes the strip, called in a worker thread, with the strip above it for encoders predicting the pixels from the rows above.
+        The result is passed to write_encoded_strip, in the order of the strips.
+        """
+        pass
+
+    @abstractmethod
+    def write_encoded_strip(self, encoded_strip):
+        pass
+
+    @abstractmethod
+    def finish(self):
+        pass
+
+
+class JpegStripEncoder(StripEncoder):
+    """
+    Encodes a baseline JPEG with a restart marker after each strip. Each strip is encoded by PIL as a separate JPEG with the same
+    quantization and Huffman tables, and their entropy coded data are joined, which restart markers allow as they reset the coding state.
+    The strips are aligned to the 16 pixel MCUs of 4:2:0 chroma subsampling, so the pixels are the same as encoding the whole image at once.
+    """
+
+    file_extension = 'jpg'
+    strip_height_multiple = 16
+    # Largest number of MCUs between restart markers
+    max_restart_interval = 2 ** 16 - 1
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int], quality: int = 95):
+        super().__init__(fp, size)
+        self.quality = quality
+
+    @classmethod
+    def get_strip_height(cls, size: tuple[int, int]) -> int:
+        max_strip_height = cls.max_restart_interval // -(-size[0] // cls.strip_height_multiple) * cls.strip_height_multiple
+        return min(super().get_strip_height(size), max(cls.strip_height_multiple, max_strip_height))
+
+    def encode_strip(self, strip_image: Image.Image, previous_strip_image: Image.Image | None, strip_index: int, is_last: bool) -> tuple[int, bytes]:
+        strip_buffer = BytesIO()
+        strip_image.save(strip_buffer, 'JPEG', quality=self.quality, subsampling='4:2:0')
+        return strip_index, strip_buffer.getvalue()
+
+    def write_encoded_strip(self, encoded_strip: tuple[int, bytes]):
+        strip_index, strip_data = encoded_strip
+        headers, entropy_coded_data = self.split_jpeg(strip_data)
+        if strip_index == 0:
+            restart_interval = -(-self.size[0] // self.strip_height_multiple) * -(-self._strip_height // self.strip_height_multiple)
+            if restart_interval > self.max_restart_interval:
+                raise ValueError(f"Strips of {self._strip_height} rows exceed the maximum restart interval at image width {self.size[0]}.")
+            self.fp.write(b'\xff\xd8')
+            for marker, segment in headers[:-1]:
+                if marker == 0xc0:
+                    # Start of frame, with the height of the whole image instead of the strip's
+                    segment = segment[:1] + struct.pack('>HH', self.size[1], self.size[0]) + segment[5:]
+                self.write_segment(marker, segment)
+            self.write_segment(0xdd, struct.pack('>H', restart_interval))
+            self.write_segment(*headers[-1])
+        else:
+            self.fp.write(bytes((0xff, 0xd0 + (strip_index - 1) % 8)))
+        self.fp.write(entropy_coded_data)
+
+    def finish(self):
+        self.fp.write(b'\xff\xd9')
+
+    def write_segment(self, marker: int, segment: bytes):
+        self.fp.write(struct.pack('>BBH', 0xff, marker, len(segment) + 2) + segment)
+
+    @staticmethod
+    def split_jpeg(jpeg_data: bytes) -> tuple[list[tuple[int, bytes]], bytes]:
+        """Splits a baseline JPEG into its header segments, up to and including the start of scan, and the entropy coded data of its scan."""
+        headers = []
+        position = 2
+        while True:
+            marker = jpeg_data[position + 1]
+            segment_length = struct.unpack_from('>H', jpeg_data, position + 2)[0]
+            headers.append((marker, jpeg_data[position + 4:position + 2 + segment_length]))
+            position += 2 + segment_length
+            if marker == 0xda:
+                # The scan ends with the end of image marker, as there's only one scan and no restart markers
+                return headers, jpeg_data[position:-2]
+
+
+class PngStripEncoder(StripEncoder):
+    """
+    Encodes an RGB PNG with the Up filter, compressing the strips in parallel into a single zlib stream. Each strip is compressed separately,
+    ending with a sync flush, so that the compressed strips join into a valid stream, and their checksums are combined in order.
+    """
+
+    file_extension = 'png'
+    compression_level = 6
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int]):
+        super().__init__(fp, size)
+        self._adler32 = 1
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 2, 0, 0, 0))
+        # zlib stream header: deflate with a 32 KiB window and the default compression
+        self.write_chunk(b'IDAT', b'\x78\x9c')
+
+    def encode_strip(self, strip_image: Image.Image, previous_strip_image: Image.Image | None, strip_index: int, is_last: bool) -> tuple[int, int, bytes]:
+        # The first row of each strip is filtered against the last row of the previous strip, or against zeros for the first row of the image
+        pixels = np.asarray(strip_image)
+        if previous_strip_image is None:
+            previous_row = np.zeros_like(pixels[0])
+        else:
+            previous_row = np.asarray(previous_strip_image.crop((0, previous_strip_image.size[1] - 1) + previous_strip_image.size))[0]
+
+        filtered = np.empty((pixels.shape[0], 1 + pixels.shape[1] * 3), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter
+        filtered[0, 1:] = (pixels[0] - previous_row).reshape(-1)
+        filtered[1:, 1:] = (pixels[1:] - pixels[:-1]).reshape(pixels.shape[0] - 1, pixels.shape[1] * 3)
+        filtered_data = filtered.tobytes()
+
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        compressed_data = compressor.compress(filtered_data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+        return zlib.adler32(filtered_data), len(filtered_data), compressed_data
+
+    def write_encoded_strip(self, encoded_strip: tuple[int, int, bytes]):
+        strip_adler32, strip_length, compressed_data = encoded_strip
+        self._adler32 = self.combine_adler32(self._adler32, strip_adler32, strip_length)
+        self.write_chunk(b'IDAT', compressed_data)
+
+    def finish(self):
+        self.write_chunk(b'IDAT', struct.pack('>I', self._adler32))
+        self.write_chunk(b'IEND', b'')
+
+    def write_chunk(self, chunk_type: bytes, data: bytes):
+        self.fp.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+    @staticmethod
+    def combine_adler32(adler1: int, adler2: int, length2: int) -> int:
+        """Returns the Adler-32 checksum of two concatenated pieces of data from their checksums, like zlib's adler32_combine."""
+        base = 65521
+        sum1 = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+        sum2 = ((adler1 >> 16) + (adler2 >> 16) + length2 * ((adler1 & 0xffff) - 1)) % base
+        return sum1 | (sum2 << 16)
+
+
+# Output formats encoded in strips, in addition to the formats saved by PIL
+strip_encoders: dict[str, type[StripEncoder]] = {
+    'jpg-stream': JpegStripEncoder,
+    'png-stream': PngStripEncoder,
+}
+
+
+def get_file_extension(output_format: str) -> str:
+    return strip_encoders[output_format].file_extension if output_format in strip_encoders else output_format
+
+
+def save_in_strips(image: Image.Image | MapCanvas, output_path: str, output_format: str):
+    """Saves the image with the format's strip encoder, cropping it one strip at a time, so that a map canvas is never read into memory in full."""
+    encoder_type = strip_encoders[output_format]
+    strip_height = encoder_type.get_strip_height(image.size)
+    with open(output_path, 'wb') as f:
+        encoder = encoder_type(f, image.size)
+        for strip_top in range(0, image.size[1], strip_height):
+            encoder.write(image.crop((0, strip_top, image.size[0], min(image.size[1], strip_top + strip_height))))
+        encoder.close()
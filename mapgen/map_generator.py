@@ -1,27 +1,63 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
 import threading
 import time
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
 from io import BytesIO
+from itertools import islice
+from typing import Callable
 
 import requests
 from PIL import Image
 from PIL.Image import Resampling
-from requests import HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
 from data.map_images import tile_api_map_overlays
+from mapgen.map_canvas import MapCanvas
 from mapgen.map_coordinates import tile_image_size, MapCoordinateSystem
+from mapgen.memory_usage import get_peak_memory_usage_text
+from mapgen.raster_cache import BaseRasterCache
+from mapgen.tile_archive import TileArchive
+from mapgen.tile_cache import TileCache, TileKey
+from mapgen.tile_store import TileStore
 
 
 class MapTileSource(ABC):
     @abstractmethod
-    def get_tile_image(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
+    def get_tile_data(self, continent: int, floor: int, zoom: int, x: int, y: int) -> bytes | None:
+        """Returns the encoded tile image, or None for a tile which doesn't exist, outside of the map's art."""
         pass
 
+    def get_tile_image(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
+        return decode_tile_data(self.get_tile_data(continent, floor, zoom, x, y))
+
     @abstractmethod
     def get_max_parallel_workers(self) -> int:
         pass
 
+    async def get_tile_image_async(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
+        """Asynchronous variant of get_tile_image. By default, runs get_tile_image in the event loop's executor."""
+        return await asyncio.to_thread(self.get_tile_image, continent, floor, zoom, x, y)
+
+    def get_tile_host(self, x: int, y: int) -> int:
+        """Returns the index of the host serving the given tile, used to limit the number of concurrent requests per host."""
+        return 0
+
+    @abstractmethod
+    def get_source_key(self, continent: int, floor: int, zoom: int) -> str:
+        """
+        Returns a string identifying the tiles of the given zoom level and the image overlays provided by this source, used as a part of cache keys.
+        The string changes when the tiles do, as far as the source can tell.
+        """
+        pass
+
     def get_image_overlays(self, continent: int, floor: int) -> list[
         tuple[Image.Image, tuple[tuple[int, int], tuple[int, int]]]]:
         """
@@ -30,41 +66,162 @@ class MapTileSource(ABC):
         """
         return []
 
+    def finish_loading(self):
+        """Called after all tiles for a map image have been loaded."""
+        pass
+
+
+def decode_tile_image(fp) -> Image.Image:
+    """Opens and fully decodes a tile image, so that the decoding happens in the loading worker rather than lazily on first use."""
+    tile_image = Image.open(fp)
+    tile_image.load()
+    return tile_image
+
+
+def decode_tile_data(tile_data: bytes | None) -> Image.Image:
+    """Decodes an encoded tile image returned by get_tile_data, with tiles which don't exist being black."""
+    if tile_data is None:
+        return Image.new('RGB', (tile_image_size, tile_image_size), 'black')
+    return decode_tile_image(BytesIO(tile_data))
+
+
+def get_directory_digest(directory: str) -> str:
+    """Returns a hash of the relative paths, sizes and modification times of all files in the directory and its subdirectories."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            file_stat = os.stat(file_path)
+            digest.update(f'{os.path.relpath(file_path, directory)}:{file_stat.st_size}:{file_stat.st_mtime_ns}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
 
 class LocalMapTileSource(MapTileSource):
     """Map tile source looking for tile images on local file system."""
 
-    def __init__(self, input_directory: str):
+    def __init__(self, input_directory: str, max_parallel_workers: int | None = None):
         self.input_directory = input_directory
+        # Decoding the JPEG tiles dominates the loading time and PIL releases the GIL while decoding, so use a thread per core
+        self.max_parallel_workers = max_parallel_workers or os.cpu_count() or 1
+        self._source_keys: dict[tuple[int, int, int], str] = {}
+        self._source_keys_lock = threading.Lock()
+
+    def get_tile_data(self, continent: int, floor: int, zoom: int, x: int, y: int) -> bytes | None:
+        with open(f"{self.input_directory}/{continent}/{floor}/{zoom}/{x}/{y}.jpg", 'rb') as f:
+            return f.read()
+
+    def get_max_parallel_workers(self) -> int:
+        return self.max_parallel_workers
+
+    def get_source_key(self, continent: int, floor: int, zoom: int) -> str:
+        # Digest the size and modification time of every tile of the zoom level, once per run, so that replaced tiles change the key
+        with self._source_keys_lock:
+            if (continent, floor, zoom) not in self._source_keys:
+                zoom_directory = f"{self.input_directory}/{continent}/{floor}/{zoom}"
+                self._source_keys[continent, floor, zoom] = f'local:{os.path.abspath(zoom_directory)}:{get_directory_digest(zoom_directory)}'
+            return self._source_keys[continent, floor, zoom]
+
+
+class ArchiveMapTileSource(MapTileSource):
+    """Map tile source reading tile images from a memory-mapped tile archive, created from a local tile directory by pack_tile_directory."""
+
+    def __init__(self, archive_path: str, max_parallel_workers: int | None = None):
+        self.tile_archive = TileArchive(archive_path)
+        self.max_parallel_workers = max_parallel_workers or os.cpu_count() or 1
+
+    def get_tile_data(self, continent: int, floor: int, zoom: int, x: int, y: int) -> bytes | None:
+        return bytes(self.tile_archive.get_tile_bytes(self.get_tile_key(continent, floor, zoom, x, y)))
 
     def get_tile_image(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
-        return Image.open(f"{self.input_directory}/{continent}/{floor}/{zoom}/{x}/{y}.jpg")
+        # Decode directly from the archive's mapping, without copying the encoded tile
+        return decode_tile_image(self.tile_archive.open_tile(self.get_tile_key(continent, floor, zoom, x, y)))
+
+    def get_tile_key(self, continent: int, floor: int, zoom: int, x: int, y: int) -> TileKey:
+        tile_key = (continent, floor, zoom, x, y)
+        if tile_key not in self.tile_archive:
+            raise FileNotFoundError(f"Tile {tile_key} not found in tile archive {self.tile_archive.archive_path}.")
+        return tile_key
 
     def get_max_parallel_workers(self) -> int:
-        return 1
+        return self.max_parallel_workers
+
+    def get_source_key(self, continent: int, floor: int, zoom: int) -> str:
+        archive_stat = os.stat(self.tile_archive.archive_path)
+        return f'archive:{os.path.abspath(self.tile_archive.archive_path)}:{archive_stat.st_size}:{archive_stat.st_mtime_ns}'
 
 
 class TileApiMapTileSource(MapTileSource):
     """Map tile source looking for tile images in official API's tile service."""
 
+    default_tile_url = "https://tiles{dns}.guildwars2.com/{continent}/{floor}/{zoom}/{x}/{y}.jpg"
     dns_count = 4
+    request_timeout = 30
+    max_retries = 5
 
-    def __init__(self):
-        self.dns_index = 0
+    def __init__(self, tile_url: str = default_tile_url, tile_cache: TileCache | None = None, max_parallel_workers: int = 32, max_age: float = 24 * 3600):
+        """
+        :param max_age: Number of seconds for which the tiles are assumed unchanged, after which the source key changes,
+            expiring anything cached under it, such as base map images.
+        """
+        self.tile_url = tile_url
+        self.tile_cache = tile_cache
+        self.max_parallel_workers = max_parallel_workers
+        # Fixed for the whole run, so that all keys of a run agree even if it crosses the end of a period
+        self.source_key_period = int(time.time() // max_age) if max_age > 0 else None
+        # One keep-alive session per tile server, so that the connections are reused across tiles instead of a new handshake for each
+        self._sessions = [self.create_session() for _ in range(self.dns_count)]
         self._overlay_cache: dict[str, Image.Image] = {}
 
-    def get_tile_image(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
-        url = f"https://tiles{self.dns_index + 1}.guildwars2.com/{continent}/{floor}/{zoom}/{x}/{y}.jpg"
-        self.dns_index = (self.dns_index + 1) % self.dns_count
-        response = requests.get(url)
-        try:
-            response.raise_for_status()
-            return Image.open(BytesIO(response.content))
-        except HTTPError:
-            return Image.new('RGB', (256, 256), 'black')
+    def create_session(self) -> requests.Session:
+        retry = Retry(total=self.max_retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=['GET'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_parallel_workers, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_tile_host(self, x: int, y: int) -> int:
+        # Spread the tiles across the tile servers based on their position, which needs no shared state between worker threads
+        return (x + y) % self.dns_count
+
+    def get_tile_data(self, continent: int, floor: int, zoom: int, x: int, y: int) -> bytes | None:
+        tile_key = (continent, floor, zoom, x, y)
+        cached = self.tile_cache.get(tile_key) if self.tile_cache else None
+        if cached and self.tile_cache.is_fresh(cached[1]):
+            return None if cached[1].missing else cached[0]
+
+        # Revalidate stale cached tiles with a conditional request, so that unchanged tiles don't need to be downloaded again
+        headers = {}
+        if cached:
+            if cached[1].etag:
+                headers['If-None-Match'] = cached[1].etag
+            if cached[1].last_modified:
+                headers['If-Modified-Since'] = cached[1].last_modified
+
+        dns_index = self.get_tile_host(x, y)
+        url = self.tile_url.format(dns=dns_index + 1, continent=continent, floor=floor, zoom=zoom, x=x, y=y)
+        response = self._sessions[dns_index].get(url, headers=headers, timeout=self.request_timeout)
+        if cached and not cached[1].missing and response.status_code == 304:
+            self.tile_cache.refresh(tile_key)
+            return cached[0]
+
+        # Tiles outside of the map's art don't exist, other errors are only raised once the retries are exhausted
+        if response.status_code == 404:
+            if self.tile_cache:
+                self.tile_cache.put_missing(tile_key)
+            return None
+        response.raise_for_status()
+
+        if self.tile_cache:
+            self.tile_cache.put(tile_key, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.content
 
     def get_max_parallel_workers(self) -> int:
-        return 32
+        return self.max_parallel_workers
+
+    def get_source_key(self, continent: int, floor: int, zoom: int) -> str:
+        return f'api:{self.tile_url}:{self.source_key_period}:{json.dumps(tile_api_map_overlays, sort_keys=True)}'
 
     def get_image_overlays(self, continent: int, floor: int) -> list[
         tuple[Image.Image, tuple[tuple[int, int], tuple[int, int]]]]:
@@ -89,43 +246,191 @@ class TileApiMapTileSource(MapTileSource):
 
         return overlays
 
+    def finish_loading(self):
+        if self.tile_cache:
+            self.tile_cache.save_index()
+            print(self.tile_cache.get_stats_text())
+
+
+class StoredMapTileSource(MapTileSource):
+    """Map tile source keeping the tiles loaded from another tile source in a tile store, so that each tile is only loaded once per run."""
+
+    def __init__(self, tile_source: MapTileSource, tile_store: TileStore):
+        self.tile_source = tile_source
+        self.tile_store = tile_store
+
+    def get_tile_data(self, continent: int, floor: int, zoom: int, x: int, y: int) -> bytes | None:
+        return self.tile_source.get_tile_data(continent, floor, zoom, x, y)
+
+    def get_tile_image(self, continent: int, floor: int, zoom: int, x: int, y: int) -> Image.Image:
+        return self.tile_store.get_or_load((continent, floor, zoom, x, y), lambda: self.tile_source.get_tile_data(continent, floor, zoom, x, y), decode_tile_data)
+
+    def get_max_parallel_workers(self) -> int:
+        return self.tile_source.get_max_parallel_workers()
+
+    def get_tile_host(self, x: int, y: int) -> int:
+        return self.tile_source.get_tile_host(x, y)
+
+    def get_source_key(self, continent: int, floor: int, zoom: int) -> str:
+        return self.tile_source.get_source_key(continent, floor, zoom)
+
+    def get_image_overlays(self, continent: int, floor: int) -> list[
+        tuple[Image.Image, tuple[tuple[int, int], tuple[int, int]]]]:
+        return self.tile_source.get_image_overlays(continent, floor)
+
+    def finish_loading(self):
+        self.tile_source.finish_loading()
+        print(self.tile_store.get_stats_text())
+
+
+TileLoadedCallback = Callable[[int, int, Image.Image], None]
+
+
+class MapTileFetcher(ABC):
+    """Strategy for loading a set of tiles from a tile source concurrently."""
+
+    def __init__(self, tile_source: MapTileSource):
+        self.tile_source = tile_source
+
+    @abstractmethod
+    def fetch_tiles(self, continent: int, floor: int, zoom: int, tile_coords: list[tuple[int, int]], on_tile_loaded: TileLoadedCallback):
+        """Loads all the given tiles, calling on_tile_loaded(x, y, tile_image) from a single thread as each of them is loaded."""
+        pass
+
+
+class ThreadedMapTileFetcher(MapTileFetcher):
+    """Loads the tiles using a thread pool with one task per tile, keeping only a limited window of tasks submitted at a time."""
+
+    tasks_per_worker = 2
+
+    def fetch_tiles(self, continent: int, floor: int, zoom: int, tile_coords: list[tuple[int, int]], on_tile_loaded: TileLoadedCallback):
+        def fetch_tile(x, y) -> tuple[int, int, Image.Image]:
+            return x, y, self.tile_source.get_tile_image(continent, floor, zoom, x, y)
+
+        max_workers = self.tile_source.get_max_parallel_workers()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Don't keep references to finished futures, so that each tile image can be released right after it's handled
+            tile_coords_iter = iter(tile_coords)
+            pending = {executor.submit(fetch_tile, x, y) for x, y in islice(tile_coords_iter, self.tasks_per_worker * max_workers)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_tile_loaded(*future.result())
+                    next_tile_coord = next(tile_coords_iter, None)
+                    if next_tile_coord is not None:
+                        pending.add(executor.submit(fetch_tile, *next_tile_coord))
+
+
+class AsyncioMapTileFetcher(MapTileFetcher):
+    """
+    Loads the tiles using an asyncio event loop, with a fixed number of workers per tile host pulling from that host's queue of tiles.
+    This limits both the number of concurrent requests per host and the number of tiles in flight, regardless of the total tile count.
+    """
+
+    def __init__(self, tile_source: MapTileSource, concurrency_per_host: int):
+        super().__init__(tile_source)
+        self.concurrency_per_host = concurrency_per_host
+
+    def fetch_tiles(self, continent: int, floor: int, zoom: int, tile_coords: list[tuple[int, int]], on_tile_loaded: TileLoadedCallback):
+        asyncio.run(self._fetch_tiles(continent, floor, zoom, tile_coords, on_tile_loaded))
+
+    async def _fetch_tiles(self, continent: int, floor: int, zoom: int, tile_coords: list[tuple[int, int]], on_tile_loaded: TileLoadedCallback):
+        host_queues: dict[int, deque[tuple[int, int]]] = defaultdict(deque)
+        for x, y in tile_coords:
+            host_queues[self.tile_source.get_tile_host(x, y)].append((x, y))
+
+        async def worker(queue: deque[tuple[int, int]]):
+            while queue:
+                x, y = queue.popleft()
+                tile_image = await self.tile_source.get_tile_image_async(continent, floor, zoom, x, y)
+                on_tile_loaded(x, y, tile_image)
+
+        # Tile sources without native asynchronous loading run in the default executor, sized to match the total concurrency
+        # The executor is shut down once fetching ends, also on errors, cancelling the tiles not started yet
+        worker_count = len(host_queues) * self.concurrency_per_host
+        executor = ThreadPoolExecutor(max_workers=max(1, worker_count))
+        asyncio.get_running_loop().set_default_executor(executor)
+        try:
+            await asyncio.gather(*(worker(queue) for queue in host_queues.values() for _ in range(self.concurrency_per_host)))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+@dataclass
+class ResizeBand:
+    image_rows: tuple[int, int]
+    resized_rows: tuple[int, int]
+    box_rows: tuple[float, float] | None  # resampling box rows relative to image_rows
+
 
 class MapGenerator:
+    band_tile_rows = 8
+    resize_filter_support = 3.0  # support of the Lanczos filter
+
     def __init__(self, args):
         self.tile_source = self.get_tile_source(args)
+        self.tile_fetcher = self.get_tile_fetcher(args, self.tile_source)
+        self.raster_cache = BaseRasterCache(args.base_cache, round(args.base_cache_size * 2 ** 20)) if args.base_cache else None
+        self.canvas_directory = args.canvas_dir
 
     def generate_map_image(self, continent: int, floor: int, map_coord: MapCoordinateSystem, sector_index: int,
-                           sector_total: int) -> Image.Image:
-        int_zoom_map_coord = map_coord.with_int_zoom()
-        int_zoom: int = int_zoom_map_coord.zoom
-        int_zoom_image_dimensions = int_zoom_map_coord.continent_to_full_image_coord(
-            int_zoom_map_coord.sector_dimensions)
+                           sector_total: int) -> Image.Image | MapCanvas:
+        if not self.raster_cache:
+            return self.render_map_image(continent, floor, map_coord, sector_index, sector_total)
+
+        raster_key = self.get_base_image_key(continent, floor, map_coord)
+        image = self.raster_cache.load(raster_key, self.canvas_directory)
+        if image is not None:
+            print(f"\nLoaded map image {sector_index} / {sector_total} from the base map cache.")
+            return image
 
-        image = Image.new('RGB', int_zoom_image_dimensions)
+        image = self.render_map_image(continent, floor, map_coord, sector_index, sector_total)
+        print("Saving map image to the base map cache...")
+        self.raster_cache.save(raster_key, image)
+        return image
 
-        top_left_tile = int_zoom_map_coord.continent_to_tile_coord(int_zoom_map_coord.sector_top_left)
-        bottom_right_tile = int_zoom_map_coord.continent_to_tile_coord(int_zoom_map_coord.sector_bottom_right)
-        top_left_image_coord = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_top_left)
+    def plan_map_images(self, map_images: list[tuple[int, int, MapCoordinateSystem]]):
+        """
+        Registers the (continent, floor, map coordinate system) of all the map images the run will generate with the tile store, if any,
+        so that it only keeps the tiles which will be requested again, by the following bands, sectors, layouts or zoom levels.
+        """
+        if not isinstance(self.tile_source, StoredMapTileSource):
+            return
+        tile_keys = []
+        base_image_keys = set()
+        for continent, floor, map_coord in map_images:
+            # Map images loaded from the base map cache, including those cached earlier in the run, don't request any tiles
+            if self.raster_cache:
+                base_image_key = self.get_base_image_key(continent, floor, map_coord)
+                if base_image_key in base_image_keys or self.raster_cache.contains(base_image_key):
+                    continue
+                base_image_keys.add(base_image_key)
 
-        tile_coords = [
-            (x, y)
-            for x in range(top_left_tile[0], bottom_right_tile[0] + 1)
-            for y in range(top_left_tile[1], bottom_right_tile[1] + 1)
-        ]
+            int_zoom_map_coord = map_coord.with_int_zoom()
+            for band in self.get_image_bands(map_coord)[1]:
+                tile_keys.extend((continent, floor, int_zoom_map_coord.zoom, x, y) for x, y in self.get_region_tile_coords(int_zoom_map_coord, band.image_rows))
+        self.tile_source.tile_store.expect_requests(tile_keys)
+
+    def get_base_image_key(self, continent: int, floor: int, map_coord: MapCoordinateSystem) -> str:
+        """Returns the key identifying the base map image generated for the map coordinate system's sector, also used by the base map cache."""
+        tile_source_key = self.tile_source.get_source_key(continent, floor, map_coord.with_int_zoom().zoom)
+        return BaseRasterCache.get_key(tile_source_key, continent, floor, map_coord)
+
+    def render_map_image(self, continent: int, floor: int, map_coord: MapCoordinateSystem, sector_index: int,
+                         sector_total: int) -> Image.Image | MapCanvas:
+        int_zoom_map_coord = map_coord.with_int_zoom()
+        resized_image_dimensions, bands = self.get_image_bands(map_coord)
+        band_tile_coords = [self.get_region_tile_coords(int_zoom_map_coord, band.image_rows) for band in bands]
 
-        total = len(tile_coords)
+        total = sum(len(tile_coords) for tile_coords in band_tile_coords)
         completed = 0
         lock = threading.Lock()
         stop_event = threading.Event()
 
-        def fetch_tile(x, y) -> tuple[Image.Image, tuple[int, int]]:
+        def on_tile_loaded():
             nonlocal completed
-            fetched_tile_image = self.tile_source.get_tile_image(continent, floor, int_zoom, x, y)
-            fetched_position = (x * tile_image_size - top_left_image_coord[0],
-                                y * tile_image_size - top_left_image_coord[1])
             with lock:
                 completed += 1
-            return fetched_tile_image, fetched_position
 
         def progress_reporter():
             time.sleep(1)
@@ -143,78 +448,181 @@ class MapGenerator:
         reporter_thread = threading.Thread(target=progress_reporter)
         reporter_thread.start()
 
-        results = []
-        max_workers = self.tile_source.get_max_parallel_workers()
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(fetch_tile, x, y) for x, y in tile_coords]
-            for future in as_completed(futures):
-                results.append(future.result())
-
-        stop_event.set()
-        reporter_thread.join()
-        print(f"Done fetching {total} tiles, combining into a single image...")
-
-        # 1. Base tile composition
-        for tile_image, position in results:
-            image.paste(tile_image, position)
-
-        # 2. Apply Image Overlays
-        overlays = self.tile_source.get_image_overlays(continent, floor)
-        if overlays:
-            print("Applying image overlays...")
-            canvas_w, canvas_h = image.size
-
-            for overlay_img, (ov_top_left, ov_bottom_right) in overlays:
-                # Map continent rect to target pixel coordinates at current integer zoom
-                px_top_left = int_zoom_map_coord.continent_to_full_image_coord(ov_top_left)
-                px_bottom_right = int_zoom_map_coord.continent_to_full_image_coord(ov_bottom_right)
-
-                # Relative placement on the sector canvas
-                canvas_x1 = px_top_left[0] - top_left_image_coord[0]
-                canvas_y1 = px_top_left[1] - top_left_image_coord[1]
-                canvas_x2 = px_bottom_right[0] - top_left_image_coord[0]
-                canvas_y2 = px_bottom_right[1] - top_left_image_coord[1]
-
-                ov_width = canvas_x2 - canvas_x1
-                ov_height = canvas_y2 - canvas_y1
-
-                # Skip if the overlay falls completely outside the rendered sector
-                if canvas_x2 <= 0 or canvas_y2 <= 0 or canvas_x1 >= canvas_w or canvas_y1 >= canvas_h:
-                    continue
+        # The progress reporter is stopped on errors too, as it would otherwise keep the process running
+        try:
+            image_overlays = self.get_sector_image_overlays(continent, floor, int_zoom_map_coord)
+
+            # Only integer zoom images in memory are used as rendered, fractional zoom sectors small enough for a single band still need resizing
+            if len(bands) == 1 and bands[0].box_rows is None and not self.canvas_directory:
+                image = self.render_image_region(continent, floor, int_zoom_map_coord, bands[0].image_rows, band_tile_coords[0], image_overlays, on_tile_loaded)
+            else:
+                if self.canvas_directory:
+                    image = MapCanvas(resized_image_dimensions, self.canvas_directory)
+                else:
+                    image = Image.new('RGB', resized_image_dimensions)
+                # Resize the bands in parallel with loading the following ones, keeping only a limited number of them in memory
+                max_pending_bands = os.cpu_count() or 1
+                with ThreadPoolExecutor(max_workers=max_pending_bands) as executor:
+                    pending_bands = deque()
+                    for band, tile_coords in zip(bands, band_tile_coords):
+                        band_image = self.render_image_region(continent, floor, int_zoom_map_coord, band.image_rows, tile_coords, image_overlays, on_tile_loaded)
+                        if band.box_rows is None:
+                            image.paste(band_image, (0, band.resized_rows[0]))
+                            continue
+                        band_size = (resized_image_dimensions[0], band.resized_rows[1] - band.resized_rows[0])
+                        band_box = (0, band.box_rows[0], band_image.size[0], band.box_rows[1])
+                        pending_bands.append((band, executor.submit(band_image.resize, band_size, Resampling.LANCZOS, band_box)))
+                        del band_image
+
+                        while len(pending_bands) >= max_pending_bands or (pending_bands and pending_bands[0][1].done()):
+                            resized_band, resized_band_future = pending_bands.popleft()
+                            image.paste(resized_band_future.result(), (0, resized_band.resized_rows[0]))
+                    while pending_bands:
+                        resized_band, resized_band_future = pending_bands.popleft()
+                        image.paste(resized_band_future.result(), (0, resized_band.resized_rows[0]))
+        finally:
+            stop_event.set()
+            reporter_thread.join()
+        self.tile_source.finish_loading()
+        if image.size != resized_image_dimensions:
+            raise RuntimeError(f"Generated map image of size {image.size} doesn't match the size {resized_image_dimensions} at zoom {map_coord.zoom}.")
+        print(f"Map image generated from {total} tiles. {get_peak_memory_usage_text()}")
+        return image
+
+    def get_image_bands(self, map_coord: MapCoordinateSystem) -> tuple[tuple[int, int], list[ResizeBand]]:
+        """Returns the dimensions of the sector's map image, and the bands it's rendered in."""
+        int_zoom_map_coord = map_coord.with_int_zoom()
+        int_zoom_image_dimensions = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_dimensions)
+
+        # For fractional zooms, the integer zoom image is rendered and resized in horizontal bands, so that it never needs to exist in full
+        # Map canvases are rendered in bands at integer zooms as well, so that the map image never exists in memory in full
+        if map_coord.zoom == int_zoom_map_coord.zoom:
+            if self.canvas_directory:
+                return int_zoom_image_dimensions, self.get_tile_row_bands(int_zoom_map_coord, int_zoom_image_dimensions)
+            return int_zoom_image_dimensions, [ResizeBand((0, int_zoom_image_dimensions[1]), (0, int_zoom_image_dimensions[1]), None)]
+        resized_image_dimensions = map_coord.continent_to_full_image_coord(map_coord.sector_dimensions)
+        return resized_image_dimensions, self.get_resize_bands(int_zoom_image_dimensions, resized_image_dimensions)
+
+    def get_resize_bands(self, image_size: tuple[int, int], resized_size: tuple[int, int]) -> list[ResizeBand]:
+        """
+        Splits the resizing of an image into horizontal bands, each with enough source rows above and below to cover the resampling filter,
+        so that resizing the bands separately gives the same result as resizing the whole image at once.
+        """
+        scale = image_size[1] / resized_size[1]
+        support = self.resize_filter_support * max(scale, 1)
+        band_height = max(1, math.floor(self.band_tile_rows * tile_image_size / scale))
+
+        bands = []
+        for resized_y1 in range(0, resized_size[1], band_height):
+            resized_y2 = min(resized_size[1], resized_y1 + band_height)
+            box_y1 = resized_y1 * scale
+            box_y2 = resized_y2 * scale
+            image_y1 = max(0, math.floor(box_y1 - support) - 1)
+            image_y2 = min(image_size[1], math.ceil(box_y2 + support) + 1)
+            bands.append(ResizeBand((image_y1, image_y2), (resized_y1, resized_y2), (box_y1 - image_y1, box_y2 - image_y1)))
+        return bands
+
+    def get_tile_row_bands(self, int_zoom_map_coord: MapCoordinateSystem, image_size: tuple[int, int]) -> list[ResizeBand]:
+        """Splits an integer zoom image into horizontal bands of band_tile_rows tile rows without any resizing, aligned to the tile rows."""
+        top_left_image_coord = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_top_left)
+        band_height = self.band_tile_rows * tile_image_size
+        first_band_bottom = band_height - top_left_image_coord[1] % tile_image_size
 
-                # Scale overlay to match the current zoom scale
-                resized_overlay = overlay_img.resize((ov_width, ov_height), Resampling.LANCZOS)
+        band_tops = [0, *range(first_band_bottom, image_size[1], band_height)]
+        band_bottoms = [*band_tops[1:], image_size[1]]
+        return [ResizeBand(image_rows, image_rows, None) for image_rows in zip(band_tops, band_bottoms)]
 
-                # Crop overlay edges if partially off-canvas
-                crop_x1 = max(0, -canvas_x1)
-                crop_y1 = max(0, -canvas_y1)
-                crop_x2 = ov_width - max(0, canvas_x2 - canvas_w)
-                crop_y2 = ov_height - max(0, canvas_y2 - canvas_h)
+    @staticmethod
+    def get_region_tile_coords(int_zoom_map_coord: MapCoordinateSystem, image_rows: tuple[int, int]) -> list[tuple[int, int]]:
+        top_left_tile = int_zoom_map_coord.continent_to_tile_coord(int_zoom_map_coord.sector_top_left)
+        bottom_right_tile = int_zoom_map_coord.continent_to_tile_coord(int_zoom_map_coord.sector_bottom_right)
+        top_left_image_coord = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_top_left)
+        top_tile = max(top_left_tile[1], (top_left_image_coord[1] + image_rows[0]) // tile_image_size)
+        bottom_tile = min(bottom_right_tile[1], (top_left_image_coord[1] + image_rows[1] - 1) // tile_image_size)
 
-                visible_overlay = resized_overlay.crop((crop_x1, crop_y1, crop_x2, crop_y2))
+        return [
+            (x, y)
+            for x in range(top_left_tile[0], bottom_right_tile[0] + 1)
+            for y in range(top_tile, bottom_tile + 1)
+        ]
 
-                paste_x = max(0, canvas_x1)
-                paste_y = max(0, canvas_y1)
+    def render_image_region(self, continent: int, floor: int, int_zoom_map_coord: MapCoordinateSystem, image_rows: tuple[int, int],
+                            tile_coords: list[tuple[int, int]], image_overlays: list[tuple[Image.Image, tuple[int, int]]],
+                            on_tile_loaded: Callable[[], None]) -> Image.Image:
+        """Renders the given rows of the sector's map image at an integer zoom level from its tiles and image overlays."""
+        image_width = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_dimensions)[0]
+        image = Image.new('RGB', (image_width, image_rows[1] - image_rows[0]))
+        top_left_image_coord = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_top_left)
 
-                # Paste onto base canvas using alpha transparency mask
-                image.paste(visible_overlay, (paste_x, paste_y), visible_overlay)
+        def paste_tile(x, y, fetched_tile_image):
+            # Paste each tile as soon as it's loaded, so that only the tiles in flight are held in memory besides the map image itself
+            fetched_position = (x * tile_image_size - top_left_image_coord[0],
+                                y * tile_image_size - top_left_image_coord[1] - image_rows[0])
+            image.paste(fetched_tile_image, fetched_position)
+            on_tile_loaded()
 
-        # 3. Handle floating point zoom resizing
-        if map_coord.zoom == int_zoom:
-            print("Map image generated.")
-            return image
-        else:
-            print("Resizing map image...")
-            resized_image_dimensions = map_coord.continent_to_full_image_coord(map_coord.sector_dimensions)
-            resized_image = image.resize(resized_image_dimensions, Resampling.LANCZOS)
-            print("Map image generated.")
-            return resized_image
+        self.tile_fetcher.fetch_tiles(continent, floor, int_zoom_map_coord.zoom, tile_coords, paste_tile)
+
+        # Paste image overlays using their alpha transparency mask, clipped to the region
+        for overlay_image, overlay_position in image_overlays:
+            image.paste(overlay_image, (overlay_position[0], overlay_position[1] - image_rows[0]), overlay_image)
+
+        return image
+
+    def get_sector_image_overlays(self, continent: int, floor: int, int_zoom_map_coord: MapCoordinateSystem) -> list[tuple[Image.Image, tuple[int, int]]]:
+        """Returns the tile source's image overlays visible in the sector, resized to the zoom level, with their positions in the sector image."""
+        sector_image_overlays = []
+        top_left_image_coord = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_top_left)
+        canvas_w, canvas_h = int_zoom_map_coord.continent_to_full_image_coord(int_zoom_map_coord.sector_dimensions)
+
+        for overlay_img, (ov_top_left, ov_bottom_right) in self.tile_source.get_image_overlays(continent, floor):
+            # Map continent rect to target pixel coordinates at current integer zoom
+            px_top_left = int_zoom_map_coord.continent_to_full_image_coord(ov_top_left)
+            px_bottom_right = int_zoom_map_coord.continent_to_full_image_coord(ov_bottom_right)
+
+            # Relative placement on the sector canvas
+            canvas_x1 = px_top_left[0] - top_left_image_coord[0]
+            canvas_y1 = px_top_left[1] - top_left_image_coord[1]
+            canvas_x2 = px_bottom_right[0] - top_left_image_coord[0]
+            canvas_y2 = px_bottom_right[1] - top_left_image_coord[1]
+
+            # Skip if the overlay falls completely outside the rendered sector
+            if canvas_x2 <= 0 or canvas_y2 <= 0 or canvas_x1 >= canvas_w or canvas_y1 >= canvas_h:
+                continue
+
+            # Scale overlay to match the current zoom scale
+            resized_overlay = overlay_img.resize((canvas_x2 - canvas_x1, canvas_y2 - canvas_y1), Resampling.LANCZOS)
+            sector_image_overlays.append((resized_overlay, (canvas_x1, canvas_y1)))
+
+        return sector_image_overlays
 
     @staticmethod
     def get_tile_source(args) -> MapTileSource:
+        tile_source = MapGenerator.get_base_tile_source(args)
+        if args.tile_store_budget > 0:
+            tile_store = TileStore(round(args.tile_store_budget * 2 ** 20), round(args.tile_store_spill_size * 2 ** 20), args.tile_store_spill)
+            return StoredMapTileSource(tile_source, tile_store)
+        return tile_source
+
+    @staticmethod
+    def get_base_tile_source(args) -> MapTileSource:
         match args.tiles:
             case 'local':
-                return LocalMapTileSource(args.tiles_dir)
+                return LocalMapTileSource(args.tiles_dir, args.tile_workers)
+            case 'archive':
+                return ArchiveMapTileSource(args.tiles_archive, args.tile_workers)
             case 'api':
-                return TileApiMapTileSource()
+                tile_cache = None
+                if args.tile_cache:
+                    tile_cache = TileCache(args.tile_cache, round(args.tile_cache_size * 2 ** 20), args.tile_cache_max_age * 3600)
+                return TileApiMapTileSource(args.tiles_url, tile_cache, args.tile_workers or 32, args.tile_cache_max_age * 3600)
         raise ValueError(f"Unknown tile source: {args.tiles}")
+
+    @staticmethod
+    def get_tile_fetcher(args, tile_source: MapTileSource) -> MapTileFetcher:
+        match args.fetch:
+            case 'thread':
+                return ThreadedMapTileFetcher(tile_source)
+            case 'asyncio':
+                return AsyncioMapTileFetcher(tile_source, args.fetch_concurrency)
+        raise ValueError(f"Unknown tile fetcher: {args.fetch}")
@@ -0,0 +1,34 @@
+import sys
+
+
+def get_peak_memory_usage() -> int | None:
+    """Returns the peak resident memory of the current process in bytes, or None if it can't be determined on this platform."""
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD), ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t), ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports the value in kilobytes, macOS in bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def get_peak_memory_usage_text() -> str:
+    peak_memory_usage = get_peak_memory_usage()
+    return f"Peak memory usage: {peak_memory_usage / 2 ** 20:.0f} MiB" if peak_memory_usage is not None else "Peak memory usage: unknown"
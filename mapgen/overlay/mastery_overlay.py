@@ -3,7 +3,7 @@ import math
 from mapgen.overlay.overlay_util import *
 
 
-class MasteryRegionMapOverlay(MapOverlay):
+class MasteryRegionMapOverlay(LabeledMapOverlay):
     base_text_color = (255, 255, 255, 255)
     sub_text_color = (255, 255, 255, 255)
     debug_color = (255, 0, 195, 255)
@@ -38,83 +38,125 @@ class MasteryRegionMapOverlay(MapOverlay):
     }
 
     def draw_overlay(self, image: Image.Image, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
-                     scale_factor: float, debug: bool):
+                     scale_factor: float, debug: bool, region: tuple[int, int, int, int] | None = None):
         draw = ImageDraw.Draw(image, 'RGBA')
-
-        # Draw zone boundaries
-        zone_data.sort(key=lambda z: (self.category_settings[z['category']]['order'], z['id']))
-        drawn_zones = []  # list[tuple[zone, zone_image_bounds, zone_settings]]
-        for zone in zone_data:
-            continent_rect = zone['continent_rect']
-
-            if zone['id'] in map_layout.zone_blacklist or not map_coord.is_rect_contained_in_sector(continent_rect):
-                continue
-
-            zone_image_rect = map_coord.continent_to_sector_image_rect(continent_rect)
-            line_width = get_line_width(map_coord, scale_factor)
+        origin = (region[0], region[1]) if region is not None else (0, 0)
+
+        # Only the zones with boundaries or labels reaching into the region need to be drawn
+        line_width = get_line_width(map_coord, scale_factor)
+        zone_rect = get_region_continent_rect(map_coord, region)
+        if region is not None:
+            zone_margin = max(line_width, self.get_label_margin(zone_data, map_layout, map_coord, scale_factor)) / map_coord.continent_to_image_multiplier
+            zone_rect = get_expanded_rect(zone_rect, zone_margin)
+
+        # Draw zone boundaries, into a layer composited onto the map at once
+        boundary_layer = RectangleLayer(image, origin)
+        sector_zones = self.get_sector_zones(zone_data, map_layout, map_coord, zone_rect)
+        sector_zones.sort(key=lambda z: (self.category_settings[z[0]['category']]['order'], z[0]['id']))
+        drawn_zones = []  # list[tuple[zone, zone_image_bounds]]
+        for zone, zone_image_rect in sector_zones:
             outline_rect = ((zone_image_rect[0][0] - math.floor((line_width - 1) / 2), zone_image_rect[0][1] - math.floor((line_width - 1) / 2)),
                             (zone_image_rect[1][0] + math.floor(line_width / 2), zone_image_rect[1][1] + math.floor(line_width / 2)))
 
             bg_color = self.mastery_settings[zone['mastery_region']]['color']
-            draw.rectangle(outline_rect, outline='white', width=get_line_width(map_coord, scale_factor), fill=bg_color)
-            settings = self.category_settings[zone['category']]
-
-            drawn_zones.append((zone, zone_image_rect, settings))
-
-        for zone, zone_image_rect, settings in drawn_zones:
-            # Choose the fonts to draw the labels with
-            label_size_multiplier = scale_factor * (zone['label_size'] if 'label_size' in zone else settings['label_size'])
-            main_label_font_size = get_main_label_font_size(map_coord, 1 * label_size_multiplier)
-            main_label_font = get_font(main_label_font_size, True, False)
-            main_label_line_margin = main_label_font_size // 8
-            main_label_outline_width = get_text_outline_width(main_label_font_size)
-            mastery_region_font_size = get_sub_label_font_size(map_coord, 1 * label_size_multiplier)
-            mastery_region_font = get_font(mastery_region_font_size, False, True)
-            mastery_region_margin = mastery_region_font_size // 8
-            mastery_region_outline_width = get_text_outline_width(mastery_region_font_size)
-
-            # Choose the location and alignment where we want to display the zone's label (center of the zone boundary unless overridden)
-            label_anchor, label_image_rect = get_zone_pos(map_coord, zone, zone_image_rect)
+            boundary_layer.rectangle(outline_rect, outline='white', width=line_width, fill=bg_color)
 
-            if debug:
-                draw.rectangle(label_image_rect, outline=self.debug_color, width=1)
+            drawn_zones.append((zone, zone_image_rect))
+        boundary_layer.merge()
 
-            # Create a temporary image to draw the labels in, so that we can easily center them in the final map regardless of line count
-            zone_name_label_bbox = draw.textbbox((0, 0), zone['name'], font=main_label_font)
-            label_image_size = (max(250, round(zone_name_label_bbox[2] + 10), round(2 * label_image_rect[1][0] + 20)),
-                                max(250, round(10 * zone_name_label_bbox[3] + 10), round(2 * label_image_rect[1][1] + 20)))
-            label_image = Image.new('RGBA', label_image_size, (255, 255, 255, 0))
-            label_draw = ImageDraw.Draw(label_image, 'RGBA')
-            label_draw_text_anchor = label_anchor[0] + 'a'
-
-            # Collect all lines to draw so that they can be drawn in reverse order to keep earlier lines on top
-            lines_to_draw = []
-
-            # Find the ideal line wrapping for the zone's name and shape
-            wrapped_zone_name_lines = wrap_label(zone['name'], main_label_font, main_label_line_margin, label_image_rect, label_image_size, map_coord, scale_factor)
-
-            # Draw label for the zone name
-            label_pos_x = round(label_image_size[0] / 2) if label_anchor[0] == 'm' else 2 if label_anchor[0] == 'l' else label_image_size[0] - 2
-            label_pos_y = 0
-            for line in wrapped_zone_name_lines:
-                lines_to_draw.append((line, label_pos_y, main_label_font, main_label_outline_width, self.base_text_color))
-                label_pos_y = label_pos_y + main_label_font.getmetrics()[0] + main_label_line_margin
-            label_pos_y = label_pos_y + max(0, main_label_font.getmetrics()[1] - main_label_line_margin)
-
-            # Draw the mastery region
-            wrapped_mastery_region_lines = wrap_label(zone['mastery_region'], mastery_region_font, mastery_region_margin, label_image_rect, label_image_size, map_coord,
-                                                      scale_factor, 1.25)
-            for line in wrapped_mastery_region_lines:
-                lines_to_draw.append((line, label_pos_y, mastery_region_font, mastery_region_outline_width, self.sub_text_color))
-                label_pos_y = label_pos_y + mastery_region_font.getmetrics()[0] + mastery_region_margin
-
-            # Perform the actual draws
-            for (line, pos_y, font, outline_width, color) in reversed(lines_to_draw):
-                label_draw.text((label_pos_x, pos_y), line, font=font, anchor=label_draw_text_anchor, align='center', stroke_width=outline_width, fill=color, stroke_fill='black')
+        for zone, zone_image_rect in drawn_zones:
+            label = self.get_zone_label(zone, zone_image_rect, map_coord, scale_factor)
+
+            if debug:
+                draw.rectangle(((label.image_rect[0][0] - origin[0], label.image_rect[0][1] - origin[1]), (label.image_rect[1][0] - origin[0], label.image_rect[1][1] - origin[1])),
+                               outline=self.debug_color, width=1)
+
+            # When drawing a region, skip the labels outside of it, and reuse the labels drawn for the previous regions they reach into
+            if region is None:
+                label_image = self.draw_label_image(label.layout, label.image_size, label.anchor, label.draw_text_anchor)
+            elif is_label_in_region(label.image_size, label.image_rect, region):
+                label_image = label_image_cache.get_or_create((label.layout_key, label.image_size, label.anchor), lambda: self.draw_label_image(
+                    label.layout, label.image_size, label.anchor, label.draw_text_anchor))
+            else:
+                continue
 
             # Paste the resulting label into the actual map image
-            label_paste_pos = calculate_zone_label_paste_position(label_anchor, label_image, label_image_rect)
-            image.paste(label_image, label_paste_pos, label_image)
+            label_paste_pos = calculate_zone_label_paste_position(label.anchor, label_image, label.image_rect)
+            image.paste(label_image, (label_paste_pos[0] - origin[0], label_paste_pos[1] - origin[1]), label_image)
+
+    def get_zone_label(self, zone: dict, zone_image_rect: tuple[tuple[float, float], tuple[float, float]], map_coord: MapCoordinateSystem,
+                       scale_factor: float) -> ZoneLabel:
+        # Choose the fonts to draw the label with
+        settings = self.category_settings[zone['category']]
+        label_size_multiplier = scale_factor * (zone['label_size'] if 'label_size' in zone else settings['label_size'])
+        main_label_font_size = get_main_label_font_size(map_coord, 1 * label_size_multiplier)
+        main_label_font = get_font(main_label_font_size, True, False)
+        mastery_region_font_size = get_sub_label_font_size(map_coord, 1 * label_size_multiplier)
+
+        # Choose the location and alignment where we want to display the zone's label (center of the zone boundary unless overridden)
+        label_anchor, label_image_rect = get_zone_pos(map_coord, zone, zone_image_rect)
+
+        # Find the maximum size of the label, which bounds its line wrapping
+        zone_name_label_bbox = get_text_draw_bbox(main_label_font, zone['name'])
+        max_label_image_size = (max(250, round(zone_name_label_bbox[2] + 10), round(2 * label_image_rect[1][0] + 20)),
+                                max(250, round(10 * zone_name_label_bbox[3] + 10), round(2 * label_image_rect[1][1] + 20)))
+        label_draw_text_anchor = label_anchor[0] + 'a'
+
+        # Lay out the label's lines, unless an identical label has been laid out already
+        label_layout_key = ('mastery', zone['name'], zone['mastery_region'], main_label_font_size, mastery_region_font_size, label_draw_text_anchor,
+                            label_image_rect[1][0] - label_image_rect[0][0], label_image_rect[1][1] - label_image_rect[0][1], max_label_image_size,
+                            get_zoom_size_multiplier(map_coord, 2 * scale_factor))
+        label_layout = label_layout_cache.get_or_create(label_layout_key, lambda: self.create_label_layout(
+            zone, main_label_font_size, mastery_region_font_size, label_draw_text_anchor, label_image_rect, max_label_image_size, map_coord, scale_factor))
+        label_image_size = get_label_image_size(label_anchor, max_label_image_size, label_layout.text_bbox)
+        return ZoneLabel(label_layout_key, label_layout, label_anchor, label_draw_text_anchor, label_image_rect, label_image_size)
+
+    @staticmethod
+    def draw_label_image(label_layout: LabelLayout, label_image_size: tuple[int, int], label_anchor, label_draw_text_anchor) -> Image.Image:
+        # Create a temporary image just large enough to draw the label in, so that we can easily center it in the final map regardless of line count
+        label_image = Image.new('RGBA', label_image_size, (255, 255, 255, 0))
+        label_draw = ImageDraw.Draw(label_image, 'RGBA')
+        label_pos_x = round(label_image_size[0] / 2) if label_anchor[0] == 'm' else 2 if label_anchor[0] == 'l' else label_image_size[0] - 2
+
+        # Perform the actual draws, in reverse order to keep earlier lines on top
+        for line in reversed(label_layout.lines):
+            label_draw.text((label_pos_x, line.pos_y), line.text_segments[0].text, font=line.font, anchor=label_draw_text_anchor, align='center',
+                            stroke_width=line.outline_width, fill=line.text_segments[0].color, stroke_fill='black')
+        return label_image
+
+    def create_label_layout(self, zone, main_label_font_size, mastery_region_font_size, label_draw_text_anchor, label_image_rect, max_label_image_size,
+                            map_coord, scale_factor) -> LabelLayout:
+        main_label_font = get_font(main_label_font_size, True, False)
+        main_label_line_margin = main_label_font_size // 8
+        main_label_outline_width = get_text_outline_width(main_label_font_size)
+        mastery_region_font = get_font(mastery_region_font_size, False, True)
+        mastery_region_margin = mastery_region_font_size // 8
+        mastery_region_outline_width = get_text_outline_width(mastery_region_font_size)
+
+        lines: list[TextLine] = []
+
+        # Find the ideal line wrapping for the zone's name and shape
+        wrapped_zone_name_lines = wrap_label(zone['name'], main_label_font, main_label_line_margin, label_image_rect, max_label_image_size, map_coord, scale_factor)
+
+        # Lay out the label for the zone name
+        label_pos_y = 0
+        for line in wrapped_zone_name_lines:
+            lines.append(TextLine([TextLineSegment(line, self.base_text_color)], label_pos_y, main_label_font_size, True, False, main_label_outline_width))
+            label_pos_y = label_pos_y + main_label_font.getmetrics()[0] + main_label_line_margin
+        label_pos_y = label_pos_y + max(0, main_label_font.getmetrics()[1] - main_label_line_margin)
+
+        # Lay out the mastery region
+        wrapped_mastery_region_lines = wrap_label(zone['mastery_region'], mastery_region_font, mastery_region_margin, label_image_rect, max_label_image_size,
+                                                  map_coord, scale_factor, 1.25)
+        for line in wrapped_mastery_region_lines:
+            lines.append(TextLine([TextLineSegment(line, self.sub_text_color)], label_pos_y, mastery_region_font_size, False, True, mastery_region_outline_width))
+            label_pos_y = label_pos_y + mastery_region_font.getmetrics()[0] + mastery_region_margin
+
+        line_bboxes = []
+        for line in lines:
+            bbox = line.font.getbbox(line.text_segments[0].text, stroke_width=line.outline_width, anchor=label_draw_text_anchor)
+            line_bboxes.append((bbox[0], line.pos_y + bbox[1], bbox[2], line.pos_y + bbox[3]))
+        return LabelLayout(lines, get_text_bbox(line_bboxes))
 
     def draw_legend(self, image: Image.Image, map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float):
         draw_title('Mastery regions', image, map_coord, map_layout, scale_factor)
@@ -1,36 +1,119 @@
+import hashlib
+import json
+import math
+import os
+import threading
 from abc import ABC, abstractmethod
-from functools import cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from functools import cache, lru_cache
 from http.client import IncompleteRead
+from io import BytesIO
 from time import sleep
+from typing import Callable
+from urllib.parse import urlparse
 from urllib.request import urlopen
 
 import numpy as np
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageColor, ImageFont, ImageDraw
 from PIL.ImageFont import FreeTypeFont
 
+from mapgen.map_canvas import MapCanvas
 from mapgen.map_coordinates import MapCoordinateSystem, zoom_factor, MapLayout
+from mapgen.spatial_index import get_zones_in_rect
+
+image_cache_dir = 'image-cache'
+# Upper bound of the legend size in pixels, the legend fonts and icons are capped regardless of the zoom level
+max_legend_size = 4096
 
 
 class MapOverlay(ABC):
     @abstractmethod
     def draw_overlay(self, image: Image.Image, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
-                     scale_factor: float, debug: bool):
+                     scale_factor: float, debug: bool, region: tuple[int, int, int, int] | None = None):
+        """
+        Draws the overlay over the image of the map coordinate system's sector.
+        If a region (left, top, right, bottom) of the sector image is given, the image only covers that region, and only the features reaching into it
+        are drawn, with the same result as cropping the region out of the whole overlaid sector image. This bounds the memory used for each region
+        and allows rendering the regions of a large map independently.
+        """
         pass
 
+    def draw_overlay_in_tiles(self, image: Image.Image | MapCanvas, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
+                              scale_factor: float, debug: bool, tile_size: int):
+        """
+        Draws the overlay over the image of the sector one square tile at a time, with the same result as drawing it over the whole image.
+        The image can also be a map canvas, of which only the tile being drawn is then held in memory.
+        """
+        for tile_top in range(0, image.size[1], tile_size):
+            for tile_left in range(0, image.size[0], tile_size):
+                region = (tile_left, tile_top, min(tile_left + tile_size, image.size[0]), min(tile_top + tile_size, image.size[1]))
+                tile_image = image.crop(region)
+                self.draw_overlay(tile_image, zone_data, map_layout, map_coord, scale_factor, debug, region)
+                image.paste(tile_image, region[:2])
+
     @abstractmethod
     def draw_legend(self, image: Image.Image, map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float):
         pass
 
+    def draw_legend_on_canvas(self, canvas: MapCanvas, map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float):
+        """
+        Draws the legend over a map canvas by drawing it over the corner of the canvas it's aligned to. The legend is positioned relative
+        to that corner, so it ends up at the same pixels as if drawn over the whole image, as long as the corner region is large enough for it.
+        """
+        region_size = (min(canvas.size[0], map_layout.legend_image_coord[0] + max_legend_size),
+                       min(canvas.size[1], map_layout.legend_image_coord[1] + max_legend_size))
+        region_left = canvas.size[0] - region_size[0] if map_layout.legend_align[0] == 'r' else 0
+        region_top = canvas.size[1] - region_size[1] if map_layout.legend_align[1] == 'b' else 0
+        region = (region_left, region_top, region_left + region_size[0], region_top + region_size[1])
+
+        region_image = canvas.crop(region)
+        self.draw_legend(region_image, map_layout, map_coord, scale_factor)
+        canvas.paste(region_image, region[:2])
+
 
 class NoMapOverlay(MapOverlay):
     def draw_overlay(self, image: Image.Image, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
-                     scale_factor: float, debug: bool):
+                     scale_factor: float, debug: bool, region: tuple[int, int, int, int] | None = None):
         pass
 
     def draw_legend(self, image: Image.Image, map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float):
         pass
 
 
+class LabeledMapOverlay(MapOverlay):
+    """Map overlay drawing the boundaries and labels of the zones, which only goes through the zones reaching into a region when drawing one."""
+
+    def __init__(self):
+        self._label_margin: tuple[list[dict], MapLayout, tuple, float] | None = None
+
+    @abstractmethod
+    def get_zone_label(self, zone: dict, zone_image_rect: tuple[tuple[float, float], tuple[float, float]], map_coord: MapCoordinateSystem,
+                       scale_factor: float) -> 'ZoneLabel':
+        """Lays out the zone's label, anchored to the zone's rect in the sector image."""
+        pass
+
+    def get_sector_zones(self, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
+                         rect: tuple[tuple[float, float], tuple[float, float]]) -> list[tuple[dict, tuple[tuple[float, float], tuple[float, float]]]]:
+        """Returns the zones of the sector intersecting the continent rect which are drawn, with their rects in the sector image."""
+        return [(zone, map_coord.continent_to_sector_image_rect(zone['continent_rect'])) for zone in get_zones_in_rect(zone_data, rect)
+                if zone['id'] not in map_layout.zone_blacklist and map_coord.is_rect_contained_in_sector(zone['continent_rect'])]
+
+    def get_label_margin(self, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float) -> float:
+        """
+        Returns how far in pixels the labels of the sector's zones reach beyond the zones at most, so that drawing a region of the sector
+        only needs to go through the zones within that margin of it. Computed once for the last sector, whose regions are drawn one after another.
+        """
+        key = (map_coord, scale_factor)
+        if self._label_margin is None or self._label_margin[0] is not zone_data or self._label_margin[1] is not map_layout or self._label_margin[2] != key:
+            sector_rect = (map_coord.sector_top_left, map_coord.sector_bottom_right)
+            label_margin = max((self.get_zone_label(zone, zone_image_rect, map_coord, scale_factor).get_margin(zone_image_rect)
+                                for zone, zone_image_rect in self.get_sector_zones(zone_data, map_layout, map_coord, sector_rect)), default=0)
+            self._label_margin = (zone_data, map_layout, key, label_margin)
+        return self._label_margin[3]
+
+
 @cache
 def get_font(size: int, bold: bool = False, condensed: bool = False):
     font_url = f'assets/fonts/FiraSans/FiraSans{'Condensed' if condensed else ''}-{'SemiBold' if bold else 'Regular'}.ttf'
@@ -39,11 +122,18 @@ def get_font(size: int, bold: bool = False, condensed: bool = False):
 
 
 @cache
-def get_image(url: str):
+def get_image(url: str) -> Image.Image:
+    """Loads an image, downloading it only if it's not in the local image cache yet, so that following runs work offline."""
+    cache_path = os.path.join(image_cache_dir, f'{hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]}_{os.path.basename(urlparse(url).path)}')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return Image.open(BytesIO(f.read()))
+
     max_attempts = 5
     for i in range(max_attempts):
         try:
-            return Image.open(urlopen(url))
+            image_bytes = urlopen(url).read()
+            break
         except IncompleteRead as e:
             # Sometimes the loading fails, try it again a couple of times if it does
             print(f"Loading of image '{url}' failed (attempt {i + 1}/{max_attempts}): {e}")
@@ -51,37 +141,67 @@ def get_image(url: str):
                 sleep(0.3)
             else:
                 raise
-    return None
+
+    os.makedirs(image_cache_dir, exist_ok=True)
+    temp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(image_bytes)
+    os.replace(temp_path, cache_path)
+    return Image.open(BytesIO(image_bytes))
+
+
+def load_images(urls: list[str]) -> list[Image.Image]:
+    """Loads the images by get_image in parallel."""
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as executor:
+        return list(executor.map(get_image, urls))
+
+
+@dataclass(frozen=True, slots=True)
+class OverlaySizes:
+    zoom_size_multiplier: float
+    main_label_font_size: int
+    sub_label_font_size: int
+    legend_font_size: int
+    icon_size: int
+    line_width: int
+
+
+@lru_cache(maxsize=256)
+def get_overlay_sizes(zoom: float, size_multiplier: float) -> OverlaySizes:
+    """Returns the sizes of the overlay elements, which depend only on the zoom and size multiplier, not on the rest of the coordinate system."""
+    zoom_size_multiplier = size_multiplier * (zoom_factor ** zoom)
+    return OverlaySizes(
+        zoom_size_multiplier=zoom_size_multiplier,
+        main_label_font_size=min(64, max(8, round(2.6 * zoom_size_multiplier))),
+        sub_label_font_size=min(32, max(8, round(2.0 * zoom_size_multiplier))),
+        legend_font_size=min(28, max(10, round(2 * zoom_size_multiplier))),
+        icon_size=min(32, max(12, round(3 * zoom_size_multiplier))),
+        line_width=min(32, max(1, round(0.3 * zoom_size_multiplier))),
+    )
 
 
-@cache
 def get_zoom_size_multiplier(map_coord: MapCoordinateSystem, size_multiplier):
-    return size_multiplier * (zoom_factor ** map_coord.zoom)
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).zoom_size_multiplier
 
 
-@cache
 def get_main_label_font_size(map_coord: MapCoordinateSystem, size_multiplier: float = 1):
-    return min(64, max(8, round(2.6 * get_zoom_size_multiplier(map_coord, size_multiplier))))
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).main_label_font_size
 
 
-@cache
 def get_sub_label_font_size(map_coord: MapCoordinateSystem, size_multiplier: float = 1):
-    return min(32, max(8, round(2.0 * get_zoom_size_multiplier(map_coord, size_multiplier))))
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).sub_label_font_size
 
 
-@cache
 def get_legend_font_size(map_coord: MapCoordinateSystem, size_multiplier: float = 1):
-    return min(28, max(10, round(2 * get_zoom_size_multiplier(map_coord, size_multiplier))))
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).legend_font_size
 
 
-@cache
 def get_icon_size(map_coord: MapCoordinateSystem, size_multiplier: float = 1):
-    return min(32, max(12, round(3 * get_zoom_size_multiplier(map_coord, size_multiplier))))
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).icon_size
 
 
-@cache
 def get_line_width(map_coord: MapCoordinateSystem, size_multiplier: float = 1):
-    return min(32, max(1, round(0.3 * get_zoom_size_multiplier(map_coord, size_multiplier))))
+    return get_overlay_sizes(map_coord.zoom, size_multiplier).line_width
 
 
 @cache
@@ -89,14 +209,181 @@ def get_text_outline_width(font_size: float):
     return min(8, max(2, round(0.11 * font_size)))
 
 
+@dataclass
+class TextLineSegment:
+    text: str
+    color: tuple[int, ...] | None = None
+
+
+@dataclass
+class TextLine:
+    text_segments: list[TextLineSegment]
+    pos_y: float
+    font_size: int
+    bold: bool
+    condensed: bool
+    outline_width: int
+
+    @property
+    def font(self) -> FreeTypeFont:
+        return get_font(self.font_size, self.bold, self.condensed)
+
+
+@dataclass
+class LabelLayout:
+    """Final layout of a zone label: its lines positioned relative to the label's horizontal position and top, and the bbox of their text."""
+    lines: list[TextLine]
+    text_bbox: tuple[float, float, float, float]
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        lines = [TextLine([TextLineSegment(segment['text'], tuple(segment['color']) if isinstance(segment['color'], list) else segment['color'])
+                           for segment in line['text_segments']],
+                          line['pos_y'], line['font_size'], line['bold'], line['condensed'], line['outline_width'])
+                 for line in data['lines']]
+        return cls(lines, tuple(data['text_bbox']))
+
+
+@dataclass(frozen=True, slots=True)
+class ZoneLabel:
+    """A zone's laid out label, with the rect in the sector image it's anchored to and the size of the image it's drawn in."""
+    layout_key: tuple
+    layout: LabelLayout
+    anchor: str
+    draw_text_anchor: str
+    image_rect: tuple[tuple[float, float], tuple[float, float]]
+    image_size: tuple[int, int]
+
+    def get_margin(self, zone_image_rect: tuple[tuple[float, float], tuple[float, float]]) -> float:
+        """Returns how far in pixels the label can reach beyond the zone's rect in the sector image, as bounded by is_label_in_region."""
+        return max(0, zone_image_rect[0][0] - (self.image_rect[0][0] - self.image_size[0] - 1), self.image_rect[1][0] + self.image_size[0] + 1 - zone_image_rect[1][0],
+                   zone_image_rect[0][1] - (self.image_rect[0][1] - self.image_size[1] - 5), self.image_rect[1][1] + self.image_size[1] + 1 - zone_image_rect[1][1])
+
+
+class LabelLayoutCache:
+    """
+    Cache of the zone label layouts, keyed by everything a layout depends on (texts, font sizes, label rect size etc.),
+    so that labels repeated across sectors, overlays and zoom levels only need to be rasterized.
+    Optionally persisted to a JSON file in between runs.
+    """
+
+    # Increment when the label layout changes, to invalidate the previously saved layouts
+    cache_version = 1
+
+    def __init__(self):
+        self.path = None
+        self._layouts: dict[str, LabelLayout] = {}
+        self._new_layouts: dict[str, LabelLayout] = {}  # layouts not saved yet
+
+    def load(self, path: str):
+        """Sets the file to persist the cache to, and loads the layouts saved in it by previous runs if it exists."""
+        self.path = path
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != self.cache_version:
+            print(f"Label layout cache {path} is outdated, it will be rebuilt.")
+            return
+        self._layouts.update({key: LabelLayout.from_dict(layout) for key, layout in data['layouts'].items()})
+
+    def save(self):
+        if self.path is None or not self._new_layouts:
+            return
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.cache_version, 'layouts': {key: asdict(layout) for key, layout in self._layouts.items()}}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        self._new_layouts.clear()
+
+    def get_or_create(self, key: tuple, create_layout: Callable[[], LabelLayout]) -> LabelLayout:
+        key_text = json.dumps(key, ensure_ascii=False)
+        layout = self._layouts.get(key_text)
+        if layout is None:
+            layout = create_layout()
+            self._layouts[key_text] = self._new_layouts[key_text] = layout
+        return layout
+
+    def pop_new_layouts(self) -> dict[str, LabelLayout]:
+        """Returns and forgets the layouts created since the last call, so that worker processes can pass them back to the main process."""
+        new_layouts = self._new_layouts
+        self._new_layouts = {}
+        return new_layouts
+
+    def add_layouts(self, layouts: dict[str, LabelLayout]):
+        self._layouts.update(layouts)
+        self._new_layouts.update(layouts)
+
+
+label_layout_cache = LabelLayoutCache()
+
+
+class LabelImageCache:
+    """
+    Least recently used drawn label images, up to a total memory size, so that a label reaching into multiple regions of a map drawn one region
+    at a time is only drawn once, for the first of them.
+    """
+
+    def __init__(self, max_size: int = 64 * 2 ** 20):
+        self.max_size = max_size
+        self._images: OrderedDict[str, Image.Image] = OrderedDict()
+        self._size = 0
+
+    def get_or_create(self, key: tuple, create_image: Callable[[], Image.Image]) -> Image.Image:
+        key_text = json.dumps(key, ensure_ascii=False)
+        image = self._images.get(key_text)
+        if image is not None:
+            self._images.move_to_end(key_text)
+            return image
+
+        image = self._images[key_text] = create_image()
+        self._size += self._get_image_size(image)
+        while self._size > self.max_size and len(self._images) > 1:
+            self._size -= self._get_image_size(self._images.popitem(last=False)[1])
+        return image
+
+    @staticmethod
+    def _get_image_size(image: Image.Image) -> int:
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+
+label_image_cache = LabelImageCache()
+
+
+@lru_cache(maxsize=8192)
+def get_text_length(font: FreeTypeFont, text: str) -> float:
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=4096)
+def get_text_draw_bbox(font: FreeTypeFont, text: str) -> tuple[float, float, float, float]:
+    """Returns the bbox of the text drawn at the origin, as measured for each label in each region of the map it's drawn in."""
+    return ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+
+
+@lru_cache(maxsize=8192)
+def get_appended_word_length(font: FreeTypeFont, last_char: str, word: str) -> float:
+    """Returns by how much appending a space and the word to a text ending with last_char makes it longer, including kerning around the space."""
+    return font.getlength(f'{last_char} {word}') - get_text_length(font, last_char)
+
+
 def get_wrapped_text_lines(text: str, font: FreeTypeFont, line_length: int):
+    # Measure each word only once, along with the kerning against the end of the line, instead of measuring the whole line for each word
     lines = ['']
+    current_line_length = 0
     for i, word in enumerate(text.split(' ')):
-        line = f'{lines[-1]} {word}' if i > 0 else word
-        if font.getlength(line) <= line_length or len(lines[-1]) < 3:
+        if i > 0:
+            line = f'{lines[-1]} {word}'
+            length = current_line_length + get_appended_word_length(font, lines[-1][-1:], word)
+        else:
+            line = word
+            length = get_text_length(font, word)
+        if length <= line_length or len(lines[-1]) < 3:
             lines[-1] = line
+            current_line_length = length
         else:
             lines.append(word)
+            current_line_length = get_text_length(font, word)
     return lines
 
 
@@ -121,6 +408,175 @@ def wrap_label(label, font, label_margin, label_image_rect, label_image_size, ma
     return wrapped_zone_name_lines
 
 
+class SparseImageLayer:
+    """
+    Sparse copy of the cells of an image touched by many small pastes, such as the portal icons and lines. The pastes go into the small cell images
+    instead of the whole image, and merge writes the touched cells back to the image at once, with exactly the same result as pasting directly.
+    The pastes are positioned relative to the origin, the position of the image's top left corner within the sector image when drawing a region of it.
+    """
+
+    def __init__(self, image: Image.Image, cell_size: int = 128, origin: tuple[int, int] = (0, 0)):
+        self.image = image
+        self.cell_size = cell_size
+        self.origin = origin
+        self._cells: dict[tuple[int, int], Image.Image] = {}
+
+    def paste(self, im: Image.Image, box: tuple[int, int], mask: Image.Image | None = None):
+        box = (box[0] - self.origin[0], box[1] - self.origin[1])
+        x0, y0 = max(0, box[0]), max(0, box[1])
+        x1, y1 = min(self.image.size[0], box[0] + im.size[0]), min(self.image.size[1], box[1] + im.size[1])
+        if x0 >= x1 or y0 >= y1:
+            return
+        for cell_x in range(x0 // self.cell_size, (x1 - 1) // self.cell_size + 1):
+            for cell_y in range(y0 // self.cell_size, (y1 - 1) // self.cell_size + 1):
+                cell_image = self._cells.get((cell_x, cell_y))
+                if cell_image is None:
+                    cell_box = (cell_x * self.cell_size, cell_y * self.cell_size, (cell_x + 1) * self.cell_size, (cell_y + 1) * self.cell_size)
+                    cell_image = self._cells[(cell_x, cell_y)] = self.image.crop(cell_box)
+                cell_image.paste(im, (box[0] - cell_x * self.cell_size, box[1] - cell_y * self.cell_size), mask)
+
+    def merge(self):
+        for (cell_x, cell_y), cell_image in self._cells.items():
+            self.image.paste(cell_image, (cell_x * self.cell_size, cell_y * self.cell_size))
+        self._cells.clear()
+
+
+class RectangleLayer:
+    """
+    RGBA layer of axis-aligned rectangles, such as the zone boundaries and fills, drawn in order with the same semantics as ImageDraw.rectangle
+    and composited onto the image in a single operation by merge.
+    The rectangles are first drawn on the grid formed by their edges, whose cells are each covered by the same rectangles, so that drawing them
+    doesn't depend on the size of the map, and the map's pixels are then only blended with the colors left visible over them.
+    The rectangles are positioned relative to the origin, like the pastes of SparseImageLayer.
+    """
+
+    def __init__(self, image: Image.Image, origin: tuple[int, int] = (0, 0)):
+        self.image = image
+        self.origin = origin
+        self._rects: list[tuple[int, int, int, int]] = []  # (left, top, right, bottom), right and bottom exclusive
+        self._colors: list[tuple[int, int, int, int]] = []
+
+    def rectangle(self, xy: tuple[tuple[int, int], tuple[int, int]], fill=None, outline=None, width: int = 1):
+        """Adds a rectangle, drawn exactly like ImageDraw.rectangle would as long as it's more than twice as large as its outline width."""
+        (x0, y0), (x1, y1) = xy
+        if fill is not None:
+            self._add((x0, y0, x1 + 1, y1 + 1), fill)
+        if outline is not None and outline != fill and width != 0:
+            self._add((x0, y0, x1 + 1, y0 + width), outline)
+            self._add((x0, y1 - width + 1, x1 + 1, y1 + 1), outline)
+            self._add((x0, y0 + width, x0 + width, y1 - width + 1), outline)
+            self._add((x1 - width + 1, y0 + width, x1 + 1, y1 - width + 1), outline)
+
+    def _add(self, rect: tuple[int, int, int, int], color):
+        color = ImageColor.getrgb(color) if isinstance(color, str) else tuple(color)
+        self._rects.append((rect[0] - self.origin[0], rect[1] - self.origin[1], rect[2] - self.origin[0], rect[3] - self.origin[1]))
+        self._colors.append(color if len(color) == 4 else color + (255,))
+
+    def merge(self):
+        if not self._rects:
+            return
+        width, height = self.image.size
+        rects = np.array(self._rects)
+        rects[:, 0::2] = rects[:, 0::2].clip(0, width)
+        rects[:, 1::2] = rects[:, 1::2].clip(0, height)
+        visible = (rects[:, 0] < rects[:, 2]) & (rects[:, 1] < rects[:, 3]) & (np.array(self._colors)[:, 3] > 0)
+        colors = [color for color, is_visible in zip(self._colors, visible) if is_visible]
+        rects = rects[visible]
+        self._rects.clear()
+        self._colors.clear()
+        if len(rects) == 0:
+            return
+
+        # Find the stack of colors left visible over each cell of the grid of the rectangles' edges, i.e. those drawn after its last opaque one
+        grid_x, grid_y = np.unique(rects[:, 0::2]), np.unique(rects[:, 1::2])
+        cell_rects = np.stack([np.searchsorted(grid_x, rects[:, 0]), np.searchsorted(grid_y, rects[:, 1]),
+                               np.searchsorted(grid_x, rects[:, 2]), np.searchsorted(grid_y, rects[:, 3])], axis=1)
+        stacks: list[tuple[tuple[int, int, int, int], ...]] = [()]
+        stack_ids = {(): 0}
+
+        def get_stack_id(stack):
+            if stack not in stack_ids:
+                stack_ids[stack] = len(stacks)
+                stacks.append(stack)
+            return stack_ids[stack]
+
+        cell_stacks = np.zeros((len(grid_y) - 1, len(grid_x) - 1), dtype=np.int32)
+        for (cell_x0, cell_y0, cell_x1, cell_y1), color in zip(cell_rects.tolist(), colors):
+            cells = cell_stacks[cell_y0:cell_y1, cell_x0:cell_x1]
+            if color[3] == 255:
+                cells[...] = get_stack_id((color,))
+            else:
+                new_ids = np.zeros(len(stacks), dtype=np.int32)
+                for stack_id in np.flatnonzero(np.bincount(cells.ravel(), minlength=len(stacks))).tolist():
+                    new_ids[stack_id] = get_stack_id(stacks[stack_id] + (color,))
+                cells[...] = new_ids[cells]
+
+        # Composite the uniform regions of the layer: runs of cells with the same stack along each row of the grid, extended down while unchanged.
+        # The regions don't overlap, so each pixel is only blended with the colors visible over it, with exactly the same result as drawing them all.
+        draw = ImageDraw.Draw(self.image, 'RGBA')
+        open_runs: dict[tuple[int, int, int], int] = {}  # (first cell column, last cell column + 1, stack id) -> first cell row
+        for cell_y in range(len(grid_y)):
+            runs = set()
+            if cell_y < len(grid_y) - 1:
+                row_stacks = cell_stacks[cell_y]
+                run_starts = np.flatnonzero(np.diff(row_stacks, prepend=-1))
+                run_ends = np.append(run_starts[1:], len(row_stacks))
+                runs = {run for run in zip(run_starts.tolist(), run_ends.tolist(), row_stacks[run_starts].tolist()) if run[2] != 0}
+            for run in [run for run in open_runs if run not in runs]:
+                region = (grid_x[run[0]], grid_y[open_runs.pop(run)], grid_x[run[1]], grid_y[cell_y])
+                stack = stacks[run[2]]
+                if stack[0][3] == 255:
+                    self.image.paste(stack[0][:3], region)
+                    stack = stack[1:]
+                for color in stack:
+                    draw.rectangle((region[0], region[1], region[2] - 1, region[3] - 1), fill=color)
+            for run in runs:
+                open_runs.setdefault(run, cell_y)
+
+
+def draw_antialiased_line(image: Image.Image | SparseImageLayer, start: tuple[float, float], end: tuple[float, float], color: tuple[int, int, int, int], width: float,
+                          chunk_length: int = 64):
+    """
+    Draws a straight line with flat ends, anti-aliased by the coverage of each pixel by the line. To touch only the pixels near the line,
+    it's rasterized and pasted in chunks along its length, each pixel belonging to the chunk its projection onto the line falls in.
+    The line is shifted by 1/8 of a pixel, like the lines previously drawn at 4x scale and downsampled, to keep the same placement.
+    """
+    x0, y0 = start[0] + 0.125, start[1] + 0.125
+    x1, y1 = end[0] + 0.125, end[1] + 0.125
+    length = math.hypot(x1 - x0, y1 - y0)
+    if length == 0:
+        return
+    direction_x, direction_y = (x1 - x0) / length, (y1 - y0) / length
+    half_width = width / 2
+    reach = half_width + 1
+
+    chunk_count = math.ceil(length / chunk_length)
+    for i in range(chunk_count):
+        chunk_start, chunk_end = i * length / chunk_count, (i + 1) * length / chunk_count
+        chunk_x = (x0 + direction_x * chunk_start, x0 + direction_x * chunk_end)
+        chunk_y = (y0 + direction_y * chunk_start, y0 + direction_y * chunk_end)
+        left, top = math.floor(min(chunk_x) - reach), math.floor(min(chunk_y) - reach)
+        right, bottom = math.ceil(max(chunk_x) + reach), math.ceil(max(chunk_y) + reach)
+
+        # Position of the pixel centers along the line, and their distance from it
+        pixel_y, pixel_x = np.mgrid[top:bottom, left:right] + 0.5
+        offset_x, offset_y = pixel_x - x0, pixel_y - y0
+        position = offset_x * direction_x + offset_y * direction_y
+        distance = np.abs(offset_x * direction_y - offset_y * direction_x)
+
+        coverage = np.clip(half_width + 0.5 - distance, 0, 1) * np.clip(np.minimum(position, length - position) + 0.5, 0, 1)
+        if i > 0:
+            coverage[position < chunk_start] = 0
+        if i < chunk_count - 1:
+            coverage[position >= chunk_end] = 0
+
+        chunk_array = np.empty(coverage.shape + (4,), dtype=np.uint8)
+        chunk_array[..., :3] = color[:3]
+        chunk_array[..., 3] = np.round(color[3] * coverage)
+        chunk_image = Image.fromarray(chunk_array)
+        image.paste(chunk_image, (left, top), chunk_image)
+
+
 def draw_title(title_text, image, map_coord, map_layout, scale_factor):
     font_size = 2 * get_main_label_font_size(map_coord, scale_factor)
     font = get_font(font_size, True)
@@ -135,6 +591,53 @@ def draw_title(title_text, image, map_coord, map_layout, scale_factor):
               font=font, fill='white', stroke_width=outline_width, stroke_fill='black', anchor='la')
 
 
+def get_label_image_size(label_anchor, max_label_image_size: tuple[int, int], text_bbox: tuple[float, float, float, float]) -> tuple[int, int]:
+    """
+    Returns the size of the temporary image to draw a zone label in, just large enough for the label's text instead of max_label_image_size.
+    The text bbox is relative to the label's horizontal position and top of the image. The width stays congruent to the maximum width modulo 4,
+    so that the label text is positioned within the image and pasted into the map at exactly the same pixels as with the maximum size.
+    """
+    padding = 2
+    match label_anchor[0]:
+        case 'l':
+            width = math.ceil(2 + text_bbox[2] + padding)
+        case 'm':
+            width = math.ceil(2 * (max(-text_bbox[0], text_bbox[2]) + padding)) + 1
+        case _:
+            width = math.ceil(2 - text_bbox[0] + padding)
+    width = width + (max_label_image_size[0] - width) % 4
+    height = math.ceil(text_bbox[3] + padding)
+    return max(1, min(max_label_image_size[0], width)), max(1, min(max_label_image_size[1], height))
+
+
+def get_text_bbox(text_bboxes: list[tuple[float, float, float, float]]) -> tuple[float, float, float, float]:
+    """Returns the bbox enclosing all the given text bboxes."""
+    if not text_bboxes:
+        return 0, 0, 0, 0
+    return min(b[0] for b in text_bboxes), min(b[1] for b in text_bboxes), max(b[2] for b in text_bboxes), max(b[3] for b in text_bboxes)
+
+
+def get_region_continent_rect(map_coord: MapCoordinateSystem, region: tuple[int, int, int, int] | None) -> tuple[tuple[float, float], tuple[float, float]]:
+    """Returns the continent rect covered by a region of the sector image, or by the whole sector if no region is given."""
+    if region is None:
+        return map_coord.sector_top_left, map_coord.sector_bottom_right
+    return ((map_coord.sector_top_left[0] + region[0] / map_coord.continent_to_image_multiplier, map_coord.sector_top_left[1] + region[1] / map_coord.continent_to_image_multiplier),
+            (map_coord.sector_top_left[0] + region[2] / map_coord.continent_to_image_multiplier, map_coord.sector_top_left[1] + region[3] / map_coord.continent_to_image_multiplier))
+
+
+def get_expanded_rect(rect: tuple[tuple[float, float], tuple[float, float]], margin: float) -> tuple[tuple[float, float], tuple[float, float]]:
+    return (rect[0][0] - margin, rect[0][1] - margin), (rect[1][0] + margin, rect[1][1] + margin)
+
+
+def is_label_in_region(label_image_size: tuple[int, int], label_image_rect: tuple[tuple[float, float], tuple[float, float]], region: tuple[int, int, int, int]) -> bool:
+    """
+    Returns whether a label image could reach into the region once pasted by calculate_zone_label_paste_position, before drawing it.
+    Its vertical position depends on the drawn text, so it's bounded by the positions of its whole image for all anchors.
+    """
+    return (label_image_rect[0][0] - label_image_size[0] - 1 < region[2] and region[0] < label_image_rect[1][0] + label_image_size[0] + 1 and
+            label_image_rect[0][1] - label_image_size[1] - 5 < region[3] and region[1] < label_image_rect[1][1] + label_image_size[1] + 1)
+
+
 def calculate_zone_label_paste_position(label_anchor, label_image: Image.Image, label_image_rect: tuple[tuple[float, float], tuple[float, float]]) -> tuple[int, int]:
     label_bbox = label_image.getbbox()
     label_paste_pos = [0, 0]
@@ -193,25 +696,51 @@ def create_stroke_stamp(radius: int):
 def add_stroke_around_alpha(image: Image.Image, stroke_width: int = 1, stroke_color: tuple[float, float, float, float] = (0, 0, 0, 255), alpha_threshold: int = 64) -> Image.Image:
     image_array = np.asarray(image)
     input_alpha = image_array[..., 3]
-    output_alpha = np.zeros(np.array(input_alpha.shape) + 2 * stroke_width, dtype=float)
 
     # For each point of the input image with alpha over the threshold, stamp a circle of width `stroke_width` around it
-    stamp = create_stroke_stamp(stroke_width)
-    stamp_size = np.size(stamp, 0)
-    for i in range(np.size(input_alpha, 0)):
-        for j in range(np.size(input_alpha, 1)):
-            if input_alpha[i, j] >= alpha_threshold:
-                output_slice = output_alpha[i:i + stamp_size, j:j + stamp_size]
-                np.add(output_slice, stamp, out=output_slice)
+    output_alpha = get_stamped_alpha(input_alpha >= alpha_threshold, stroke_width)
 
     # Prepare the stroke image
-    np.clip(output_alpha, 0, 1, out=output_alpha)
-    output_array = np.full(image_array.shape + np.array((2 * stroke_width, 2 * stroke_width, 0)), stroke_color, dtype=float)
-    output_array[..., 3] *= output_alpha
-    output_stroke = Image.fromarray(output_array.round().astype(np.uint8))
+    output_array = np.empty(output_alpha.shape + (4,), dtype=np.uint8)
+    output_array[..., :3] = np.round(stroke_color[:3])
+    output_array[..., 3] = np.round(stroke_color[3] * output_alpha)
+    output_stroke = Image.fromarray(output_array)
 
     # Create the final image
     extended_image = Image.new('RGBA', output_stroke.size)
     extended_image.paste(image, (stroke_width, stroke_width), image)
     composite_image = Image.alpha_composite(output_stroke, extended_image)
     return composite_image.crop(composite_image.getbbox())
+
+
+def get_stamped_alpha(mask: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Returns the sum of the stroke stamps of the given radius centered on each point of the mask, clipped to [0, 1],
+    in an array extended by the radius on each side. Instead of stamping point by point, each value of the stamp is added for the whole mask at once.
+    The stamp's inner disk of ones is a binary dilation, done separably as a horizontal dilation of the mask, followed by vertical shifts.
+    Only the anti-aliased ring around it needs to be summed.
+    """
+    stamp = create_stroke_stamp(radius)
+    height, width = mask.shape
+    output_alpha = np.zeros((height + 2 * radius, width + 2 * radius), dtype=float)
+
+    # Sum the anti-aliased ring of the stamp
+    mask_values = mask.astype(float)
+    for i, j in zip(*np.nonzero((stamp > 0) & (stamp < 1))):
+        output_slice = output_alpha[i:i + height, j:j + width]
+        output_slice += stamp[i, j] * mask_values
+    np.clip(output_alpha, 0, 1, out=output_alpha)
+
+    # Dilate by the disk of ones, row by row of the stamp, with the horizontal dilation widened as needed
+    disk_half_widths = np.count_nonzero(stamp == 1, axis=1) // 2
+    horizontal_dilation = np.zeros((height, width + 2 * radius), dtype=bool)
+    dilation = np.zeros(output_alpha.shape, dtype=bool)
+    horizontal_dilation[:, radius:radius + width] = mask
+    for half_width in range(radius + 1):
+        if half_width > 0:
+            horizontal_dilation[:, radius - half_width:radius - half_width + width] |= mask
+            horizontal_dilation[:, radius + half_width:radius + half_width + width] |= mask
+        for i in np.nonzero(disk_half_widths == half_width)[0]:
+            dilation[i:i + height] |= horizontal_dilation
+    output_alpha[dilation] = 1
+    return output_alpha
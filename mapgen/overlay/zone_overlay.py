@@ -1,25 +1,11 @@
 import math
-from dataclasses import dataclass
 
 from data.portals import portals
 from mapgen.overlay.overlay_util import *
+from mapgen.spatial_index import get_portals_in_rect
 
 
-@dataclass
-class TextLineSegment:
-    text: str
-    color: tuple[int, ...] | None = None
-
-
-@dataclass
-class TextLine:
-    text_segments: list[TextLineSegment]
-    pos_y: float
-    font: FreeTypeFont
-    outline_width: int
-
-
-class ZoneMapOverlay(MapOverlay):
+class ZoneMapOverlay(LabeledMapOverlay):
     def __init__(self, show_access_requirements: bool):
         super().__init__()
         self.show_access_requirements = show_access_requirements
@@ -64,52 +50,55 @@ class ZoneMapOverlay(MapOverlay):
 
     portal_settings = {
         'neighbor': {
-            'icon': get_image("https://wiki.guildwars2.com/images/a/ae/Asura_gate_starter_area_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/a/ae/Asura_gate_starter_area_%28map_icon%29.png",
             'line_color': (45, 185, 227, 150),
             'legend': 'Zone portal'
         },
         'asura_gate': {
-            'icon': get_image("https://wiki.guildwars2.com/images/6/6c/Asura_gate_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/6/6c/Asura_gate_%28map_icon%29.png",
             'line_color': None,
             'legend': 'Asura gate / Long distance portal'
         },
         'dungeon': {
-            'icon': get_image("https://wiki.guildwars2.com/images/3/3c/Dungeon_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/3/3c/Dungeon_%28map_icon%29.png",
             'line_color': None,
             'legend': 'Dungeon'
         },
         'fractal': {
-            'icon': get_image("https://wiki.guildwars2.com/images/9/9f/Fractals_of_the_Mists_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/9/9f/Fractals_of_the_Mists_%28map_icon%29.png",
             'line_color': None,
             'legend': 'Fractals of the Mists'
         },
         'strike': {
-            'icon': get_image("https://wiki.guildwars2.com/images/e/e7/Strike_Mission_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/e/e7/Strike_Mission_%28map_icon%29.png",
             'line_color': None,
             'legend': 'Raid encounter'
         },
         'raid': {
-            'icon': get_image("https://wiki.guildwars2.com/images/8/86/Raid_%28map_icon%29.png"),
+            'icon_url': "https://wiki.guildwars2.com/images/8/86/Raid_%28map_icon%29.png",
             'line_color': (199, 76, 42, 150),
             'legend': 'Raid'
         },
     }
 
     def draw_overlay(self, image: Image.Image, zone_data: list[dict], map_layout: MapLayout, map_coord: MapCoordinateSystem,
-                     scale_factor: float, debug: bool):
+                     scale_factor: float, debug: bool, region: tuple[int, int, int, int] | None = None):
         draw = ImageDraw.Draw(image, 'RGBA')
+        origin = (region[0], region[1]) if region is not None else (0, 0)
 
-        # Draw zone boundaries
-        drawn_zones = []  # list[tuple[zone, zone_image_bounds, zone_settings]]
-        zone_data.sort(key=lambda z: (self.category_settings[z['category']]['boundary_order'], z['id']))
-        for zone in zone_data:
-            continent_rect = zone['continent_rect']
-
-            if zone['id'] in map_layout.zone_blacklist or not map_coord.is_rect_contained_in_sector(continent_rect):
-                continue
+        # Only the zones with boundaries or labels reaching into the region need to be drawn
+        line_width = get_line_width(map_coord, scale_factor)
+        zone_rect = get_region_continent_rect(map_coord, region)
+        if region is not None:
+            zone_margin = max(line_width, self.get_label_margin(zone_data, map_layout, map_coord, scale_factor)) / map_coord.continent_to_image_multiplier
+            zone_rect = get_expanded_rect(zone_rect, zone_margin)
 
-            zone_image_rect = map_coord.continent_to_sector_image_rect(continent_rect)
-            line_width = get_line_width(map_coord, scale_factor)
+        # Draw zone boundaries, into a layer composited onto the map at once
+        boundary_layer = RectangleLayer(image, origin)
+        drawn_zones = []  # list[tuple[zone, zone_image_bounds, zone_settings]]
+        sector_zones = self.get_sector_zones(zone_data, map_layout, map_coord, zone_rect)
+        sector_zones.sort(key=lambda z: (self.category_settings[z[0]['category']]['boundary_order'], z[0]['id']))
+        for zone, zone_image_rect in sector_zones:
             outline_rect = ((zone_image_rect[0][0] - math.floor((line_width - 1) / 2), zone_image_rect[0][1] - math.floor((line_width - 1) / 2)),
                             (zone_image_rect[1][0] + math.floor(line_width / 2), zone_image_rect[1][1] + math.floor(line_width / 2)))
 
@@ -118,13 +107,19 @@ class ZoneMapOverlay(MapOverlay):
 
             drawn_zones.append((zone, zone_image_rect, settings))
 
-            draw.rectangle(outline_rect, outline=line_color, width=line_width)
+            boundary_layer.rectangle(outline_rect, outline=line_color, width=line_width)
+        boundary_layer.merge()
 
         # Draw icons for portals, asura gates, dungeons etc.
         icon_size = get_icon_size(map_coord, scale_factor)
+        # Only portals with icons or connection lines reaching into the sector or region, including those just outside of it, need to be drawn
+        portal_margin = (icon_size + line_width + math.ceil(max(1, get_zoom_size_multiplier(map_coord, scale_factor)))) / map_coord.continent_to_image_multiplier
+        portal_rect = get_expanded_rect(get_region_continent_rect(map_coord, region), portal_margin)
+        # Paste them into a sparse layer of the touched parts of the map, merged into the map at once
+        portal_layer = SparseImageLayer(image, origin=origin)
         for portal_type in reversed(portals.keys()):
             portal_icon = self.get_portal_icon(portal_type, icon_size)
-            for portal in portals[portal_type]:
+            for portal in get_portals_in_rect(portal_type, portal_rect):
                 if (portal_type, portal[0]) in map_layout.portal_blacklist:
                     continue
                 portal_image_coord = map_coord.continent_to_sector_image_coord((portal[1], portal[2]))
@@ -132,65 +127,101 @@ class ZoneMapOverlay(MapOverlay):
                 if len(portal) == 5:
                     portal2_image_coord = map_coord.continent_to_sector_image_coord((portal[3], portal[4]))
                     portal2_paste_coord = (round(portal2_image_coord[0] - portal_icon.size[0] / 2), round(portal2_image_coord[1] - portal_icon.size[1] / 2))
-                    self.draw_portal_connection_line(image, portal_image_coord, portal2_image_coord, portal_type, map_coord, scale_factor)
-                    image.paste(portal_icon, portal2_paste_coord, portal_icon)
-                image.paste(portal_icon, portal_paste_coord, portal_icon)
+                    self.draw_portal_connection_line(portal_layer, portal_image_coord, portal2_image_coord, portal_type, map_coord, scale_factor)
+                    portal_layer.paste(portal_icon, portal2_paste_coord, portal_icon)
+                portal_layer.paste(portal_icon, portal_paste_coord, portal_icon)
+        portal_layer.merge()
 
         # Draw zone labels
         drawn_zones.sort(key=lambda z: (self.category_settings[z[0]['category']]['label_order'], z[0]['id']))
         for zone, zone_image_rect, settings in drawn_zones:
-            # Choose the fonts to draw the labels with
-            label_size_multiplier = scale_factor * (zone['label_size'] if 'label_size' in zone else 0.8 if settings['special'] else 1)
-            main_label_font_size = get_main_label_font_size(map_coord, label_size_multiplier)
-            main_label_font = get_font(main_label_font_size, True, False)
-            main_label_line_margin = main_label_font_size // 8
-            main_label_outline_width = get_text_outline_width(main_label_font_size)
-            sub_label_font_size = get_sub_label_font_size(map_coord, label_size_multiplier)
-            sub_label_font = get_font(sub_label_font_size, False, True)
-            sub_label_line_margin = sub_label_font_size // -8
-            sub_label_outline_width = get_text_outline_width(sub_label_font_size)
-
-            # Choose the location and alignment where we want to display the zone's label (center of the zone boundary unless overridden)
-            label_anchor, label_image_rect = get_zone_pos(map_coord, zone, zone_image_rect)
+            label = self.get_zone_label(zone, zone_image_rect, map_coord, scale_factor)
 
             if debug:
-                draw.rectangle(label_image_rect, outline=self.debug_color, width=1)
+                draw.rectangle(((label.image_rect[0][0] - origin[0], label.image_rect[0][1] - origin[1]), (label.image_rect[1][0] - origin[0], label.image_rect[1][1] - origin[1])),
+                               outline=self.debug_color, width=1)
 
-            # Create a temporary image to draw the labels in, so that we can easily center them in the final map regardless of line count
-            zone_name_label_bbox = draw.textbbox((0, 0), zone['name'], font=main_label_font)
-            label_image_size = (max(250, round(zone_name_label_bbox[2] + 10), round(2 * label_image_rect[1][0] + 20)),
-                                max(250, round(10 * zone_name_label_bbox[3] + 10), round(2 * label_image_rect[1][1] + 20)))
-            label_image = Image.new('RGBA', label_image_size, (255, 255, 255, 0))
-            label_draw = ImageDraw.Draw(label_image, 'RGBA')
-            label_draw_text_anchor = label_anchor[0] + 'a'
+            # When drawing a region, skip the labels outside of it, and reuse the labels drawn for the previous regions they reach into
             label_color = self.special_line_color if settings['special'] else 'white'
-
-            # Collect all lines to draw so that they can be drawn in reverse order to keep earlier lines on top
-            lines_to_draw: list[TextLine] = []
-
-            # Find the ideal line wrapping for the zone's name and shape
-            wrapped_zone_name_lines = wrap_label(zone['name'], main_label_font, main_label_line_margin, label_image_rect, label_image_size, map_coord, scale_factor)
-
-            # Draw label for the zone name
-            label_pos_x = label_image.size[0] / 2 if label_anchor[0] == 'm' else 2 if label_anchor[0] == 'l' else label_image.size[0] - 2
-            label_pos_y = 0
-            for line in wrapped_zone_name_lines:
-                lines_to_draw.append(TextLine([TextLineSegment(line)], label_pos_y, main_label_font, main_label_outline_width))
-                label_pos_y = label_pos_y + main_label_font.getmetrics()[0] + main_label_line_margin
-            label_pos_y = label_pos_y + max(0, main_label_font.getmetrics()[1] - main_label_line_margin)
-
-            wrapped_sub_label_lines = self.get_sub_label_lines(zone, settings, sub_label_font, sub_label_line_margin, label_image_rect, label_image_size, map_coord, scale_factor)
-            for text_lines in wrapped_sub_label_lines:
-                lines_to_draw.append(TextLine(text_lines, label_pos_y, sub_label_font, sub_label_outline_width))
-                label_pos_y = label_pos_y + sum(sub_label_font.getmetrics()) + sub_label_line_margin
-
-            # Perform the actual draws
-            for line in reversed(lines_to_draw):
-                self.draw_text_line(line, label_pos_x, label_color, label_draw, label_draw_text_anchor)
+            if region is None:
+                label_image = self.draw_label_image(label.layout, label.image_size, label.anchor, label.draw_text_anchor, label_color)
+            elif is_label_in_region(label.image_size, label.image_rect, region):
+                label_image = label_image_cache.get_or_create((label.layout_key, label.image_size, label.anchor, label_color), lambda: self.draw_label_image(
+                    label.layout, label.image_size, label.anchor, label.draw_text_anchor, label_color))
+            else:
+                continue
 
             # Paste the resulting label into the actual map image
-            label_paste_pos = calculate_zone_label_paste_position(label_anchor, label_image, label_image_rect)
-            image.paste(label_image, label_paste_pos, label_image)
+            label_paste_pos = calculate_zone_label_paste_position(label.anchor, label_image, label.image_rect)
+            image.paste(label_image, (label_paste_pos[0] - origin[0], label_paste_pos[1] - origin[1]), label_image)
+
+    def get_zone_label(self, zone: dict, zone_image_rect: tuple[tuple[float, float], tuple[float, float]], map_coord: MapCoordinateSystem,
+                       scale_factor: float) -> ZoneLabel:
+        # Choose the fonts to draw the label with
+        settings = self.category_settings[zone['category']]
+        label_size_multiplier = scale_factor * (zone['label_size'] if 'label_size' in zone else 0.8 if settings['special'] else 1)
+        main_label_font_size = get_main_label_font_size(map_coord, label_size_multiplier)
+        main_label_font = get_font(main_label_font_size, True, False)
+        sub_label_font_size = get_sub_label_font_size(map_coord, label_size_multiplier)
+
+        # Choose the location and alignment where we want to display the zone's label (center of the zone boundary unless overridden)
+        label_anchor, label_image_rect = get_zone_pos(map_coord, zone, zone_image_rect)
+
+        # Find the maximum size of the label, which bounds its line wrapping
+        zone_name_label_bbox = get_text_draw_bbox(main_label_font, zone['name'])
+        max_label_image_size = (max(250, round(zone_name_label_bbox[2] + 10), round(2 * label_image_rect[1][0] + 20)),
+                                max(250, round(10 * zone_name_label_bbox[3] + 10), round(2 * label_image_rect[1][1] + 20)))
+        label_draw_text_anchor = label_anchor[0] + 'a'
+
+        # Lay out the label's lines, unless an identical label has been laid out already
+        label_layout_key = ('zone', self.show_access_requirements, zone['name'], settings['label'], settings['show_level'], zone.get('min_level'), zone.get('max_level'),
+                            zone.get('access_req'), main_label_font_size, sub_label_font_size, label_draw_text_anchor, label_image_rect[1][0] - label_image_rect[0][0],
+                            label_image_rect[1][1] - label_image_rect[0][1], max_label_image_size, get_zoom_size_multiplier(map_coord, 2 * scale_factor))
+        label_layout = label_layout_cache.get_or_create(label_layout_key, lambda: self.create_label_layout(
+            zone, settings, main_label_font_size, sub_label_font_size, label_draw_text_anchor, label_image_rect, max_label_image_size, map_coord, scale_factor))
+        label_image_size = get_label_image_size(label_anchor, max_label_image_size, label_layout.text_bbox)
+        return ZoneLabel(label_layout_key, label_layout, label_anchor, label_draw_text_anchor, label_image_rect, label_image_size)
+
+    def draw_label_image(self, label_layout: LabelLayout, label_image_size: tuple[int, int], label_anchor, label_draw_text_anchor, label_color) -> Image.Image:
+        # Create a temporary image just large enough to draw the label in, so that we can easily center it in the final map regardless of line count
+        label_image = Image.new('RGBA', label_image_size, (255, 255, 255, 0))
+        label_draw = ImageDraw.Draw(label_image, 'RGBA')
+        label_pos_x = label_image.size[0] / 2 if label_anchor[0] == 'm' else 2 if label_anchor[0] == 'l' else label_image.size[0] - 2
+
+        # Perform the actual draws, in reverse order to keep earlier lines on top
+        for line in reversed(label_layout.lines):
+            self.draw_text_line(line, label_pos_x, label_color, label_draw, label_draw_text_anchor)
+        return label_image
+
+    def create_label_layout(self, zone, settings, main_label_font_size, sub_label_font_size, label_draw_text_anchor, label_image_rect, max_label_image_size,
+                            map_coord, scale_factor) -> LabelLayout:
+        main_label_font = get_font(main_label_font_size, True, False)
+        main_label_line_margin = main_label_font_size // 8
+        main_label_outline_width = get_text_outline_width(main_label_font_size)
+        sub_label_font = get_font(sub_label_font_size, False, True)
+        sub_label_line_margin = sub_label_font_size // -8
+        sub_label_outline_width = get_text_outline_width(sub_label_font_size)
+
+        lines: list[TextLine] = []
+
+        # Find the ideal line wrapping for the zone's name and shape
+        wrapped_zone_name_lines = wrap_label(zone['name'], main_label_font, main_label_line_margin, label_image_rect, max_label_image_size, map_coord, scale_factor)
+
+        # Lay out the label for the zone name
+        label_pos_y = 0
+        for line in wrapped_zone_name_lines:
+            lines.append(TextLine([TextLineSegment(line)], label_pos_y, main_label_font_size, True, False, main_label_outline_width))
+            label_pos_y = label_pos_y + main_label_font.getmetrics()[0] + main_label_line_margin
+        label_pos_y = label_pos_y + max(0, main_label_font.getmetrics()[1] - main_label_line_margin)
+
+        wrapped_sub_label_lines = self.get_sub_label_lines(zone, settings, sub_label_font, sub_label_line_margin, label_image_rect, max_label_image_size, map_coord,
+                                                           scale_factor)
+        for text_lines in wrapped_sub_label_lines:
+            lines.append(TextLine(text_lines, label_pos_y, sub_label_font_size, False, True, sub_label_outline_width))
+            label_pos_y = label_pos_y + sum(sub_label_font.getmetrics()) + sub_label_line_margin
+
+        text_bbox = get_text_bbox([self.get_text_line_bbox(line, label_draw_text_anchor) for line in lines])
+        return LabelLayout(lines, text_bbox)
 
     def get_sub_label_lines(self, zone, settings, font, label_margin, label_image_rect, label_image_size, map_coord, scale_factor) -> list[list[TextLineSegment]]:
         type_text = None
@@ -293,6 +324,21 @@ class ZoneMapOverlay(MapOverlay):
                             font=line.font, anchor=anchor, align='center', stroke_width=line.outline_width, fill=color, stroke_fill='black')
             pos_x_offset = pos_x_offset + line.font.getlength(segment.text)
 
+    @staticmethod
+    def get_text_line_bbox(line: TextLine, label_draw_text_anchor) -> tuple[float, float, float, float]:
+        """Returns the bbox of the text line as drawn by draw_text_line, relative to the label's horizontal position."""
+        h_align = label_draw_text_anchor[0]
+        anchor = 'l' + label_draw_text_anchor[1:]
+        full_line_length = line.font.getlength(''.join(t.text for t in line.text_segments))
+        pos_x_offset = 0 if h_align == 'l' else -full_line_length / 2 if h_align == 'm' else -full_line_length
+
+        segment_bboxes = []
+        for segment in line.text_segments:
+            bbox = line.font.getbbox(segment.text, stroke_width=line.outline_width, anchor=anchor)
+            segment_bboxes.append((pos_x_offset + bbox[0], line.pos_y + bbox[1], pos_x_offset + bbox[2], line.pos_y + bbox[3]))
+            pos_x_offset = pos_x_offset + line.font.getlength(segment.text)
+        return get_text_bbox(segment_bboxes)
+
     def draw_legend(self, image: Image.Image, map_layout: MapLayout, map_coord: MapCoordinateSystem, scale_factor: float):
         font = get_font(get_legend_font_size(map_coord, scale_factor))
         icon_size = get_icon_size(map_coord, scale_factor)
@@ -324,10 +370,18 @@ class ZoneMapOverlay(MapOverlay):
         legend_draw.rectangle(legend_coord, fill=(0, 0, 0, 160), width=get_line_width(map_coord, scale_factor), outline=(255, 255, 255, 160))
         image.paste(legend_image, legend_coord, legend_image)
 
+    @cache
+    def get_portal_template_icons(self) -> dict[str, Image.Image]:
+        # Download all the portal icons in parallel on first use, instead of one by one
+        return dict(zip(self.portal_settings, load_images([settings['icon_url'] for settings in self.portal_settings.values()])))
+
+    def get_portal_template_icon(self, portal_type: str) -> Image.Image:
+        return self.get_portal_template_icons()[portal_type]
+
     @cache
     def get_portal_icon(self, portal_type: str, icon_size: int):
         if '/' not in portal_type:
-            template_icon = self.portal_settings[portal_type]['icon']
+            template_icon = self.get_portal_template_icon(portal_type)
             return template_icon.resize((icon_size, icon_size), resample=Image.Resampling.LANCZOS)
         else:
             # Blend multiple icons together so that they're all at least partially visible despite overlapping
@@ -335,7 +389,7 @@ class ZoneMapOverlay(MapOverlay):
             portal_types = portal_type.split('/')
             arc_angle = 360 / len(portal_types)
             for i, t in enumerate(portal_types):
-                template_icon = self.portal_settings[t]['icon']
+                template_icon = self.get_portal_template_icon(t)
                 resized_icon = template_icon.resize((icon_size, icon_size), resample=Image.Resampling.LANCZOS)
                 start_angle = i * arc_angle - 90
                 end_angle = (i + 1) * arc_angle - 90
@@ -344,21 +398,7 @@ class ZoneMapOverlay(MapOverlay):
                 blended_icon = Image.composite(blended_icon, resized_icon, mask)
             return blended_icon
 
-    def draw_portal_connection_line(self, map_image, portal1_image_coord, portal2_image_coord, portal_type, map_coord, scale_factor):
-        """Draws the line between two connected far-away portals, with super-sampling for simple, if inefficient, antialiasing."""
-        margin = math.ceil(max(1, get_zoom_size_multiplier(map_coord, scale_factor)))
-        super_sampling_factor = 4
-        line_rect = abs(portal1_image_coord[0] - portal2_image_coord[0]), abs(portal1_image_coord[1] - portal2_image_coord[1])
-        paste_coord = min(portal1_image_coord[0], portal2_image_coord[0]) - margin, min(portal1_image_coord[1], portal2_image_coord[1]) - margin
-        super_sampled_image_size = super_sampling_factor * (line_rect[0] + 2 * margin), super_sampling_factor * (line_rect[1] + 2 * margin)
-        super_sampled_image = Image.new('RGBA', super_sampled_image_size)
-        super_sampled_draw = ImageDraw.Draw(super_sampled_image)
-
+    def draw_portal_connection_line(self, map_image: Image.Image | SparseImageLayer, portal1_image_coord, portal2_image_coord, portal_type, map_coord, scale_factor):
+        """Draws the line between two connected far-away portals."""
         line_color = self.portal_settings[portal_type]['line_color']
-        line_coord = ((super_sampling_factor * (portal1_image_coord[0] - paste_coord[0]), super_sampling_factor * (portal1_image_coord[1] - paste_coord[1])),
-                      (super_sampling_factor * (portal2_image_coord[0] - paste_coord[0]), super_sampling_factor * (portal2_image_coord[1] - paste_coord[1])))
-        super_sampled_draw.line(line_coord, fill=line_color, width=super_sampling_factor * get_line_width(map_coord, scale_factor))
-
-        resized_size = line_rect[0] + 2 * margin, line_rect[1] + 2 * margin
-        smooth_line_image = super_sampled_image.resize(resized_size, resample=Image.Resampling.LANCZOS)
-        map_image.paste(smooth_line_image, paste_coord, smooth_line_image)
+        draw_antialiased_line(map_image, portal1_image_coord, portal2_image_coord, line_color, get_line_width(map_coord, scale_factor))
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from mapgen.map_canvas import MapCanvas
+from mapgen.map_coordinates import MapCoordinateSystem
+
+
+class BaseRasterCache:
+    """
+    Persistent cache of finished base map images (tiles, image overlays and fractional zoom resizing, but no map overlays),
+    so that iterations on the zone data or overlays don't need to repeat any tile work.
+    The images are stored as raw NumPy arrays, which are much faster to save and load than any compressed image format.
+    The total size of the cache is capped, evicting the least recently used images first.
+    """
+
+    # Increment when the base map image generation changes, to invalidate the previously cached images
+    cache_version = 1
+
+    def __init__(self, directory: str, max_size: int):
+        """
+        :param directory: Directory to store the cached images in.
+        :param max_size: Maximum total size of the cached images in bytes. The most recently saved image is kept even if it exceeds it.
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_key(cls, tile_source_key: str, continent: int, floor: int, map_coord: MapCoordinateSystem) -> str:
+        key_data = {
+            'version': cls.cache_version,
+            'tile_source': tile_source_key,
+            'continent': continent,
+            'floor': floor,
+            'sector': [map_coord.sector_top_left, map_coord.sector_bottom_right],
+            'zoom': map_coord.zoom,
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def contains(self, key: str) -> bool:
+        return self._raster_path(key).exists()
+
+    def load(self, key: str, canvas_directory: str | None = None) -> Image.Image | MapCanvas | None:
+        """Loads the cached image, into a map canvas in the given directory if one is given, or None if it's not cached."""
+        raster_path = self._raster_path(key)
+        try:
+            # The modification time of the cached images tracks their last use for the eviction
+            os.utime(raster_path)
+        except FileNotFoundError:
+            return None
+        if canvas_directory is None:
+            return Image.fromarray(np.load(raster_path))
+
+        # Copy the cached image into the canvas one strip at a time, instead of loading all of it into memory
+        raster_array = np.load(raster_path, mmap_mode='r')
+        canvas = MapCanvas((raster_array.shape[1], raster_array.shape[0]), canvas_directory)
+        for top, bottom in canvas.get_strip_rows():
+            canvas.paste(Image.fromarray(np.array(raster_array[top:bottom])), (0, top))
+        del raster_array
+        return canvas
+
+    def save(self, key: str, image: Image.Image | MapCanvas):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        raster_path = self._raster_path(key)
+        temp_path = raster_path.with_name(f'{raster_path.stem}.{threading.get_ident()}.tmp.npy')
+        if isinstance(image, MapCanvas):
+            # Write the same file as np.save would, one strip of the canvas at a time
+            with open(temp_path, 'wb') as f:
+                header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)), 'fortran_order': False, 'shape': (image.size[1], image.size[0], 3)}
+                np.lib.format.write_array_header_1_0(f, header)
+                for _, strip_image in image.strips():
+                    f.write(np.asarray(strip_image).tobytes())
+        else:
+            np.save(temp_path, np.asarray(image))
+        os.replace(temp_path, raster_path)
+        self._evict(raster_path)
+
+    def _evict(self, saved_path: Path):
+        with self._lock:
+            raster_stats = []
+            for raster_path in self.directory.glob('*.npy'):
+                if raster_path.name.endswith('.tmp.npy'):
+                    continue
+                try:
+                    raster_stats.append((raster_path, raster_path.stat()))
+                except FileNotFoundError:
+                    continue
+
+            total_size = sum(raster_stat.st_size for _, raster_stat in raster_stats)
+            for raster_path, raster_stat in sorted(raster_stats, key=lambda item: item[1].st_mtime_ns):
+                if total_size <= self.max_size:
+                    break
+                if raster_path == saved_path:
+                    continue
+                try:
+                    raster_path.unlink()
+                except OSError as e:
+                    print(f"Warning: Failed to evict cached base map image {raster_path}: {e}")
+                    continue
+                total_size -= raster_stat.st_size
+
+    def _raster_path(self, key: str) -> Path:
+        return self.directory / f'{key}.npy'
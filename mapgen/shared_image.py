@@ -0,0 +1,40 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+
+class SharedImage:
+    """
+    Image stored in shared memory, so that worker processes can access it without it being pickled and copied for each of them.
+    Only a handle (the shared memory name, mode and size) is pickled when passing the shared image to another process.
+    """
+
+    def __init__(self, image: Image.Image):
+        if image.mode != 'RGB':
+            raise ValueError(f"Only RGB images can be shared, got {image.mode}.")
+        self.mode = image.mode
+        self.size = image.size
+        self._shared_memory = SharedMemory(create=True, size=image.size[0] * image.size[1] * 3)
+        self._owner = True
+        np.ndarray((image.size[1], image.size[0], 3), dtype=np.uint8, buffer=self._shared_memory.buf)[:] = np.asarray(image)
+
+    def __getstate__(self):
+        return {'name': self._shared_memory.name, 'mode': self.mode, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.mode = state['mode']
+        self.size = state['size']
+        # The creating process is responsible for freeing the shared memory, so don't track it in the worker processes
+        self._shared_memory = SharedMemory(name=state['name'], track=False)
+        self._owner = False
+
+    def copy(self) -> Image.Image:
+        """Returns a private, writable copy of the image."""
+        return Image.frombuffer(self.mode, self.size, self._shared_memory.buf, 'raw', self.mode, 0, 1).copy()
+
+    def close(self):
+        """Releases the shared memory in this process, and frees it entirely if called by the process which created it."""
+        self._shared_memory.close()
+        if self._owner:
+            self._shared_memory.unlink()
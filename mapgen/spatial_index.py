@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+from data.portals import portals
+
+Rect = tuple[tuple[float, float], tuple[float, float]]
+
+
+class GridIndex:
+    """
+    Uniform grid index of rects in continent coordinates, for finding the features (zones, portals) within a sector
+    without going through all of them. Items are identified by their index in the list of rects the grid was built from.
+    """
+
+    def __init__(self, rects: list[Rect], cell_size: int = 4096):
+        self.cell_size = cell_size
+        self.rects = rects
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        for i, rect in enumerate(rects):
+            for cell in self._get_cells(rect):
+                self._cells.setdefault(cell, []).append(i)
+
+    def query(self, rect: Rect) -> list[int]:
+        """Returns the indices of the rects intersecting the given rect, in the order they were given in."""
+        found = set()
+        for cell in self._get_cells(rect):
+            found.update(self._cells.get(cell, ()))
+        return sorted(i for i in found if self._intersects(self.rects[i], rect))
+
+    def _get_cells(self, rect: Rect):
+        (x0, y0), (x1, y1) = rect
+        for cell_x in range(int(min(x0, x1) // self.cell_size), int(max(x0, x1) // self.cell_size) + 1):
+            for cell_y in range(int(min(y0, y1) // self.cell_size), int(max(y0, y1) // self.cell_size) + 1):
+                yield cell_x, cell_y
+
+    @staticmethod
+    def _intersects(rect1: Rect, rect2: Rect) -> bool:
+        return (min(rect1[0][0], rect1[1][0]) <= max(rect2[0][0], rect2[1][0]) and min(rect2[0][0], rect2[1][0]) <= max(rect1[0][0], rect1[1][0]) and
+                min(rect1[0][1], rect1[1][1]) <= max(rect2[0][1], rect2[1][1]) and min(rect2[0][1], rect2[1][1]) <= max(rect1[0][1], rect1[1][1]))
+
+
+# Indices of the most recently used zone data lists, holding a reference to each list so that its id can't be reused while cached
+_zone_indices: OrderedDict[int, tuple[list[dict], int, GridIndex]] = OrderedDict()
+_max_zone_indices = 16
+
+
+def get_zone_index(zone_data: list[dict]) -> GridIndex:
+    """Returns the index of the zones' continent rects, built once per zone data list, e.g. once per overlay and language for all sectors."""
+    cached = _zone_indices.get(id(zone_data))
+    if cached is not None and cached[0] is zone_data and cached[1] == len(zone_data):
+        _zone_indices.move_to_end(id(zone_data))
+        return cached[2]
+
+    zone_index = GridIndex([zone['continent_rect'] for zone in zone_data])
+    _zone_indices[id(zone_data)] = (zone_data, len(zone_data), zone_index)
+    while len(_zone_indices) > _max_zone_indices:
+        _zone_indices.popitem(last=False)
+    return zone_index
+
+
+def get_zones_in_rect(zone_data: list[dict], rect: Rect) -> list[dict]:
+    """Returns the zones whose continent rect intersects the given rect, in the order of the zone data."""
+    return [zone_data[i] for i in get_zone_index(zone_data).query(rect)]
+
+
+_portal_indices: dict[str, GridIndex] = {}
+
+
+def get_portals_in_rect(portal_type: str, rect: Rect) -> list[tuple]:
+    """Returns the portals of the given type with an endpoint, or a connection line, within the given rect, in the order of the portal data."""
+    portal_index = _portal_indices.get(portal_type)
+    if portal_index is None:
+        portal_index = _portal_indices[portal_type] = GridIndex([((p[1], p[2]), (p[-2], p[-1])) for p in portals[portal_type]])
+    return [portals[portal_type][i] for i in portal_index.query(rect)]
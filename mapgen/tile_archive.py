@@ -0,0 +1,129 @@
+import io
+import mmap
+import os
+import struct
+import sys
+from pathlib import Path
+
+from mapgen.tile_cache import TileKey
+
+# Tile archive format, packing a whole tile directory into a single file:
+# - header: magic bytes, format version and number of tiles,
+# - index: for each tile its continent, floor, zoom, x, y, and the offset and length of its image in the file,
+# - data: the encoded tile images, concatenated.
+archive_magic = b'GW2TILES'
+archive_version = 1
+header_struct = struct.Struct('<8sII')
+index_entry_struct = struct.Struct('<HhBIIQI')
+
+
+class MemoryViewReader(io.RawIOBase):
+    """Read-only file object over a memory view, so that the tile bytes can be decoded straight from the memory-mapped archive."""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self.view = view
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self.position = offset
+            case io.SEEK_CUR:
+                self.position += offset
+            case io.SEEK_END:
+                self.position = len(self.view) + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+
+class TileArchive:
+    """Memory-mapped tile archive created by pack_tile_directory."""
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        with open(archive_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, tile_count = header_struct.unpack_from(self._mmap, 0)
+        if magic != archive_magic:
+            raise ValueError(f"File {archive_path} is not a tile archive.")
+        if version != archive_version:
+            raise ValueError(f"Unsupported tile archive version {version} in {archive_path}, expected {archive_version}.")
+
+        self._index: dict[TileKey, tuple[int, int]] = {}
+        for i in range(tile_count):
+            continent, floor, zoom, x, y, offset, length = index_entry_struct.unpack_from(self._mmap, header_struct.size + i * index_entry_struct.size)
+            self._index[(continent, floor, zoom, x, y)] = (offset, length)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key: TileKey):
+        return key in self._index
+
+    def get_tile_bytes(self, key: TileKey) -> memoryview:
+        """Returns the encoded image of the given tile as a view into the archive, without copying it."""
+        offset, length = self._index[key]
+        return self._view[offset:offset + length]
+
+    def open_tile(self, key: TileKey) -> MemoryViewReader:
+        return MemoryViewReader(self.get_tile_bytes(key))
+
+
+def find_tile_files(input_directory: str) -> list[tuple[TileKey, Path]]:
+    """Finds all tile images in a directory structured as {continent}/{floor}/{zoom}/{x}/{y}.jpg, such as that_shaman's tiles."""
+    tile_files = []
+    for tile_path in Path(input_directory).glob('*/*/*/*/*.jpg'):
+        parts = tile_path.relative_to(input_directory).with_suffix('').parts
+        try:
+            tile_key = tuple(int(p) for p in parts)
+        except ValueError:
+            continue
+        tile_files.append((tile_key, tile_path))
+    tile_files.sort()
+    return tile_files
+
+
+def pack_tile_directory(input_directory: str, archive_path: str):
+    """Packs all tiles of a tile directory into a single tile archive."""
+    tile_files = find_tile_files(input_directory)
+    if not tile_files:
+        raise FileNotFoundError(f"No tiles found in directory {input_directory}.")
+
+    tile_sizes = [os.path.getsize(tile_path) for _, tile_path in tile_files]
+    offset = header_struct.size + len(tile_files) * index_entry_struct.size
+
+    temp_path = f'{archive_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(header_struct.pack(archive_magic, archive_version, len(tile_files)))
+        for (tile_key, _), tile_size in zip(tile_files, tile_sizes):
+            f.write(index_entry_struct.pack(*tile_key, offset, tile_size))
+            offset += tile_size
+        for _, tile_path in tile_files:
+            f.write(tile_path.read_bytes())
+    os.replace(temp_path, archive_path)
+
+    print(f"Packed {len(tile_files)} tiles ({sum(tile_sizes) / 2 ** 20:.1f} MiB) from {input_directory} into {archive_path}.")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python -m mapgen.tile_archive <tiles directory> <archive path>")
+        sys.exit(1)
+    pack_tile_directory(sys.argv[1], sys.argv[2])
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+TileKey = tuple[int, int, int, int, int]  # (continent, floor, zoom, x, y)
+
+
+@dataclass
+class TileCacheEntry:
+    size: int
+    etag: str | None
+    last_modified: str | None
+    fetched_at: float
+    missing: bool = False  # the tile doesn't exist in the tile service, which is cached like an existing tile but without a file
+
+
+class TileCache:
+    """
+    Persistent on-disk cache of encoded map tile images, keyed by continent, floor, zoom and tile coordinates.
+    The tiles are stored exactly as received from the tile service, together with their ETag and Last-Modified validators,
+    so that stale tiles can be revalidated with a cheap conditional request instead of being downloaded again.
+    Tiles which don't exist in the tile service, outside of the map's art, are cached as well, so that warm runs don't request them again.
+    The total size of the cache is capped, evicting the least recently used tiles first.
+    """
+
+    index_file_name = 'index.json'
+
+    def __init__(self, directory: str, max_size: int, max_age: float):
+        """
+        :param directory: Directory to store the cached tiles in.
+        :param max_size: Maximum total size of the cached tiles in bytes.
+        :param max_age: Number of seconds for which a cached tile is used without revalidation.
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, TileCacheEntry] = OrderedDict()  # least recently used first
+        self._total_size = 0
+        self._load_index()
+
+    def get(self, key: TileKey) -> tuple[bytes, TileCacheEntry] | None:
+        """
+        Returns the cached tile bytes and their cache entry, or None if the tile is not cached or its file is missing or truncated.
+        The bytes of a tile cached as missing are empty.
+        """
+        entry_key = self._entry_key(key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(entry_key)
+
+        data = b''
+        if not entry.missing:
+            try:
+                data = self._tile_path(entry_key).read_bytes()
+            except FileNotFoundError:
+                data = None
+            if data is None or len(data) != entry.size:
+                with self._lock:
+                    self._remove_entry(entry_key)
+                return None
+
+        if self.is_fresh(entry):
+            with self._lock:
+                self.hits += 1
+        return data, entry
+
+    def is_fresh(self, entry: TileCacheEntry) -> bool:
+        return time.time() - entry.fetched_at < self.max_age
+
+    def put(self, key: TileKey, data: bytes, etag: str | None, last_modified: str | None):
+        entry_key = self._entry_key(key)
+        tile_path = self._tile_path(entry_key)
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = tile_path.with_name(f'{tile_path.name}.{threading.get_ident()}.tmp')
+        temp_path.write_bytes(data)
+        os.replace(temp_path, tile_path)
+
+        with self._lock:
+            self._remove_entry(entry_key)
+            self._entries[entry_key] = TileCacheEntry(len(data), etag, last_modified, time.time())
+            self._total_size += len(data)
+            self.misses += 1
+            self._evict()
+
+    def put_missing(self, key: TileKey):
+        """Caches that the tile doesn't exist in the tile service."""
+        entry_key = self._entry_key(key)
+        self._tile_path(entry_key).unlink(missing_ok=True)
+        with self._lock:
+            self._remove_entry(entry_key)
+            self._entries[entry_key] = TileCacheEntry(0, None, None, time.time(), True)
+            self.misses += 1
+
+    def refresh(self, key: TileKey):
+        """Marks a cached tile as fresh again, after the tile service confirmed it has not changed."""
+        with self._lock:
+            entry = self._entries.get(self._entry_key(key))
+            if entry is not None:
+                entry.fetched_at = time.time()
+            self.revalidations += 1
+
+    def save_index(self):
+        with self._lock:
+            index = {k: [e.size, e.etag, e.last_modified, e.fetched_at, e.missing] for k, e in self._entries.items()}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        index_path = self.directory / self.index_file_name
+        temp_path = index_path.with_name(f'{index_path.name}.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(temp_path, index_path)
+
+    def get_stats_text(self) -> str:
+        return (f"Tile cache: {self.hits} hits, {self.revalidations} revalidated, {self.misses} misses, "
+                f"{len(self._entries)} tiles ({self._total_size / 2 ** 20:.1f} MiB) cached.")
+
+    def _load_index(self):
+        index_path = self.directory / self.index_file_name
+        if not index_path.exists():
+            return
+
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        for entry_key, entry_fields in index.items():
+            entry = self._entries[entry_key] = TileCacheEntry(*entry_fields)
+            self._total_size += entry.size
+        self._evict()
+
+    def _evict(self):
+        while self._total_size > self.max_size and self._entries:
+            entry_key = next(iter(self._entries))
+            self._remove_entry(entry_key)
+            self._tile_path(entry_key).unlink(missing_ok=True)
+
+    def _remove_entry(self, entry_key: str):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._total_size -= entry.size
+
+    def _tile_path(self, entry_key: str) -> Path:
+        return self.directory / f'{entry_key}.jpg'
+
+    @staticmethod
+    def _entry_key(key: TileKey) -> str:
+        return '/'.join(str(k) for k in key)
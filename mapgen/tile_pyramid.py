@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from mapgen.map_canvas import MapCanvas
+from mapgen.map_coordinates import MapCoordinateSystem, tile_image_size, zoom_factor
+
+
+class TilePyramidWriter:
+    """
+    Writes a rendered single sector map as a deep-zoom pyramid of square tiles, in the same zoom/x/y directory structure as the map tiles themselves.
+    Only the highest zoom level is rendered, each level below it is downsampled from the level above. The tiles are aligned to the tile grid
+    of the sector's continent, so that they line up with the continent's map tiles.
+    The hashes of the pixels of the written tiles are kept in a manifest in the pyramid directory, so that the following builds don't encode
+    and write again the tiles whose pixels haven't changed, keeping their files untouched for incremental uploads. The map is still rendered
+    in full, skipping the rendering of maps whose inputs haven't changed is up to the build manifest.
+    """
+
+    # Increment when the tile pyramid layout changes, to rewrite all the tiles written by previous versions
+    manifest_version = 1
+    manifest_file_name = 'tiles.json'
+    # Number of pixels in each horizontal strip a level is downsampled in, the strip height depends on the level width
+    strip_pixels = 2 ** 22
+
+    def __init__(self, directory: str, file_extension: str, min_zoom: int, canvas_directory: str | None = None):
+        """
+        :param directory: Directory to write the pyramid's zoom level directories and manifest to.
+        :param file_extension: File extension of the tile images, determining their format.
+        :param min_zoom: Lowest zoom level of the pyramid.
+        :param canvas_directory: Directory to create the downsampled levels of map canvases in, as map canvases themselves.
+        """
+        self.directory = directory
+        self.file_extension = file_extension
+        self.min_zoom = min_zoom
+        self.canvas_directory = canvas_directory
+        self._tile_hashes: dict[str, str] = {}
+        self._previous_tile_hashes: dict[str, str] = {}
+
+    def write(self, image: Image.Image | MapCanvas, map_coord: MapCoordinateSystem, part_top_left: tuple[int, int]):
+        """
+        Writes the pyramid of the map image of a single sector, rendered at the integer zoom level of its map coordinate system,
+        with the sector placed at the given position in the image.
+        """
+        if map_coord.zoom != map_coord.with_int_zoom().zoom:
+            raise ValueError(f"Tile pyramids can only be written from integer zoom levels, got {map_coord.zoom}.")
+        # Validates the minimum zoom against the continent's zoom levels
+        MapCoordinateSystem(map_coord.map_params, self.min_zoom, map_coord.sector)
+
+        self._load_manifest()
+        sector_image_coord = map_coord.continent_to_full_image_coord(map_coord.sector_top_left)
+        level_origin = (sector_image_coord[0] - part_top_left[0], sector_image_coord[1] - part_top_left[1])
+        level_image = image
+        for zoom in range(int(map_coord.zoom), self.min_zoom - 1, -1):
+            if zoom < map_coord.zoom:
+                reduced_image, level_origin = self.downsample_level(level_image, level_origin)
+                if level_image is not image and isinstance(level_image, MapCanvas):
+                    level_image.close()
+                level_image = reduced_image
+            self.write_level(level_image, level_origin, zoom)
+        if level_image is not image and isinstance(level_image, MapCanvas):
+            level_image.close()
+        self._save_manifest()
+
+    def downsample_level(self, image: Image.Image | MapCanvas, origin: tuple[int, int]) -> tuple[Image.Image | MapCanvas, tuple[int, int]]:
+        """
+        Downsamples a level of the pyramid, whose top left pixel is at the given origin of the level's full image, into the level below.
+        Each pixel of the level below averages a 2x2 block of the level, aligned to the full image, so the blocks are independent
+        and the level is downsampled one strip at a time.
+        """
+        padding = (origin[0] % zoom_factor, origin[1] % zoom_factor)
+        reduced_size = (-(-(image.size[0] + padding[0]) // zoom_factor), -(-(image.size[1] + padding[1]) // zoom_factor))
+        if isinstance(image, MapCanvas):
+            reduced_image = MapCanvas(reduced_size, self.canvas_directory)
+        else:
+            reduced_image = Image.new('RGB', reduced_size)
+
+        strip_height = max(1, self.strip_pixels // image.size[0])
+        for reduced_top in range(0, reduced_size[1], strip_height):
+            reduced_bottom = min(reduced_size[1], reduced_top + strip_height)
+            strip_box = (-padding[0], zoom_factor * reduced_top - padding[1], zoom_factor * reduced_size[0] - padding[0], zoom_factor * reduced_bottom - padding[1])
+            reduced_image.paste(image.crop(strip_box).reduce(zoom_factor), (0, reduced_top))
+        return reduced_image, (origin[0] // zoom_factor, origin[1] // zoom_factor)
+
+    def write_level(self, image: Image.Image | MapCanvas, origin: tuple[int, int], zoom: int):
+        """Writes the tiles covering the level's image, whose top left pixel is at the given origin of the level's full image."""
+        first_tile = (origin[0] // tile_image_size, origin[1] // tile_image_size)
+        last_tile = ((origin[0] + image.size[0] - 1) // tile_image_size, (origin[1] + image.size[1] - 1) // tile_image_size)
+        written_tiles = skipped_tiles = 0
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            for tile_y in range(first_tile[1], last_tile[1] + 1):
+                row_left = first_tile[0] * tile_image_size - origin[0]
+                row_top = tile_y * tile_image_size - origin[1]
+                row_image = image.crop((row_left, row_top, (last_tile[0] + 1) * tile_image_size - origin[0], row_top + tile_image_size))
+                tile_x_range = range(first_tile[0], last_tile[0] + 1)
+                tile_images = [row_image.crop((i * tile_image_size, 0, (i + 1) * tile_image_size, tile_image_size)) for i in range(len(tile_x_range))]
+                for is_written in executor.map(self.write_tile, [zoom] * len(tile_x_range), tile_x_range, [tile_y] * len(tile_x_range), tile_images):
+                    if is_written:
+                        written_tiles += 1
+                    else:
+                        skipped_tiles += 1
+        print(f"Tile pyramid level {zoom}: {written_tiles} tiles written, {skipped_tiles} unchanged tiles not rewritten.")
+
+    def write_tile(self, zoom: int, tile_x: int, tile_y: int, tile_image: Image.Image) -> bool:
+        """Writes the tile unless its pixels are unchanged since the previous build, returning whether it was written."""
+        tile_key = f'{zoom}/{tile_x}/{tile_y}'
+        tile_path = os.path.join(self.directory, str(zoom), str(tile_x), f'{tile_y}.{self.file_extension}')
+        tile_hash = hashlib.sha256(tile_image.tobytes()).hexdigest()
+        self._tile_hashes[tile_key] = tile_hash
+        if self._previous_tile_hashes.get(tile_key) == tile_hash and os.path.exists(tile_path):
+            return False
+
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tile_image.save(tile_path, quality=95 if self.file_extension == 'jpg' else None)
+        return True
+
+    def _load_manifest(self):
+        manifest_path = os.path.join(self.directory, self.manifest_file_name)
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == self.manifest_version and manifest.get('file_extension') == self.file_extension:
+            self._previous_tile_hashes = manifest['tiles']
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, self.manifest_file_name)
+        temp_path = f'{manifest_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.manifest_version, 'file_extension': self.file_extension, 'tiles': self._previous_tile_hashes | self._tile_hashes}, f)
+        os.replace(temp_path, manifest_path)
@@ -0,0 +1,185 @@
+import os
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Iterable
+
+from PIL import Image
+
+from mapgen.tile_cache import TileKey
+
+
+class TileStore:
+    """
+    In-run store of tile images, keyed by continent, floor, zoom and tile coordinates, so that tiles requested multiple times in a run,
+    by overlapping bands, sectors, layouts or zoom levels rounding up to the same integer zoom, are only loaded and decoded once.
+    Only the tiles expected to be requested again are kept: decoded in memory up to the given budget, and the least recently used ones
+    beyond it as their encoded data in files on disk, up to the spill budget. Any other tiles are loaded again when requested.
+    """
+
+    def __init__(self, memory_budget: int, spill_budget: int, spill_directory: str | None = None):
+        """
+        :param memory_budget: Maximum size of the tiles kept in memory, in bytes.
+        :param spill_budget: Maximum size of the encoded tiles spilled to disk, in bytes.
+        :param spill_directory: Directory to spill the tiles exceeding the memory budget to. If None, a temporary directory is used.
+        """
+        self.memory_budget = memory_budget
+        self.spill_budget = spill_budget
+        self.hits = 0
+        self.spill_hits = 0
+        self.loads = 0
+
+        if spill_directory is None:
+            self._temp_directory = tempfile.TemporaryDirectory(prefix='gw2-tile-store-')
+            spill_directory = self._temp_directory.name
+        self.spill_directory = spill_directory
+        os.makedirs(self.spill_directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._tiles: OrderedDict[TileKey, tuple[Image.Image, bytes | None]] = OrderedDict()  # least recently used first
+        self._memory_size = 0
+        self._spilled_tiles: dict[TileKey, int] = {}  # tile key -> size of the spilled tile data
+        self._spill_size = 0
+        self._loading: dict[TileKey, Future] = {}  # tiles being loaded or spilled
+        self._remaining_requests: Counter[TileKey] = Counter()
+
+    def expect_requests(self, keys: Iterable[TileKey]):
+        """Registers tiles which will be requested, once for each occurrence of their key, so that they're kept until their last request."""
+        with self._lock:
+            self._remaining_requests.update(keys)
+
+    def get_or_load(self, key: TileKey, load_tile_data: Callable[[], bytes | None], decode_tile_data: Callable[[bytes | None], Image.Image]) -> Image.Image:
+        """
+        Returns the stored tile image, or loads its encoded data with load_tile_data and decodes it with decode_tile_data.
+        Concurrent requests for the same tile wait for a single load.
+        """
+        with self._lock:
+            if self._remaining_requests[key] > 1:
+                self._remaining_requests[key] -= 1
+            else:
+                self._remaining_requests.pop(key, None)
+            is_requested_again = key in self._remaining_requests
+
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self.hits += 1
+                if is_requested_again:
+                    self._tiles.move_to_end(key)
+                else:
+                    self._remove_tile(key)
+                    if key in self._spilled_tiles:
+                        self._remove_spilled_tile(key)
+                return tile[0]
+
+            spilled_size = self._spilled_tiles.get(key)
+            loading_future = self._loading.get(key)
+            if loading_future is None:
+                loading_future = Future()
+                self._loading[key] = loading_future
+                is_loader = True
+            else:
+                is_loader = False
+
+        if not is_loader:
+            tile_image = loading_future.result()
+            with self._lock:
+                # The last request of a tile which was being spilled while requested also removes it from disk
+                if key not in self._remaining_requests and key in self._spilled_tiles and key not in self._tiles and key not in self._loading:
+                    self._remove_spilled_tile(key)
+            return tile_image
+
+        try:
+            if spilled_size is None:
+                tile_data = load_tile_data()
+            elif spilled_size == 0:
+                tile_data = None
+            else:
+                with open(self._spill_path(key), 'rb') as f:
+                    tile_data = f.read()
+            tile_image = decode_tile_data(tile_data)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            loading_future.set_exception(e)
+            raise
+
+        with self._lock:
+            if spilled_size is not None:
+                self.spill_hits += 1
+            else:
+                self.loads += 1
+            del self._loading[key]
+            spilled_tiles = []
+            if key in self._remaining_requests:
+                self._tiles[key] = (tile_image, tile_data)
+                self._memory_size += self._get_tile_size(tile_image, tile_data)
+                spilled_tiles = self._evict()
+            elif spilled_size is not None:
+                self._remove_spilled_tile(key)
+
+        loading_future.set_result(tile_image)
+        self._spill(spilled_tiles)
+        return tile_image
+
+    def get_stats_text(self) -> str:
+        return (f"Tile store: {self.hits} reused from memory, {self.spill_hits} reused from disk, {self.loads} loaded, "
+                f"{len(self._tiles)} tiles ({self._memory_size / 2 ** 20:.0f} MiB) in memory, "
+                f"{len(self._spilled_tiles)} ({self._spill_size / 2 ** 20:.0f} MiB) on disk.")
+
+    def _evict(self) -> list[tuple[TileKey, Image.Image, bytes | None, Future]]:
+        """
+        Evicts the least recently used tiles exceeding the memory budget, returning the ones to spill. Tiles being spilled are
+        registered as loading, so that concurrent requests for them wait for the spill instead of loading them again.
+        """
+        spilled_tiles = []
+        while self._memory_size > self.memory_budget and self._tiles:
+            key = next(iter(self._tiles))
+            tile_image, tile_data = self._tiles[key]
+            self._remove_tile(key)
+            if key in self._spilled_tiles:
+                continue
+            spilled_size = len(tile_data) if tile_data is not None else 0
+            if self._spill_size + spilled_size > self.spill_budget:
+                continue
+            self._spilled_tiles[key] = spilled_size
+            self._spill_size += spilled_size
+            spilling_future = self._loading[key] = Future()
+            spilled_tiles.append((key, tile_image, tile_data, spilling_future))
+        return spilled_tiles
+
+    def _spill(self, spilled_tiles: list[tuple[TileKey, Image.Image, bytes | None, Future]]):
+        for key, tile_image, tile_data, spilling_future in spilled_tiles:
+            # Tiles which don't exist have no data, and only need to be registered as spilled
+            try:
+                if tile_data is not None:
+                    spill_path = self._spill_path(key)
+                    temp_path = f'{spill_path}.{threading.get_ident()}.tmp'
+                    with open(temp_path, 'wb') as f:
+                        f.write(tile_data)
+                    os.replace(temp_path, spill_path)
+            except OSError as e:
+                print(f"Warning: Failed to spill tile {key} to {self.spill_directory}: {e}")
+                with self._lock:
+                    self._spill_size -= self._spilled_tiles.pop(key)
+            finally:
+                with self._lock:
+                    del self._loading[key]
+                spilling_future.set_result(tile_image)
+
+    def _remove_tile(self, key: TileKey):
+        tile_image, tile_data = self._tiles.pop(key)
+        self._memory_size -= self._get_tile_size(tile_image, tile_data)
+
+    def _remove_spilled_tile(self, key: TileKey):
+        spilled_size = self._spilled_tiles.pop(key)
+        self._spill_size -= spilled_size
+        if spilled_size:
+            os.remove(self._spill_path(key))
+
+    def _spill_path(self, key: TileKey) -> str:
+        return os.path.join(self.spill_directory, '_'.join(str(k) for k in key) + '.jpg')
+
+    @staticmethod
+    def _get_tile_size(tile_image: Image.Image, tile_data: bytes | None) -> int:
+        return tile_image.size[0] * tile_image.size[1] * len(tile_image.getbands()) + (len(tile_data) if tile_data is not None else 0)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from mapgen.overlay.overlay_util import add_stroke_around_alpha, create_stroke_stamp
+
+
+def add_stroke_around_alpha_reference(image, stroke_width=1, stroke_color=(0, 0, 0, 255), alpha_threshold=64):
+    """Previous implementation of add_stroke_around_alpha, stamping the stroke point by point, to compare against."""
+    image_array = np.asarray(image)
+    input_alpha = image_array[..., 3]
+    output_alpha = np.zeros(np.array(input_alpha.shape) + 2 * stroke_width, dtype=float)
+
+    stamp = create_stroke_stamp(stroke_width)
+    stamp_size = np.size(stamp, 0)
+    for i in range(np.size(input_alpha, 0)):
+        for j in range(np.size(input_alpha, 1)):
+            if input_alpha[i, j] >= alpha_threshold:
+                output_slice = output_alpha[i:i + stamp_size, j:j + stamp_size]
+                np.add(output_slice, stamp, out=output_slice)
+
+    np.clip(output_alpha, 0, 1, out=output_alpha)
+    output_array = np.full(image_array.shape + np.array((2 * stroke_width, 2 * stroke_width, 0)), stroke_color, dtype=float)
+    output_array[..., 3] *= output_alpha
+    output_stroke = Image.fromarray(output_array.round().astype(np.uint8))
+
+    extended_image = Image.new('RGBA', output_stroke.size)
+    extended_image.paste(image, (stroke_width, stroke_width), image)
+    composite_image = Image.alpha_composite(output_stroke, extended_image)
+    return composite_image.crop(composite_image.getbbox())
+
+
+def create_shape_image() -> Image.Image:
+    """Creates a transparent image with anti-aliased shapes of partial alpha, similar to the zone labels, touching the image borders."""
+    image = Image.new('RGBA', (96, 64))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((10, 8, 50, 40), fill=(255, 255, 255, 255))
+    draw.line((0, 63, 95, 20), fill=(200, 180, 40, 160), width=3)
+    draw.polygon(((60, 0), (95, 10), (70, 30)), fill=(30, 90, 220, 70))
+    draw.point([(5, 5), (90, 60)], fill=(255, 0, 0, 64))
+    draw.point([(20, 55), (80, 50)], fill=(0, 255, 0, 63))
+    # Downsample to get the anti-aliased alpha edges of the rendered text
+    return image.resize((48, 32), Image.Resampling.LANCZOS)
+
+
+def create_random_image() -> Image.Image:
+    rng = np.random.default_rng(0)
+    image_array = rng.integers(0, 256, (40, 30, 4), dtype=np.uint8)
+    image_array[..., 3] = np.where(rng.random((40, 30)) < 0.95, 0, image_array[..., 3])
+    return Image.fromarray(image_array)
+
+
+def create_empty_alpha_image() -> Image.Image:
+    """Creates an image with color, but an empty alpha channel."""
+    return Image.new('RGBA', (32, 24), (255, 128, 0, 0))
+
+
+@pytest.mark.parametrize('stroke_width', [1, 2, 3, 5])
+@pytest.mark.parametrize('create_image', [create_shape_image, create_random_image, create_empty_alpha_image])
+def test_stroke_matches_reference(create_image, stroke_width):
+    image = create_image()
+    result = add_stroke_around_alpha(image, stroke_width)
+    reference_result = add_stroke_around_alpha_reference(image, stroke_width)
+
+    assert result.size == reference_result.size
+    assert result.getchannel('A').tobytes() == reference_result.getchannel('A').tobytes()
+    assert result.tobytes() == reference_result.tobytes()
+
+
+@pytest.mark.parametrize('stroke_width', [1, 2, 3, 5])
+def test_stroke_color_matches_reference(stroke_width):
+    image = create_shape_image()
+    stroke_color = (250, 20, 130, 200)
+    result = add_stroke_around_alpha(image, stroke_width, stroke_color)
+    reference_result = add_stroke_around_alpha_reference(image, stroke_width, stroke_color)
+
+    assert result.size == reference_result.size
+    assert result.tobytes() == reference_result.tobytes()
@@ -0,0 +1,172 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+
+import pytest
+import requests
+from PIL import Image
+
+from mapgen.map_generator import TileApiMapTileSource
+from mapgen.tile_cache import TileCache
+
+missing_tile_x = 404
+failing_tile_x = 500
+
+
+class TileServer:
+    """Local stand-in of the tile service, serving a tile of a single color per position, with ETags, 404 for missing tiles and 500 for failing ones."""
+
+    def __init__(self):
+        self.requests: list[tuple[str, int]] = []  # (path, status) of each request
+        self.conditional_requests = 0
+        tile_server = self
+
+        class TileRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                continent, floor, zoom, x, y = (int(part) for part in self.path.removesuffix('.png').strip('/').split('/'))
+                etag = f'"{continent}-{floor}-{zoom}-{x}-{y}"'
+                if self.headers.get('If-None-Match'):
+                    tile_server.conditional_requests += 1
+                if x == missing_tile_x:
+                    self.send_tile_response(404)
+                elif x == failing_tile_x:
+                    self.send_tile_response(500)
+                elif self.headers.get('If-None-Match') == etag:
+                    self.send_tile_response(304, etag=etag)
+                else:
+                    self.send_tile_response(200, create_tile_data(x, y), etag)
+
+            def send_tile_response(self, status: int, data: bytes = b'', etag: str | None = None):
+                tile_server.requests.append((self.path, status))
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), TileRequestHandler)
+        self.tile_url = f'http://127.0.0.1:{self._server.server_port}/{{continent}}/{{floor}}/{{zoom}}/{{x}}/{{y}}.png'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def get_statuses(self) -> list[int]:
+        return [status for _, status in self.requests]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def get_tile_color(x: int, y: int) -> tuple[int, int, int]:
+    return x % 256, y % 256, (x + y) % 256
+
+
+def create_tile_data(x: int, y: int) -> bytes:
+    tile_data = BytesIO()
+    # Uncompressed, so that all tiles have the same size
+    Image.new('RGB', (256, 256), get_tile_color(x, y)).save(tile_data, 'PNG', compress_level=0)
+    return tile_data.getvalue()
+
+
+@pytest.fixture
+def tile_server():
+    server = TileServer()
+    yield server
+    server.close()
+
+
+def create_tile_source(tile_server: TileServer, cache_directory, max_age: float = 3600, max_size: int = 2 ** 20) -> TileApiMapTileSource:
+    return TileApiMapTileSource(tile_server.tile_url, TileCache(str(cache_directory), max_size, max_age))
+
+
+def test_cold_miss_downloads_and_caches_tile(tile_server, tmp_path):
+    tile_source = create_tile_source(tile_server, tmp_path)
+    tile_image = tile_source.get_tile_image(1, 1, 3, 10, 20)
+
+    assert tile_image.convert('RGB').getpixel((0, 0)) == get_tile_color(10, 20)
+    assert tile_server.get_statuses() == [200]
+    assert tile_source.tile_cache.misses == 1
+    assert tile_source.tile_cache.hits == 0
+    assert tile_source.tile_cache.get((1, 1, 3, 10, 20))[0] == create_tile_data(10, 20)
+
+
+def test_warm_hit_needs_no_request(tile_server, tmp_path):
+    cold_tile_source = create_tile_source(tile_server, tmp_path)
+    cold_tile_source.get_tile_image(1, 1, 3, 10, 20)
+    cold_tile_source.finish_loading()
+
+    # A new cache loads the saved index, like the next run
+    warm_tile_source = create_tile_source(tile_server, tmp_path)
+    tile_image = warm_tile_source.get_tile_image(1, 1, 3, 10, 20)
+
+    assert tile_image.convert('RGB').getpixel((0, 0)) == get_tile_color(10, 20)
+    assert tile_server.get_statuses() == [200]
+    assert warm_tile_source.tile_cache.hits == 1
+    assert warm_tile_source.tile_cache.misses == 0
+
+
+def test_stale_tile_is_revalidated_with_etag(tile_server, tmp_path):
+    cold_tile_source = create_tile_source(tile_server, tmp_path)
+    cold_tile_source.get_tile_image(1, 1, 3, 10, 20)
+    cold_tile_source.finish_loading()
+
+    stale_tile_source = create_tile_source(tile_server, tmp_path, max_age=0)
+    tile_image = stale_tile_source.get_tile_image(1, 1, 3, 10, 20)
+
+    assert tile_image.convert('RGB').getpixel((0, 0)) == get_tile_color(10, 20)
+    assert tile_server.get_statuses() == [200, 304]
+    assert tile_server.conditional_requests == 1
+    assert stale_tile_source.tile_cache.revalidations == 1
+    assert stale_tile_source.tile_cache.hits == 0
+    assert stale_tile_source.tile_cache.misses == 0
+
+
+def test_missing_tile_is_cached_as_missing(tile_server, tmp_path):
+    cold_tile_source = create_tile_source(tile_server, tmp_path)
+    tile_image = cold_tile_source.get_tile_image(1, 1, 3, missing_tile_x, 20)
+    cold_tile_source.finish_loading()
+
+    assert tile_image.getextrema() == ((0, 0), (0, 0), (0, 0))
+    assert tile_server.get_statuses() == [404]
+    assert cold_tile_source.tile_cache.get((1, 1, 3, missing_tile_x, 20))[1].missing
+
+    warm_tile_source = create_tile_source(tile_server, tmp_path)
+    tile_image = warm_tile_source.get_tile_image(1, 1, 3, missing_tile_x, 20)
+
+    assert tile_image.getextrema() == ((0, 0), (0, 0), (0, 0))
+    assert tile_server.get_statuses() == [404]
+    assert warm_tile_source.tile_cache.hits == 1
+
+
+def test_least_recently_used_tiles_are_evicted(tile_server, tmp_path):
+    tile_size = len(create_tile_data(0, 0))
+    tile_source = create_tile_source(tile_server, tmp_path, max_size=round(2.5 * tile_size))
+    tile_source.get_tile_image(1, 1, 3, 0, 0)
+    tile_source.get_tile_image(1, 1, 3, 0, 1)
+    # Use the first tile again, so that the second one is the least recently used
+    tile_source.get_tile_image(1, 1, 3, 0, 0)
+    tile_source.get_tile_image(1, 1, 3, 0, 2)
+
+    assert tile_server.get_statuses() == [200, 200, 200]
+    assert tile_source.tile_cache.get((1, 1, 3, 0, 1)) is None
+    assert tile_source.tile_cache.get((1, 1, 3, 0, 0)) is not None
+    assert tile_source.tile_cache.get((1, 1, 3, 0, 2)) is not None
+    assert len(list(tmp_path.rglob('*.jpg'))) == 2
+
+
+class FastRetryTileApiMapTileSource(TileApiMapTileSource):
+    max_retries = 2
+
+
+def test_server_errors_are_retried_then_raised(tile_server, tmp_path):
+    tile_source = FastRetryTileApiMapTileSource(tile_server.tile_url, TileCache(str(tmp_path), 2 ** 20, 3600))
+
+    with pytest.raises(requests.HTTPError):
+        tile_source.get_tile_image(1, 1, 3, failing_tile_x, 20)
+    assert tile_server.get_statuses() == [500] * (1 + FastRetryTileApiMapTileSource.max_retries)
+    assert tile_source.tile_cache.get((1, 1, 3, failing_tile_x, 20)) is None